@@ -3,11 +3,13 @@ Chefs & Bartenders Flask Application Factory
 Clean, modular application structure using blueprints
 """
 from flask import Flask
+from sqlalchemy import inspect
+from sqlalchemy.orm import load_only
 from datetime import datetime
 import os
 
 # Import extensions
-from extensions import db, login_manager, mail
+from extensions import db, login_manager, mail, limiter, cache, celery_init_app
 
 # Import models (must import after extensions to avoid circular imports)
 # Models import db from extensions
@@ -21,8 +23,8 @@ from blueprints.secondary import secondary_bp
 from blueprints.recipes import recipes_bp
 
 # Import utilities
-from utils.helpers import inject_now
-from utils.db_helpers import ensure_schema_updates
+from utils.helpers import inject_now, RecipeCodeConverter
+from utils.db_helpers import ensure_schema_updates, warm_column_cache
 
 
 def create_app(config_object='config.Config'):
@@ -30,19 +32,42 @@ def create_app(config_object='config.Config'):
     app = Flask(__name__)
     app.config.from_object(config_object)
     
+    # Trust X-Forwarded-For from the platform proxy so request.remote_addr is the client IP
+    if app.config.get('PROXY_FIX_X_FOR'):
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+    
+    # Jinja bytecode cache - workers skip parsing/compiling templates another worker already compiled
+    try:
+        from jinja2 import FileSystemBytecodeCache
+        os.makedirs(app.config['JINJA_CACHE_DIR'], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory=app.config['JINJA_CACHE_DIR'])
+    except Exception as e:
+        app.logger.warning(f'Jinja bytecode cache disabled: {str(e)}')
+    
     # Initialize extensions
     db.init_app(app)
     login_manager.init_app(app)
+    limiter.init_app(app)
+    cache.init_app(app)
     # Initialize mail (optional - won't crash if email not configured)
     try:
         # Log mail configuration before initializing (for debugging)
-        import os
         app.logger.info(f'Mail config before init - MAIL_SERVER={app.config.get("MAIL_SERVER")}, MAIL_USERNAME={bool(app.config.get("MAIL_USERNAME"))}, MAIL_PASSWORD={bool(app.config.get("MAIL_PASSWORD"))}, ENV_MAIL_PASSWORD={bool(os.environ.get("MAIL_PASSWORD"))}')
+        # Gmail App Passwords may be pasted with surrounding whitespace
+        if not app.config.get('MAIL_PASSWORD') and (os.environ.get('MAIL_PASSWORD') or '').strip():
+            app.config['MAIL_PASSWORD'] = os.environ['MAIL_PASSWORD'].strip()
         mail.init_app(app)
+        # Credentials don't change after startup - senders check this flag
+        app.extensions['mail_configured'] = bool(app.config.get('MAIL_USERNAME') and app.config.get('MAIL_PASSWORD'))
         app.logger.info('Mail extension initialized successfully')
     except Exception as e:
+        app.extensions['mail_configured'] = False
         app.logger.warning(f'Mail extension initialization warning: {str(e)}')
     
+    # Initialize Celery (background tasks such as verification emails)
+    celery_init_app(app)
+    
     # Configure login manager
     login_manager.login_view = 'auth.login'
     login_manager.login_message = 'Please log in to access this page.'
@@ -50,7 +75,15 @@ def create_app(config_object='config.Config'):
     
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        # Runs on every authenticated request (flask_login caches the result for the rest of it)
+        # Skip the password hash - pages only need id/username/email/is_admin
+        return db.session.get(
+            User, int(user_id),
+            options=[load_only(User.id, User.username, User.email, User.is_admin)]
+        )
+    
+    # URL converters must exist before the blueprint routes using them are registered
+    app.url_map.converters['reccode'] = RecipeCodeConverter
     
     # Register blueprints
     app.register_blueprint(main_bp)
@@ -91,6 +124,36 @@ def create_app(config_object='config.Config'):
         secondary_id = click.prompt('Secondary ingredient ID', type=int)
         show_secondary_ingredient_details(secondary_id)
     
+    @app.cli.command('purge-verification-codes')
+    def purge_verification_codes():
+        """Delete verification codes that expired more than a day ago"""
+        import click
+        from tasks import purge_expired_verification_codes
+        
+        deleted = purge_expired_verification_codes()
+        click.echo(f'✓ Deleted {deleted} expired verification code(s)')
+    
+    @app.cli.command('schema-upgrade')
+    def schema_upgrade():
+        """Apply schema migrations (run once per deploy when AUTO_SCHEMA_UPDATES is off)"""
+        import click
+        from utils.db_helpers import upgrade_schema
+        
+        db.create_all()
+        if upgrade_schema():
+            click.echo('✓ Schema is up to date')
+        else:
+            raise click.ClickException('Schema upgrade incomplete - see the warnings above')
+    
+    @app.cli.command('compile-templates')
+    def compile_templates():
+        """Compile all templates into the Jinja bytecode cache (run at build/deploy time)"""
+        import click
+        names = app.jinja_env.list_templates()
+        for name in names:
+            app.jinja_env.get_template(name)
+        click.echo(f'✓ Compiled {len(names)} template(s) into {app.config["JINJA_CACHE_DIR"]}')
+    
     # Context processor
     @app.context_processor
     def inject_context():
@@ -102,6 +165,11 @@ def create_app(config_object='config.Config'):
         from flask import render_template
         return render_template('error.html', error='Page not found'), 404
     
+    @app.errorhandler(429)
+    def rate_limit_error(error):
+        from flask import render_template
+        return render_template('error.html', error='Too many attempts. Please wait a minute and try again.'), 429
+    
     @app.errorhandler(500)
     def internal_error(error):
         from flask import render_template
@@ -126,8 +194,14 @@ def create_app(config_object='config.Config'):
             # Create all tables
             db.create_all()
             
-            # Run schema updates
+            # Run schema updates (skipped when AUTO_SCHEMA_UPDATES is off)
             ensure_schema_updates()
+            # Load column metadata now so has_column() never queries during a request
+            warm_column_cache()
+            
+            # Request handlers assume the tables exist - make a missing schema obvious in the logs
+            if not inspect(db.engine).has_table('verification_code'):
+                app.logger.error('Database schema is missing the verification_code table - check DATABASE_URL and run flask schema-upgrade')
         except Exception as e:
             # Log error but don't crash - allow app to start
             # Database/table creation will happen on first request if needed
@@ -138,6 +212,8 @@ def create_app(config_object='config.Config'):
 
 # Create the app instance
 app = create_app()
+# Celery worker entry point: celery -A app.celery_app worker
+celery_app = app.extensions['celery']
 
 if __name__ == '__main__':
     app.run(debug=True, port=5001)
@@ -1,167 +1,152 @@
 """
 Authentication blueprint - handles login, register, logout
 """
-from flask import Blueprint, render_template, redirect, url_for, request, flash, session
+import hmac
+from flask import Blueprint, render_template, redirect, url_for, request, flash, session, current_app
+from flask_limiter.util import get_remote_address
 from flask_login import login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
-from extensions import db
+from sqlalchemy import or_
+from sqlalchemy.orm import load_only
+from sqlalchemy.dialects import postgresql, sqlite
+from extensions import db, limiter
 from models import User, VerificationCode
-from utils.email_helpers import generate_verification_code, send_verification_email
+from utils.db_helpers import has_index
+from utils.security import hash_password, verify_password, password_needs_rehash
+from utils.email_helpers import generate_verification_code, is_mail_configured, is_valid_email
+from tasks import queue_verification_email
 from datetime import datetime, timedelta
 
 auth_bp = Blueprint('auth', __name__)
 
+# Minimum time between verification emails for one pending registration
+RESEND_COOLDOWN_SECONDS = 60
+
+
+def save_verification_code(email, code, username, password_hash):
+    """
+    Insert or replace the pending verification code for an email in a single statement.
+    The UPSERT relies on the unique index on verification_code.email - without it
+    (database not migrated yet) the row is replaced with a delete + insert instead.
+    """
+    values = dict(
+        email=email,
+        code=code,
+        username=username,
+        password_hash=password_hash,
+        created_at=datetime.utcnow(),
+        expires_at=datetime.utcnow() + timedelta(minutes=10),
+        verified=False
+    )
+    dialect = db.engine.dialect.name
+    upsert_ready = has_index('verification_code', 'uq_verification_code_email')
+    if dialect == 'postgresql' and upsert_ready:
+        insert = postgresql.insert
+    elif dialect == 'sqlite' and upsert_ready:
+        insert = sqlite.insert
+    else:
+        # No portable UPSERT (or no unique index for ON CONFLICT) - replace the row inside one transaction
+        VerificationCode.query.filter_by(email=email).delete()
+        db.session.add(VerificationCode(**values))
+        db.session.commit()
+        return
+    
+    stmt = insert(VerificationCode).values(**values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['email'],
+        set_={key: stmt.excluded[key] for key in values if key != 'email'}
+    )
+    db.session.execute(stmt)
+    db.session.commit()
+
 
 @auth_bp.route('/register', methods=['GET', 'POST'])
+@limiter.limit('3 per minute', methods=['POST'])
 def register():
-    from flask import current_app
+    # Errors use Post/Redirect/Get: flash the message and send a 303 back to GET /register
     if request.method == 'POST':
         try:
-            try:
-                current_app.logger.info('=== REGISTRATION ATTEMPT STARTED ===')
-                current_app.logger.info(f'Form data received: username={request.form.get("username", "NOT PROVIDED")}, email={request.form.get("email", "NOT PROVIDED")}')
-            except:
-                pass  # Don't crash if logging fails
-                # Initial registration step - collect user info and send code
-                username = request.form.get('username', '').strip()
-                email = request.form.get('email', '').strip()
-                password = request.form.get('password', '')
-                password_confirm = request.form.get('password_confirm', '')
+            current_app.logger.info('=== REGISTRATION ATTEMPT STARTED ===')
+            current_app.logger.info(f'Form data received: username={request.form.get("username", "NOT PROVIDED")}, email={request.form.get("email", "NOT PROVIDED")}')
+            # Initial registration step - collect user info and send code
+            username = request.form.get('username', '').strip()
+            email = request.form.get('email', '').strip()
+            password = request.form.get('password', '')
+            password_confirm = request.form.get('password_confirm', '')
 
-                # Validate inputs
-                if not username or not email or not password or not password_confirm:
-                    current_app.logger.warning(f'Validation failed: missing fields - username={bool(username)}, email={bool(email)}, password={bool(password)}, password_confirm={bool(password_confirm)}')
-                    flash('Please fill in all fields.', 'error')
-                    return render_template('register.html')
-                
-                # Validate passwords match
-                if password != password_confirm:
-                    flash('Passwords do not match. Please try again.')
-                    return render_template('register.html')
-                
-                # Validate password length
-                if len(password) < 6:
-                    flash('Password must be at least 6 characters long.')
-                    return render_template('register.html')
+            # Validate inputs
+            if not username or not email or not password or not password_confirm:
+                current_app.logger.warning(f'Validation failed: missing fields - username={bool(username)}, email={bool(email)}, password={bool(password)}, password_confirm={bool(password_confirm)}')
+                flash('Please fill in all fields.', 'error')
+                return redirect(url_for('auth.register'), code=303)
+            
+            # Validate passwords match
+            if password != password_confirm:
+                flash('Passwords do not match. Please try again.')
+                return redirect(url_for('auth.register'), code=303)
+            
+            # Validate password length
+            if len(password) < 6:
+                flash('Password must be at least 6 characters long.')
+                return redirect(url_for('auth.register'), code=303)
 
-                # Validate email format
-                if '@' not in email or '.' not in email.split('@')[1]:
-                    flash('Please enter a valid email address.')
-                    return render_template('register.html')
+            # Validate email format
+            if not is_valid_email(email):
+                flash('Please enter a valid email address.')
+                return redirect(url_for('auth.register'), code=303)
 
-                # Check if email already registered
-                if User.query.filter_by(email=email).first():
-                    flash('Email already registered. Please log in instead.')
-                    return redirect(url_for('auth.login'))
+            # Check if email or username is already taken (one query for both)
+            taken = db.session.query(User.email, User.username).filter(
+                or_(User.email == email, User.username == username)
+            ).limit(2).all()
+            if any(row.email == email for row in taken):
+                flash('Email already registered. Please log in instead.')
+                return redirect(url_for('auth.login'), code=303)
+            if any(row.username == username for row in taken):
+                flash('Username already taken. Please choose another.')
+                return redirect(url_for('auth.register'), code=303)
 
-                # Check if username already taken
-                if User.query.filter_by(username=username).first():
-                    flash('Username already taken. Please choose another.')
-                    return render_template('register.html')
+            # Email verification is required - registration cannot proceed without a mail server
+            if not is_mail_configured():
+                current_app.logger.error(f'Email not configured - MAIL_USERNAME={bool(current_app.config.get("MAIL_USERNAME"))}, MAIL_PASSWORD={bool(current_app.config.get("MAIL_PASSWORD"))}')
+                flash('⚠️ Unable to send verification email. Email verification is required to complete registration.\n\n'
+                      'Email service is not configured on the server. The administrator needs to set up MAIL_USERNAME and MAIL_PASSWORD environment variables.', 'error')
+                return redirect(url_for('auth.register'), code=303)
 
-                # Generate verification code
-                code = generate_verification_code()
-                
-                # Store registration data in session temporarily
-                session['reg_username'] = username
-                session['reg_email'] = email
-                session['reg_password'] = generate_password_hash(password)
-                
-                # Ensure VerificationCode table exists
-                from flask import current_app
-                try:
-                    # Try to create all tables if they don't exist
-                    db.create_all()
-                except Exception as e:
-                    current_app.logger.warning(f'Table creation check: {str(e)}')
-                
-                # Delete any existing verification codes for this email
-                try:
-                    VerificationCode.query.filter_by(email=email).delete()
-                    db.session.commit()
-                except Exception as e:
-                    current_app.logger.warning(f'Could not delete old verification codes: {str(e)}')
-                    db.session.rollback()
-                
-                # Create new verification code record
-                try:
-                    verification = VerificationCode(
-                        email=email,
-                        code=code,
-                        username=username,
-                        password_hash=session['reg_password'],
-                        expires_at=datetime.utcnow() + timedelta(minutes=10)
-                    )
-                    db.session.add(verification)
-                    db.session.commit()
-                except Exception as e:
-                    current_app.logger.error(f'Database error creating verification code: {str(e)}', exc_info=True)
-                    db.session.rollback()
-                    # Try creating table again and retry
-                    try:
-                        db.create_all()
-                        db.session.add(verification)
-                        db.session.commit()
-                    except Exception as e2:
-                        db.session.rollback()
-                        current_app.logger.error(f'Failed to create verification code after retry: {str(e2)}', exc_info=True)
-                        flash(f'Database error. Please try again or contact administrator. Error: {str(e2)}')
-                        return render_template('register.html')
-                
-                # Email verification is MANDATORY - send verification email
-                # Code is ONLY sent via email, never shown on page
-                current_app.logger.info(f'Attempting to send verification email to {email} with code {code}')
-                current_app.logger.info(f'Email config status - MAIL_USERNAME={bool(current_app.config.get("MAIL_USERNAME"))}, MAIL_PASSWORD={bool(current_app.config.get("MAIL_PASSWORD"))}, MAIL_SERVER={current_app.config.get("MAIL_SERVER", "Not set")}')
-                email_sent = send_verification_email(email, code)
-                current_app.logger.info(f'Email send result: {email_sent}')
-                
-                if email_sent:
-                    current_app.logger.info(f'Email sent successfully to {email}')
-                    flash('Verification code sent to your email. Please check your inbox (and spam folder).', 'success')
-                    return render_template('verify_email.html', email=email)
-                else:
-                    # If email not configured or failed, show detailed error
-                    # Email verification is required - registration cannot proceed without it
-                    mail_username = current_app.config.get('MAIL_USERNAME')
-                    mail_password = current_app.config.get('MAIL_PASSWORD')
-                    mail_server = current_app.config.get('MAIL_SERVER', 'Not set')
-                    
-                    # Check what specifically failed
-                    if not mail_username or not mail_password:
-                        error_detail = 'Email service is not configured on the server. The administrator needs to set up MAIL_USERNAME and MAIL_PASSWORD environment variables.'
-                        current_app.logger.error(f'Email not configured - MAIL_USERNAME={bool(mail_username)}, MAIL_PASSWORD={bool(mail_password)}')
-                    else:
-                        error_detail = f'Email service is configured (Server: {mail_server}) but failed to send. This could be due to incorrect credentials or network issues.'
-                        current_app.logger.error(f'Email sending failed - MAIL_SERVER={mail_server}, email={email}')
-                    
-                    error_message = f'⚠️ Unable to send verification email. Email verification is required to complete registration.\n\n{error_detail}\n\nPlease contact the administrator to configure email service.'
-                    current_app.logger.error(f'Registration blocked due to email failure: {error_message}')
-                    flash(error_message, 'error')
-                    
-                    # Clean up the verification code since we can't send it
-                    try:
-                        db.session.delete(verification)
-                        db.session.commit()
-                    except Exception as cleanup_error:
-                        current_app.logger.warning(f'Error cleaning up verification code: {cleanup_error}')
-                        db.session.rollback()
-                    session.clear()
-                    return render_template('register.html')
+            # Generate verification code
+            code = generate_verification_code()
+            
+            # Hash only now that every cheap check has passed - the KDF is the most expensive step
+            password_hash = hash_password(password)
+            
+            # Store the code - replaces any previous code for this email in one statement
+            save_verification_code(email, code, username, password_hash)
+            
+            # Only the email goes in the session - username and password hash live on the VerificationCode row
+            session['reg_email'] = email
+            
+            # Email verification is MANDATORY - send verification email
+            # Code is ONLY sent via email, never shown on page
+            # Sending happens in a background task so the SMTP round trip doesn't block this worker
+            current_app.logger.info(f'Queueing verification email to {email}')
+            queue_verification_email(email, code)
+            flash('Verification code sent to your email. Please check your inbox (and spam folder).', 'success')
+            return render_template('verify_email.html', email=email)
         except Exception as e:
-            from flask import current_app
-            import traceback
-            try:
-                current_app.logger.error(f'Registration error: {str(e)}', exc_info=True)
-                current_app.logger.error(f'Traceback: {traceback.format_exc()}')
-            except:
-                pass  # Don't crash if logging fails
+            db.session.rollback()
+            current_app.logger.error(f'Registration error: {str(e)}', exc_info=True)
             flash(f'An error occurred during registration: {str(e)}. Please try again.', 'error')
-            return render_template('register.html')
+            return redirect(url_for('auth.register'), code=303)
 
     return render_template('register.html')
 
 
+def _verification_limit_key():
+    """Rate-limit code attempts per pending registration, falling back to client IP"""
+    return session.get('reg_email') or get_remote_address()
+
+
 @auth_bp.route('/verify-email', methods=['GET', 'POST'])
+@limiter.limit('10 per hour', methods=['POST'], key_func=_verification_limit_key)
 def verify_registration():
     """Handle email verification step"""
     if request.method == 'GET':
@@ -179,11 +164,14 @@ def verify_registration():
         flash('Session expired. Please register again.')
         return redirect(url_for('auth.register'))
     
-    # Find verification code
-    verification = VerificationCode.query.filter_by(
+    # Find verification code (at most one per email - unique index lookup, no sort needed)
+    verification = VerificationCode.query.options(
+        load_only(VerificationCode.email, VerificationCode.code, VerificationCode.expires_at,
+                  VerificationCode.username, VerificationCode.password_hash)
+    ).filter_by(
         email=email,
         verified=False
-    ).order_by(VerificationCode.created_at.desc()).first()
+    ).first()
     
     if not verification:
         flash('No verification code found. Please register again.')
@@ -197,7 +185,8 @@ def verify_registration():
         session.clear()
         return redirect(url_for('auth.register'))
     
-    if entered_code != verification.code:
+    # Constant-time comparison (encode first - compare_digest rejects non-ASCII str)
+    if not hmac.compare_digest(entered_code.encode('utf-8'), verification.code.encode('utf-8')):
         flash('Invalid verification code. Please try again.')
         return render_template('verify_email.html', email=email)
     
@@ -210,18 +199,12 @@ def verify_registration():
         )
         db.session.add(user)
         
-        # Mark verification as used
-        verification.verified = True
+        # The code is used up - remove it in the same transaction that creates the user
+        db.session.delete(verification)
         db.session.commit()
         
         # Clean up session
-        session.pop('reg_username', None)
         session.pop('reg_email', None)
-        session.pop('reg_password', None)
-        
-        # Delete old verification codes for this email
-        VerificationCode.query.filter_by(email=email, verified=True).delete()
-        db.session.commit()
         
         flash('Account created successfully! Please log in.')
         return redirect(url_for('auth.login'))
@@ -232,6 +215,7 @@ def verify_registration():
 
 
 @auth_bp.route('/resend-code', methods=['POST'])
+@limiter.limit('3 per minute')
 def resend_code():
     """Resend verification code"""
     email = session.get('reg_email')
@@ -240,31 +224,33 @@ def resend_code():
         flash('Session expired. Please register again.')
         return redirect(url_for('auth.register'))
     
+    if not is_mail_configured():
+        current_app.logger.error(f'Email not configured - cannot resend verification code to {email}')
+        flash('⚠️ Email service is not configured. Please contact administrator.', 'error')
+        return redirect(url_for('auth.verify_registration'))
+    
+    # Registration details are kept on the pending verification row
+    pending = VerificationCode.query.options(
+        load_only(VerificationCode.username, VerificationCode.password_hash, VerificationCode.created_at)
+    ).filter_by(email=email, verified=False).first()
+    if not pending:
+        flash('No pending registration found. Please register again.')
+        session.pop('reg_email', None)
+        return redirect(url_for('auth.register'))
+    
+    # The last code is probably still on its way - don't start another SMTP send for it
+    if pending.created_at and pending.created_at > datetime.utcnow() - timedelta(seconds=RESEND_COOLDOWN_SECONDS):
+        flash('A verification code was sent less than a minute ago. Please check your inbox (and spam folder).')
+        return redirect(url_for('auth.verify_registration'))
+    
     try:
-        # Delete old codes
-        VerificationCode.query.filter_by(email=email).delete()
-        
-        # Generate new code
+        # Generate new code (replaces the old one)
         code = generate_verification_code()
-        verification = VerificationCode(
-            email=email,
-            code=code,
-            username=session.get('reg_username', ''),
-            password_hash=session.get('reg_password', ''),
-            expires_at=datetime.utcnow() + timedelta(minutes=10)
-        )
-        db.session.add(verification)
-        db.session.commit()
+        save_verification_code(email, code, pending.username, pending.password_hash)
         
-        email_sent = send_verification_email(email, code)
-        if email_sent:
-            flash('New verification code sent to your email. Please check your inbox (and spam folder).')
-        else:
-            from flask import current_app
-            current_app.logger.error(f'Email not configured - cannot resend verification code to {email}')
-            flash('⚠️ Email service is not configured. Please contact administrator.', 'error')
+        queue_verification_email(email, code)
+        flash('New verification code sent to your email. Please check your inbox (and spam folder).')
     except Exception as e:
-        from flask import current_app
         current_app.logger.error(f'Error resending code: {str(e)}', exc_info=True)
         db.session.rollback()
         flash('Error generating new code. Please try again.')
@@ -273,6 +259,7 @@ def resend_code():
 
 
 @auth_bp.route('/login', methods=['GET', 'POST'])
+@limiter.limit('5 per minute;20 per hour', methods=['POST'])
 def login():
     if request.method == 'POST':
         login_input = request.form.get('email', '').strip()
@@ -282,13 +269,20 @@ def login():
             flash('Please enter both email/username and password.')
             return render_template('login.html')
         
-        # Try to find user by email first, then by username
-        user = User.query.filter_by(email=login_input).first()
-        if not user:
-            # If not found by email, try username
-            user = User.query.filter_by(username=login_input).first()
+        # Find user by email or username in one query (email match wins if both exist)
+        user = User.query.filter(
+            or_(User.email == login_input, User.username == login_input)
+        ).order_by((User.email == login_input).desc()).first()
         
-        if user and check_password_hash(user.password, password):
+        if user and verify_password(user.password, password):
+            # Transparently migrate legacy pbkdf2/scrypt hashes to argon2
+            if password_needs_rehash(user.password):
+                try:
+                    user.password = hash_password(password)
+                    db.session.commit()
+                except Exception as e:
+                    current_app.logger.warning(f'Could not upgrade password hash for user {user.id}: {str(e)}')
+                    db.session.rollback()
             login_user(user)
             flash('Welcome back!')
             return redirect(url_for('main.index'))
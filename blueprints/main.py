@@ -2,6 +2,7 @@
 Main blueprint - handles index, errors, and file uploads
 """
 from flask import Blueprint, render_template, send_from_directory, current_app
+from extensions import db
 
 main_bp = Blueprint('main', __name__)
 
@@ -24,7 +25,6 @@ def not_found_error(error):
 
 @main_bp.errorhandler(500)
 def internal_error(error):
-    from extensions import db
     db.session.rollback()
     current_app.logger.error(f'Internal Server Error: {str(error)}', exc_info=True)
     return render_template('error.html', error=str(error)), 500
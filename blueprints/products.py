@@ -2,19 +2,119 @@
 Products/Ingredients Master List Blueprint
 Handles all product and ingredient master list routes
 """
-from flask import Blueprint, render_template, redirect, url_for, request, flash, current_app
+from flask import Blueprint, render_template, redirect, url_for, request, flash, current_app, jsonify
 from flask_login import login_required, current_user
-from extensions import db
-from models import Product, HomemadeIngredient
-from utils.db_helpers import ensure_schema_updates
-from utils.file_upload import save_uploaded_file
-from utils.ai_categorization import categorize_product_ai, should_use_ai_categorization
+from extensions import db, cache
+from sqlalchemy import func, cast, or_, BigInteger
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload, load_only
+from models import Product, HomemadeIngredient, HomemadeIngredientItem, RecipeIngredient
+from utils.db_helpers import ensure_schema_updates, has_column, product_code_indexes_ready
+from utils.file_upload import save_uploaded_file, delete_file_async
+from utils.ai_categorization import categorize_products_ai, should_use_ai_categorization
+from utils.ingredient_options import invalidate_ingredient_options
+import re
 import uuid
 import os
-import time
+import logging
+import traceback
+from collections import namedtuple
+
+# pandas/openpyxl are only needed for bulk upload - the rest of the blueprint works without them
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+try:
+    from openpyxl import load_workbook
+except ImportError:
+    load_workbook = None
 
 products_bp = Blueprint('products', __name__)
 
+# Sub-categories always offered in the master list filter, whatever the user has stored
+DEFAULT_CATEGORIES = frozenset([
+    'Alcohol', 'Non Alcohol', 'Non-Alcohol', 'Fruits', 'Vegetables', 'Dairy', 'Syrups & Purees',
+    'Syrup', 'Puree', 'Juice', 'Other', 'Food', 'Beverage', 'Secondary Ingredient'
+])
+
+# One master list table row (products and secondary ingredients share the same columns)
+MasterRow = namedtuple('MasterRow', 'id kind image unique_item_number code description supplier '
+                                    'category sub_category item_level quantity cost_per_unit')
+# Master list rows per JSON page (default / largest a client may ask for)
+MASTER_PAGE_SIZE = 100
+MASTER_PAGE_MAX = 500
+
+
+@cache.memoize(timeout=3600)
+def _user_categories(user_id):
+    """Sorted category dropdown for a user - cached until one of their products changes"""
+    stored = db.session.query(Product.sub_category).filter(
+        Product.user_id == user_id, Product.sub_category.isnot(None), Product.sub_category != ''
+    ).distinct()
+    return sorted(DEFAULT_CATEGORIES.union(row.sub_category for row in stored))
+
+
+def invalidate_user_categories(user_id):
+    """Drop the cached category dropdown after products are added, edited or deleted"""
+    try:
+        cache.delete_memoized(_user_categories, user_id)
+    except Exception as e:
+        current_app.logger.warning(f'Could not invalidate category cache for user {user_id}: {str(e)}')
+
+
+def next_barbuddy_code(user_id):
+    """Next BB### code for a user: highest existing numeric code + 1, computed in SQL"""
+    latest_number = db.session.query(
+        func.max(cast(func.substr(Product.barbuddy_code, 3), BigInteger))
+    ).filter(
+        Product.user_id == user_id,
+        Product.barbuddy_code.regexp_match('^BB[0-9]{1,18}$')
+    ).scalar()
+    return f"BB{(latest_number or 0) + 1:03d}"
+
+
+def unique_item_number_taken(user_id, unique_item_number, exclude_id=None):
+    """
+    Existence check for a user's item number. Only queries while the per-user unique
+    index is missing (older databases with duplicate codes) - otherwise the index
+    rejects duplicates on commit.
+    """
+    if product_code_indexes_ready():
+        return False
+    query = db.session.query(Product.id).filter(
+        Product.user_id == user_id, Product.unique_item_number == unique_item_number
+    )
+    if exclude_id is not None:
+        query = query.filter(Product.id != exclude_id)
+    return query.first() is not None
+
+
+# Per-user unique indexes on product codes -> the column each one guards
+PRODUCT_CODE_INDEXES = {
+    'product_user_unique_item_number_key': 'unique_item_number',
+    'product_user_barbuddy_code_key': 'barbuddy_code',
+}
+
+
+def duplicate_product_code(error):
+    """
+    Which product code an IntegrityError rejected: 'unique_item_number', 'barbuddy_code' or None.
+    PostgreSQL names the violated index; SQLite only lists its columns
+    ("UNIQUE constraint failed: product.user_id, product.unique_item_number").
+    """
+    constraint = getattr(getattr(error.orig, 'diag', None), 'constraint_name', None)
+    if constraint:
+        return PRODUCT_CODE_INDEXES.get(constraint)
+    message = str(error.orig)
+    prefix = 'UNIQUE constraint failed: '
+    if message.startswith(prefix):
+        columns = {column.rsplit('.', 1)[-1] for column in message[len(prefix):].split(', ')}
+        for column in PRODUCT_CODE_INDEXES.values():
+            if column in columns:
+                return column
+    return None
+
 
 @products_bp.route('/products')
 @login_required
@@ -40,20 +140,16 @@ def add_product():
         bottles_per_case = int(request.form.get('bottles_per_case', 1))
         unique_item_number = (request.form.get('unique_item_number', '') or '').strip()
 
+        # Duplicates are rejected by the (user_id, unique_item_number) unique index on insert,
+        # or checked up front while an older database can't have that index yet
         if unique_item_number:
-            if Product.query.filter(Product.user_id == current_user.id, Product.unique_item_number == unique_item_number).first():
+            if unique_item_number_taken(current_user.id, unique_item_number):
                 flash('Unique item number already exists. Please use a different value.')
                 return redirect(url_for('products.add_product'))
         else:
             unique_item_number = f"ITEM-{uuid.uuid4().hex[:8].upper()}"
 
-        # Get latest product for this user to generate next code
-        latest_product = Product.query.filter(Product.user_id == current_user.id).order_by(Product.id.desc()).first()
-        if latest_product and latest_product.barbuddy_code and latest_product.barbuddy_code[2:].isdigit():
-            next_number = int(latest_product.barbuddy_code[2:]) + 1
-        else:
-            next_number = 1
-        barbuddy_code = f"BB{next_number:03d}"
+        barbuddy_code = next_barbuddy_code(current_user.id)
 
         image_path = None
         if 'image' in request.files:
@@ -80,84 +176,134 @@ def add_product():
         )
 
         db.session.add(product)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError as e:
+            # The unique indexes reject duplicates - no SELECT before the INSERT
+            db.session.rollback()
+            if image_path:
+                delete_file_async(os.path.join(current_app.static_folder, image_path))
+            if duplicate_product_code(e) == 'unique_item_number':
+                flash('Unique item number already exists. Please use a different value.')
+            else:
+                flash('Could not assign a unique code. Please try again.')
+            return redirect(url_for('products.add_product'))
+        invalidate_user_categories(current_user.id)
+        invalidate_ingredient_options(current_user.id)
         flash('Product added successfully!')
         return redirect(url_for('products.products'))
     return render_template('products/add_product.html')
 
 
+def _master_product_query(user_id, category_key, level_filter):
+    """The user's products for the master list (only the listed columns), filtered in SQL"""
+    query = db.session.query(
+        Product.id, Product.image_path, Product.unique_item_number, Product.barbuddy_code, Product.description,
+        Product.supplier, Product.category, Product.sub_category, Product.item_level, Product.ml_in_bottle,
+        Product.cost_per_unit
+    ).filter(Product.user_id == user_id)
+    if category_key:
+        if category_key == 'other':
+            # Blank sub-categories are shown as 'Other'
+            query = query.filter(or_(
+                func.lower(Product.sub_category) == 'other',
+                Product.sub_category.is_(None),
+                Product.sub_category == ''
+            ))
+        else:
+            query = query.filter(func.lower(Product.sub_category) == category_key)
+    if level_filter:
+        if level_filter == 'Primary':
+            # Blank item levels are shown as 'Primary'
+            query = query.filter(or_(
+                Product.item_level == 'Primary',
+                Product.item_level.is_(None),
+                Product.item_level == ''
+            ))
+        else:
+            query = query.filter(Product.item_level == level_filter)
+    return query
+
+
+def _product_row(p):
+    return MasterRow(p.id, 'product', p.image_path, p.unique_item_number or 'N/A', p.barbuddy_code or 'N/A',
+                     p.description, p.supplier or 'N/A', p.category or 'Product', p.sub_category or 'Other',
+                     p.item_level or 'Primary', p.ml_in_bottle, p.cost_per_unit or 0.0)
+
+
+def _secondary_row(sec):
+    return MasterRow(sec.id, 'secondary', None, sec.unique_code or 'N/A', sec.unique_code or 'N/A',
+                     sec.name, 'In-House', 'Secondary', 'Secondary Ingredient',
+                     'Secondary', sec.total_volume_ml, sec.calculate_cost_per_unit())
+
+
 @products_bp.route('/ingredients', methods=['GET'])
 @login_required
 def ingredients_master():
+    """Master list page - rows are fetched page by page from ingredients_master_json"""
+    category_filter = request.args.get('category', '')
+    level_filter = request.args.get('level', '')
+    try:
+        # Category dropdown is cached per user and invalidated by the add/edit/delete routes
+        if all(has_column(table, 'user_id') for table in ('product', 'homemade_ingredient')):
+            categories = _user_categories(current_user.id)
+        else:
+            categories = sorted(DEFAULT_CATEGORIES)
+    except Exception as e:
+        current_app.logger.error('Error loading categories: %s', e, exc_info=True)
+        categories = sorted(DEFAULT_CATEGORIES)
+    return render_template('master_list/master.html', categories=categories, selected_category=category_filter, selected_level=level_filter)
+
+
+@products_bp.route('/ingredients.json', methods=['GET'])
+@login_required
+def ingredients_master_json():
+    """
+    One page of master list rows: products by id, then secondary ingredients.
+    Keyset pagination - cursor is 'p<last product id>' or 's<last secondary id>'.
+    """
+    category_key = request.args.get('category', '').lower()
+    level_filter = request.args.get('level', '')
+    limit = min(max(request.args.get('limit', MASTER_PAGE_SIZE, type=int) or MASTER_PAGE_SIZE, 1), MASTER_PAGE_MAX)
+    cursor = request.args.get('cursor', '')
+    kind = cursor[:1] if cursor[:1] in ('p', 's') else 'p'
+    after_id = int(cursor[1:]) if cursor[1:].isdigit() else 0
     try:
-        category_filter = request.args.get('category', '')
-        level_filter = request.args.get('level', '')
-        # Filter by user_id, excluding NULL user_id records (old data)
         # Handle case where user_id column might not exist yet
-        from utils.db_helpers import has_column
-        try:
-            if has_column('product', 'user_id') and has_column('homemade_ingredient', 'user_id'):
-                # Columns exist - filter by user
-                products = Product.query.filter(Product.user_id == current_user.id).all()
-                secondary_items = HomemadeIngredient.query.filter(HomemadeIngredient.user_id == current_user.id).all()
-            else:
-                # Columns don't exist yet - return empty lists
-                current_app.logger.info('user_id columns do not exist yet - returning empty lists')
-                products = []
-                secondary_items = []
-        except Exception as e:
-            # If any error occurs, return empty lists
-            current_app.logger.error(f'Error loading ingredients: {str(e)}', exc_info=True)
-            products = []
-            secondary_items = []
-
-        rows = []
-        for p in products:
-            rows.append({
-                'id': p.id,
-                'kind': 'product',
-                'image': p.image_path,
-                'unique_item_number': p.unique_item_number or 'N/A',
-                'code': p.barbuddy_code or 'N/A',
-                'description': p.description,
-                'supplier': p.supplier or 'N/A',
-                'category': p.category or 'Product',
-                'sub_category': p.sub_category or 'Other',
-                'item_level': p.item_level or 'Primary',
-                'quantity': p.ml_in_bottle,
-                'cost_per_unit': p.cost_per_unit or 0.0
-            })
-
-        for sec in secondary_items:
-            rows.append({
-                'id': sec.id,
-                'kind': 'secondary',
-                'image': None,
-                'unique_item_number': sec.unique_code or 'N/A',
-                'code': sec.unique_code or 'N/A',
-                'description': sec.name,
-                'supplier': 'In-House',
-                'category': 'Secondary',
-                'sub_category': 'Secondary Ingredient',
-                'item_level': 'Secondary',
-                'quantity': sec.total_volume_ml,
-                'cost_per_unit': sec.calculate_cost_per_unit()
-            })
-
-        if category_filter:
-            rows = [r for r in rows if (r['sub_category'] or '').lower() == category_filter.lower()]
-        if level_filter:
-            rows = [r for r in rows if (r['item_level'] or 'Primary') == level_filter]
-
-        categories = db.session.query(Product.sub_category).filter(Product.user_id == current_user.id).distinct().all()
-        categories = [c[0] for c in categories if c[0]]
-        default_categories = ['Alcohol', 'Non Alcohol', 'Non-Alcohol', 'Fruits', 'Vegetables', 'Dairy', 'Syrups & Purees', 'Syrup', 'Puree', 'Juice', 'Other', 'Food', 'Beverage', 'Secondary Ingredient']
-        categories = sorted(set(categories + default_categories))
-        return render_template('master_list/master.html', rows=rows, categories=categories, selected_category=category_filter, selected_level=level_filter)
+        if not all(has_column(table, 'user_id') for table in ('product', 'homemade_ingredient')):
+            return jsonify(rows=[], next_cursor=None)
+
+        # Secondary ingredients are listed as 'Secondary Ingredient' / 'Secondary' - skip them if filtered out
+        include_secondary = category_key in ('', 'secondary ingredient') and level_filter in ('', 'Secondary')
+        next_cursor = None
+        if kind == 'p':
+            products = _master_product_query(current_user.id, category_key, level_filter).filter(
+                Product.id > after_id
+            ).order_by(Product.id).limit(limit + 1).all()
+            if len(products) > limit:
+                products = products[:limit]
+                next_cursor = f'p{products[-1].id}'
+            elif include_secondary:
+                next_cursor = 's0'
+            rows = [_product_row(p) for p in products]
+        elif include_secondary:
+            # Preload recipe items and their products so calculate_cost_per_unit() doesn't lazy-load per row
+            secondary_items = HomemadeIngredient.query.filter(
+                HomemadeIngredient.user_id == current_user.id,
+                HomemadeIngredient.id > after_id
+            ).options(
+                selectinload(HomemadeIngredient.ingredients).selectinload(HomemadeIngredientItem.product)
+            ).order_by(HomemadeIngredient.id).limit(limit + 1).all()
+            if len(secondary_items) > limit:
+                secondary_items = secondary_items[:limit]
+                next_cursor = f's{secondary_items[-1].id}'
+            rows = [_secondary_row(sec) for sec in secondary_items]
+        else:
+            rows = []
+        return jsonify(rows=[row._asdict() for row in rows], next_cursor=next_cursor)
     except Exception as e:
-        flash(f'Error loading ingredients: {str(e)}')
-        current_app.logger.error(f'Error in ingredients_master: {str(e)}', exc_info=True)
-        return render_template('master_list/master.html', rows=[], categories=[], selected_category='', selected_level='')
+        current_app.logger.error('Error in ingredients_master_json: %s', e, exc_info=True)
+        return jsonify(error=f'Error loading ingredients: {str(e)}'), 500
 
 
 @products_bp.route('/ingredients/add', methods=['GET', 'POST'])
@@ -178,19 +324,16 @@ def add_ingredient():
         purchase_type = request.form.get('purchase_type', 'each')
         bottles_per_case = int(request.form.get('bottles_per_case', 1) or 1)
 
+        # Duplicates are rejected by the (user_id, unique_item_number) unique index on insert,
+        # or checked up front while an older database can't have that index yet
         if unique_item_number:
-            if Product.query.filter(Product.user_id == current_user.id, Product.unique_item_number == unique_item_number).first():
+            if unique_item_number_taken(current_user.id, unique_item_number):
                 flash('Unique item number already exists. Please use a different one.')
                 return redirect(url_for('products.ingredients_master'))
         else:
             unique_item_number = f"ITEM-{uuid.uuid4().hex[:8].upper()}"
 
-        latest_product = Product.query.filter(Product.user_id == current_user.id).order_by(Product.id.desc()).first()
-        if latest_product and latest_product.barbuddy_code and latest_product.barbuddy_code[2:].isdigit():
-            next_number = int(latest_product.barbuddy_code[2:]) + 1
-        else:
-            next_number = 1
-        barbuddy_code = f"BB{next_number:03d}"
+        barbuddy_code = next_barbuddy_code(current_user.id)
 
         image_path = None
         if 'image' in request.files:
@@ -217,7 +360,20 @@ def add_ingredient():
         )
 
         db.session.add(product)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError as e:
+            # The unique indexes reject duplicates - no SELECT before the INSERT
+            db.session.rollback()
+            if image_path:
+                delete_file_async(os.path.join(current_app.static_folder, image_path))
+            if duplicate_product_code(e) == 'unique_item_number':
+                flash('Unique item number already exists. Please use a different one.')
+            else:
+                flash('Could not assign a unique code. Please try again.')
+            return redirect(url_for('products.ingredients_master'))
+        invalidate_user_categories(current_user.id)
+        invalidate_ingredient_options(current_user.id)
         flash('Ingredient added successfully!')
         return redirect(url_for('products.ingredients_master'))
     return render_template('master_list/add.html')
@@ -226,9 +382,18 @@ def add_ingredient():
 @products_bp.route('/ingredients/<int:id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_ingredient(id):
-    product = Product.query.filter(Product.id == id, Product.user_id == current_user.id).first_or_404()
+    # Only the columns the edit form shows and updates
+    product = Product.query.options(load_only(
+        Product.id, Product.unique_item_number, Product.description, Product.supplier, Product.category,
+        Product.sub_category, Product.item_level, Product.ml_in_bottle, Product.selling_unit,
+        Product.cost_per_unit, Product.purchase_type, Product.bottles_per_case, Product.image_path
+    )).filter(Product.id == id, Product.user_id == current_user.id).first_or_404()
     if request.method == 'POST':
-        product.unique_item_number = request.form.get('unique_item_number', product.unique_item_number)
+        unique_item_number = request.form.get('unique_item_number', product.unique_item_number)
+        if unique_item_number != product.unique_item_number and unique_item_number_taken(current_user.id, unique_item_number, exclude_id=product.id):
+            flash('Unique item number already exists. Please use a different one.')
+            return redirect(url_for('products.edit_ingredient', id=id))
+        product.unique_item_number = unique_item_number
         product.description = request.form['description']
         product.supplier = request.form.get('supplier', product.supplier or 'N/A').strip() or 'N/A'
         product.category = request.form['category']
@@ -240,16 +405,28 @@ def edit_ingredient(id):
         product.purchase_type = request.form.get('purchase_type', 'each')
         product.bottles_per_case = int(request.form.get('bottles_per_case', 1) or 1)
         
+        old_image_path = new_image_path = None
         if 'image' in request.files:
             file = request.files['image']
             if file.filename:
-                if product.image_path:
-                    old_path = os.path.join(current_app.config['UPLOAD_FOLDER'], product.image_path)
-                    if os.path.exists(old_path):
-                        os.remove(old_path)
-                product.image_path = save_uploaded_file(file, 'products')
+                old_image_path = product.image_path
+                new_image_path = save_uploaded_file(file, 'products')
+                product.image_path = new_image_path
         
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            # The row still points at the old image - only the new upload is orphaned
+            if new_image_path and new_image_path != old_image_path:
+                delete_file_async(os.path.join(current_app.static_folder, new_image_path))
+            flash('Unique item number already exists. Please use a different one.')
+            return redirect(url_for('products.edit_ingredient', id=id))
+        # Old image is unlinked in the background once the row no longer references it
+        if old_image_path and old_image_path != new_image_path:
+            delete_file_async(os.path.join(current_app.static_folder, old_image_path))
+        invalidate_user_categories(current_user.id)
+        invalidate_ingredient_options(current_user.id)
         flash('Ingredient updated successfully!')
         return redirect(url_for('products.ingredients_master'))
     return render_template('master_list/edit.html', product=product)
@@ -261,6 +438,8 @@ def delete_ingredient(id):
     product = Product.query.filter(Product.id == id, Product.user_id == current_user.id).first_or_404()
     db.session.delete(product)
     db.session.commit()
+    invalidate_user_categories(current_user.id)
+    invalidate_ingredient_options(current_user.id)
     flash('Ingredient deleted successfully!')
     return redirect(url_for('products.ingredients_master'))
 
@@ -271,11 +450,11 @@ def delete_all_ingredients():
     try:
         ensure_schema_updates()
         # Delete all products for this user (not secondary ingredients)
-        products = Product.query.filter(Product.user_id == current_user.id).all()
-        count = len(products)
-        for product in products:
-            db.session.delete(product)
+        # Single DELETE statement - no need to load the rows first
+        count = Product.query.filter(Product.user_id == current_user.id).delete(synchronize_session=False)
         db.session.commit()
+        invalidate_user_categories(current_user.id)
+        invalidate_ingredient_options(current_user.id)
         flash(f'Successfully deleted {count} product(s) from the master list.')
     except Exception as e:
         db.session.rollback()
@@ -294,58 +473,85 @@ def delete_selected_ingredients():
             flash('No items selected for deletion.', 'error')
             return redirect(url_for('products.ingredients_master'))
         
+        ids = [int(item_id) for item_id in selected_ids if str(item_id).isdigit()]
+        # Only this user's products (and references to them) may be deleted
+        owned_ids = [row.id for row in db.session.query(Product.id).filter(
+            Product.id.in_(ids), Product.user_id == current_user.id
+        )]
+        
         count = 0
-        errors = []
-        for item_id in selected_ids:
-            try:
-                item_id_int = int(item_id)
-                product = Product.query.filter(Product.id == item_id_int, Product.user_id == current_user.id).first()
-                if product:
-                    try:
-                        # Delete related recipe ingredients and secondary ingredient items first
-                        from models import RecipeIngredient, HomemadeIngredientItem
-                        RecipeIngredient.query.filter(
-                            RecipeIngredient.ingredient_type == 'Product',
-                            RecipeIngredient.ingredient_id == item_id_int
-                        ).delete()
-                        HomemadeIngredientItem.query.filter(
-                            HomemadeIngredientItem.product_id == item_id_int
-                        ).delete()
-                        
-                        db.session.delete(product)
-                        count += 1
-                    except Exception as delete_error:
-                        current_app.logger.error(f'Error deleting product {item_id_int} and its references: {str(delete_error)}', exc_info=True)
-                        errors.append(f"Error deleting {product.description}: {str(delete_error)}")
-                        continue
-                else:
-                    current_app.logger.warning(f'Product {item_id_int} not found or does not belong to user {current_user.id}')
-            except (ValueError, TypeError) as e:
-                current_app.logger.warning(f'Invalid item ID: {item_id}, error: {str(e)}')
-                continue
-            except Exception as e:
-                current_app.logger.error(f'Error deleting product {item_id}: {str(e)}', exc_info=True)
-                errors.append(f"Error deleting item {item_id}: {str(e)}")
-                continue
+        if owned_ids:
+            # Delete related recipe ingredients and secondary ingredient items first, then the products
+            RecipeIngredient.query.filter(
+                RecipeIngredient.ingredient_type == 'Product',
+                RecipeIngredient.ingredient_id.in_(owned_ids)
+            ).delete(synchronize_session=False)
+            HomemadeIngredientItem.query.filter(
+                HomemadeIngredientItem.product_id.in_(owned_ids)
+            ).delete(synchronize_session=False)
+            count = Product.query.filter(Product.id.in_(owned_ids)).delete(synchronize_session=False)
+        db.session.commit()
+        invalidate_user_categories(current_user.id)
+        invalidate_ingredient_options(current_user.id)
         
-        if errors:
-            db.session.rollback()
-            flash('Some items could not be deleted: ' + ' '.join(errors), 'error')
+        if count > 0:
+            flash(f'Successfully deleted {count} selected product(s) from the master list.')
         else:
-            db.session.commit()
-            if count > 0:
-                flash(f'Successfully deleted {count} selected product(s) from the master list.')
-            else:
-                flash('No products were deleted. Please check that items are selected and belong to you.', 'error')
+            flash('No products were deleted. Please check that items are selected and belong to you.', 'error')
     except Exception as e:
         db.session.rollback()
         current_app.logger.error(f'Error deleting selected ingredients: {str(e)}', exc_info=True)
-        import traceback
         current_app.logger.error(traceback.format_exc())
         flash(f'An error occurred while deleting selected products: {str(e)}', 'error')
     return redirect(url_for('products.ingredients_master'))
 
 
+# Rows parsed, inserted and committed per bulk upload batch
+BULK_UPLOAD_BATCH_SIZE = 1000
+# Bulk upload sheet headers (compared upper-cased and stripped)
+REQUIRED_COLUMNS = ('DESCRIPTION', 'SUPPLIER', 'CATEGORY', 'COST/UNIT (AED)')
+SUB_CATEGORY_COLUMNS = ('SUB CATEGORY', 'SUB-CATEGORY', 'SUB_CATEGORY', 'SUBCATEGORY')
+
+
+def _iter_upload_sheet(file, batch_size=BULK_UPLOAD_BATCH_SIZE):
+    """
+    Yield the header columns of an uploaded sheet, then DataFrames of at most batch_size rows.
+    .xlsx files are streamed with openpyxl's read-only reader so only one batch is held in
+    memory; legacy .xls files (which openpyxl can't read) go through pd.read_excel.
+    """
+    if load_workbook is None or not file.filename.lower().endswith('.xlsx'):
+        df = pd.read_excel(file)
+        yield list(df.columns)
+        for i in range(0, len(df), batch_size):
+            yield df.iloc[i:i + batch_size]
+        return
+
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None) or ()
+        # Match pandas' naming for blank header cells
+        columns = [col if col is not None else f'Unnamed: {i}' for i, col in enumerate(header)]
+        width = len(columns)
+        yield columns
+
+        batch = []
+        first_index = 0
+        for values in rows:
+            # Read-only sheets can report trailing rows with no values at all
+            if all(value is None for value in values):
+                continue
+            batch.append((tuple(values) + (None,) * width)[:width])
+            if len(batch) == batch_size:
+                yield pd.DataFrame(batch, columns=columns, index=range(first_index, first_index + len(batch)))
+                first_index += len(batch)
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns=columns, index=range(first_index, first_index + len(batch)))
+    finally:
+        workbook.close()
+
+
 @products_bp.route('/ingredients/bulk-upload', methods=['POST'])
 @login_required
 def bulk_upload_products():
@@ -358,198 +564,195 @@ def bulk_upload_products():
         flash('Only .xlsx or .xls files are supported for bulk upload.')
         return redirect(url_for('products.ingredients_master'))
 
-    try:
-        import pandas as pd
-    except ImportError:
+    if pd is None:
         flash('Pandas is required for bulk upload. Please install it via pip install pandas openpyxl.')
         return redirect(url_for('products.ingredients_master'))
 
     try:
-        df = pd.read_excel(file)
+        frames = _iter_upload_sheet(file)
+        columns = next(frames)
     except Exception as exc:
         flash(f'Failed to read Excel file: {exc}')
         return redirect(url_for('products.ingredients_master'))
 
-    required_columns = ['DESCRIPTION', 'SUPPLIER', 'CATEGORY', 'COST/UNIT (AED)']
-    normalized_columns = {str(col).upper().strip(): col for col in df.columns}
+    normalized_columns = {str(col).upper().strip(): col for col in columns}
     # Log available columns for debugging
-    current_app.logger.info(f'Excel columns found: {list(df.columns)}')
-    current_app.logger.info(f'Normalized columns: {list(normalized_columns.keys())}')
-    missing = [col for col in required_columns if col not in normalized_columns]
+    current_app.logger.info('Excel columns found: %s', columns)
+    current_app.logger.info('Normalized columns: %s', list(normalized_columns))
+    missing = [col for col in REQUIRED_COLUMNS if col not in normalized_columns]
     if missing:
+        frames.close()
         flash(f'Missing required columns: {", ".join(missing)}')
         return redirect(url_for('products.ingredients_master'))
 
-    def clean_str(value, default=''):
-        if pd.isna(value) or value is None:
-            return default
-        return str(value).strip()
+    sub_cat_name = next((name for name in SUB_CATEGORY_COLUMNS
+                         if name in normalized_columns), None)
+    if not sub_cat_name:
+        current_app.logger.warning('SUB CATEGORY column not found in Excel. Available columns: %s', list(normalized_columns))
+
+    def parse_frame(df):
+        """Parse and clean every column of one batch in a single vectorized pass"""
+        def text_column(name, default=''):
+            """Stripped string values for a column ('' for blanks/NaN replaced by default)"""
+            col = normalized_columns.get(name)
+            if col is None:
+                return pd.Series(default, index=df.index, dtype=object)
+            values = df[col].where(df[col].notna(), '').astype(str).str.strip()
+            return values.where(values != '', default)
+
+        item_levels = text_column('ITEM LEVEL', 'Primary')
+        quantity_col = normalized_columns.get('QUANTITY')
+        if quantity_col is not None:
+            quantities = pd.to_numeric(df[quantity_col], errors='coerce')
+            quantities = quantities.astype(object).where(quantities.notna(), None)
+        else:
+            quantities = pd.Series(None, index=df.index, dtype=object)
+        return pd.DataFrame({
+            'description': text_column('DESCRIPTION'),
+            'supplier': text_column('SUPPLIER', 'N/A'),
+            'category': text_column('CATEGORY', 'Other'),
+            # '' means no sub_category in the sheet (AI may fill it in)
+            'sub_category': text_column(sub_cat_name) if sub_cat_name else pd.Series('', index=df.index, dtype=object),
+            'item_level': item_levels.where(item_levels.str.lower().isin(['primary', 'secondary']), 'Primary'),
+            'unit': text_column('UNIT', 'each'),
+            'cost_per_unit': pd.to_numeric(df[normalized_columns['COST/UNIT (AED)']], errors='coerce').fillna(0.0),
+            'unique_item_number': text_column('UNIQUE ITEM #'),
+            'barbuddy_code': text_column('CODE'),
+            'ml_in_bottle': quantities,
+        })
 
     created = 0
     skipped = 0
-    base_count = Product.query.filter(Product.user_id == current_user.id).count()
-    
-    # Track used codes in this batch to avoid duplicates within the same upload
-    used_unique_numbers = set()
-    used_barbuddy_codes = set()
+    # Per-row AI log lines are only built when INFO logging is actually on
+    log_ai = current_app.logger.isEnabledFor(logging.INFO)
     
     # Get existing codes for this user to avoid conflicts
-    existing_unique_numbers = {p.unique_item_number for p in Product.query.filter(Product.user_id == current_user.id).all() if p.unique_item_number}
-    existing_barbuddy_codes = {p.barbuddy_code for p in Product.query.filter(Product.user_id == current_user.id).all() if p.barbuddy_code}
+    # (one query, only the two code columns)
+    existing_codes = db.session.query(Product.unique_item_number, Product.barbuddy_code).filter(
+        Product.user_id == current_user.id
+    ).all()
+    existing_unique_numbers = {row.unique_item_number for row in existing_codes if row.unique_item_number}
+    existing_barbuddy_codes = {row.barbuddy_code for row in existing_codes if row.barbuddy_code}
+
+    def highest_number(codes, prefix):
+        """Highest N among PREFIX-N style codes (0 if there are none)"""
+        numbers = pd.to_numeric(pd.Series(list(codes), dtype=object).astype(str).str.extract(rf'^{re.escape(prefix)}(\d+)$')[0], errors='coerce')
+        return int(numbers.max()) if numbers.notna().any() else 0
+
+    # Highest generated number so far per prefix - carried across batches so existing codes are scanned once
+    highest = {'ITEM-': highest_number(existing_unique_numbers, 'ITEM-'), 'BB': highest_number(existing_barbuddy_codes, 'BB')}
+
+    def assign_codes(codes, existing, prefix, width):
+        """
+        Keep supplied codes that are new and unique within the sheet; number the rest
+        sequentially after the highest PREFIX### code seen so far (no per-row collision checks).
+        """
+        keep = (codes != '') & ~codes.isin(existing) & ~codes.duplicated()
+        start = max(highest[prefix], highest_number(codes[keep], prefix)) + 1
+        missing = codes.index[~keep]
+        generated = pd.Series([f'{prefix}{n:0{width}d}' for n in range(start, start + len(missing))], index=missing, dtype=object)
+        highest[prefix] = start - 1 + len(missing)
+        assigned = codes.astype(object).where(keep, generated)
+        existing.update(assigned)
+        return assigned
 
-    for idx, row in df.iterrows():
-        try:
-            description = clean_str(row[normalized_columns['DESCRIPTION']])
-            if not description:
-                skipped += 1
-                continue
+    try:
+        for df in frames:
+            parsed = parse_frame(df)
+            # Rows without a description are skipped
+            has_description = parsed['description'] != ''
+            skipped += int((~has_description).sum())
+            parsed = parsed[has_description]
+
+            # Generate unique codes if not provided or if duplicates found - for the whole batch at once
+            parsed['unique_item_number'] = assign_codes(parsed['unique_item_number'], existing_unique_numbers, 'ITEM-', 6)
+            parsed['barbuddy_code'] = assign_codes(parsed['barbuddy_code'], existing_barbuddy_codes, 'BB', 3)
 
-            supplier = clean_str(row[normalized_columns['SUPPLIER']], 'N/A') or 'N/A'
-            category = clean_str(row[normalized_columns['CATEGORY']])
-            if not category:
-                category = 'Other'
-
-            # Try multiple possible column name variations
-            sub_cat_col = (normalized_columns.get('SUB CATEGORY') or 
-                          normalized_columns.get('SUB-CATEGORY') or
-                          normalized_columns.get('SUB_CATEGORY') or
-                          normalized_columns.get('SUBCATEGORY'))
-            sub_category = 'Other'  # Default value
-            sub_category_from_excel = False  # Track if we got a value from Excel
-            
-            # Preserve the exact sub_category from Excel sheet if it exists and is not empty
-            if sub_cat_col:
-                try:
-                    sub_category_value = row[sub_cat_col]
-                    # Check if value is NaN or empty using pandas
-                    if not pd.isna(sub_category_value) and sub_category_value is not None:
-                        sub_category_str = str(sub_category_value).strip()
-                        if sub_category_str:  # Not empty after strip
-                            sub_category = sub_category_str
-                            sub_category_from_excel = True
-                            current_app.logger.info(f'Preserved sub_category from Excel: "{sub_category}" for "{description}" (column: {sub_cat_col})')
-                except (KeyError, IndexError, Exception) as e:
-                    current_app.logger.warning(f'Error reading sub_category column "{sub_cat_col}" for "{description}": {str(e)}')
-                    # Keep default 'Other', sub_category_from_excel remains False
-            else:
-                current_app.logger.warning(f'SUB CATEGORY column not found in Excel for "{description}". Available columns: {list(normalized_columns.keys())}')
-            
             # Use AI to categorize ONLY if category or sub_category is truly missing/empty
-            # IMPORTANT: Never use AI if sub_category was explicitly set from Excel (even if it's "Other")
-            category_missing = not category or category.strip() == '' or category.strip() == 'Other'
-            # Only use AI for sub_category if we didn't get a value from Excel
-            sub_category_missing = not sub_category_from_excel
-            
-            # Only use AI if category is missing OR sub_category was not found in Excel
-            if category_missing or sub_category_missing:
-                try:
-                    ai_category, ai_sub_category = categorize_product_ai(description, supplier)
-                    if ai_category and category_missing:
-                        category = ai_category
-                        current_app.logger.info(f'AI categorized "{description}" as category: {category}')
-                    # Only overwrite sub_category if it was NOT found in Excel
-                    if ai_sub_category and sub_category_missing:
-                        sub_category = ai_sub_category
-                        current_app.logger.info(f'AI categorized "{description}" as sub_category: {sub_category}')
-                except Exception as e:
-                    current_app.logger.warning(f'AI categorization failed for "{description}": {str(e)}')
-                    # Continue with original values if AI fails
-
-            item_level_col = normalized_columns.get('ITEM LEVEL')
-            item_level = clean_str(row.get(item_level_col), 'Primary') if item_level_col else 'Primary'
-            if item_level.lower() not in ('primary', 'secondary'):
-                item_level = 'Primary'
-
-            unit_col = normalized_columns.get('UNIT')
-            unit = clean_str(row.get(unit_col), 'each') if unit_col else 'each'
-
-            cost_per_unit = row[normalized_columns['COST/UNIT (AED)']]
+            # Never use AI for sub_category if it was explicitly set in Excel (even if it's "Other")
+            needs_ai = (parsed['category'] == 'Other') | (parsed['sub_category'] == '')
+            # Every row that needs AI is sent together - batched requests instead of one round trip per row
             try:
-                cost_per_unit = float(cost_per_unit or 0)
-            except (TypeError, ValueError):
-                cost_per_unit = 0.0
-
-            unique_col = normalized_columns.get('UNIQUE ITEM #')
-            unique_item_number = clean_str(row.get(unique_col)) if unique_col else ''
-            # Check if it exists in database OR in this batch
-            if unique_item_number:
-                if unique_item_number in existing_unique_numbers or unique_item_number in used_unique_numbers:
-                    unique_item_number = ''  # Will generate new one
-                else:
-                    used_unique_numbers.add(unique_item_number)
-
-            code_col = normalized_columns.get('CODE')
-            barbuddy_code = clean_str(row.get(code_col)) if code_col else ''
-            # Check if it exists in database OR in this batch
-            if barbuddy_code:
-                if barbuddy_code in existing_barbuddy_codes or barbuddy_code in used_barbuddy_codes:
-                    barbuddy_code = ''  # Will generate new one
-                else:
-                    used_barbuddy_codes.add(barbuddy_code)
-
-            quantity_col = normalized_columns.get('QUANTITY')
-            quantity_value = row.get(quantity_col)
-            try:
-                ml_in_bottle = float(quantity_value) if quantity_value is not None and not pd.isna(quantity_value) else None
-            except (TypeError, ValueError):
-                ml_in_bottle = None
-
-            # Generate unique codes if not provided or if duplicates found
-            if not unique_item_number:
-                counter = 1
-                while True:
-                    candidate = f"ITEM-{base_count + created + counter:06d}"
-                    if candidate not in existing_unique_numbers and candidate not in used_unique_numbers:
-                        unique_item_number = candidate
-                        used_unique_numbers.add(candidate)
-                        break
-                    counter += 1
-                    if counter > 10000:  # Safety limit
-                        unique_item_number = f"ITEM-{int(time.time())}{created:04d}"
-                        break
-            
-            if not barbuddy_code:
-                counter = 1
-                while True:
-                    candidate = f"BB{base_count + created + counter:03d}"
-                    if candidate not in existing_barbuddy_codes and candidate not in used_barbuddy_codes:
-                        barbuddy_code = candidate
-                        used_barbuddy_codes.add(candidate)
-                        break
-                    counter += 1
-                    if counter > 10000:  # Safety limit
-                        barbuddy_code = f"BB{int(time.time())}{created:04d}"
-                        break
-
-            product = Product(
-                user_id=current_user.id,
-                description=description,
-                supplier=supplier,
-                category=category,
-                sub_category=sub_category,
-                selling_unit=unit,
-                cost_per_unit=cost_per_unit,
-                unique_item_number=unique_item_number,
-                barbuddy_code=barbuddy_code,
-                item_level=item_level,
-                ml_in_bottle=ml_in_bottle,
-                image_path=None
-            )
-            db.session.add(product)
-            created += 1
-        except Exception as exc:
-            skipped += 1
-            current_app.logger.error('Failed to import row %s: %s', idx, exc, exc_info=True)
-            db.session.rollback()  # Rollback this failed row
-            continue
+                ai_results = dict(zip(parsed.index[needs_ai], categorize_products_ai(
+                    list(zip(parsed.loc[needs_ai, 'description'], parsed.loc[needs_ai, 'supplier']))
+                )))
+            except Exception as e:
+                current_app.logger.warning('AI categorization failed for this batch: %s', e)
+                ai_results = {}
 
-    try:
-        db.session.commit()
+            pending = []  # Validated rows of this batch, inserted together after the loop
+            for idx, row in zip(parsed.index, parsed.to_dict(orient='records')):
+                try:
+                    description = row['description']
+                    supplier = row['supplier']
+                    category = row['category']
+                    sub_category = row['sub_category'] or 'Other'
+                    sub_category_from_excel = bool(row['sub_category'])
+                    category_missing = category == 'Other'
+                    sub_category_missing = not sub_category_from_excel
+                    
+                    # AI results only exist for rows with a missing category or sub_category
+                    if idx in ai_results:
+                        ai_category, ai_sub_category = ai_results[idx]
+                        if ai_category and category_missing:
+                            category = ai_category
+                            if log_ai:
+                                current_app.logger.info('AI categorized "%s" as category: %s', description, category)
+                        # Only overwrite sub_category if it was NOT found in Excel
+                        if ai_sub_category and sub_category_missing:
+                            sub_category = ai_sub_category
+                            if log_ai:
+                                current_app.logger.info('AI categorized "%s" as sub_category: %s', description, sub_category)
+
+                    pending.append(dict(
+                        user_id=current_user.id,
+                        description=description,
+                        supplier=supplier,
+                        category=category,
+                        sub_category=sub_category,
+                        selling_unit=row['unit'],
+                        cost_per_unit=row['cost_per_unit'],
+                        unique_item_number=row['unique_item_number'],
+                        barbuddy_code=row['barbuddy_code'],
+                        item_level=row['item_level'],
+                        ml_in_bottle=row['ml_in_bottle'],
+                        image_path=None
+                    ))
+                except Exception as exc:
+                    # Only this row is skipped - nothing has touched the session yet
+                    skipped += 1
+                    current_app.logger.error('Failed to import row %s: %s', idx, exc, exc_info=True)
+                    continue
+
+            # Insert each batch in one statement and commit it, so memory stays bounded by the batch size
+            if pending:
+                try:
+                    db.session.bulk_insert_mappings(Product, pending)
+                    db.session.commit()
+                    created += len(pending)
+                except IntegrityError:
+                    # A code was taken after the existing codes were loaded (e.g. a concurrent upload) -
+                    # retry this batch row by row and skip only the conflicting rows
+                    db.session.rollback()
+                    for mapping in pending:
+                        try:
+                            with db.session.begin_nested():
+                                db.session.bulk_insert_mappings(Product, [mapping])
+                            created += 1
+                        except IntegrityError:
+                            skipped += 1
+                            current_app.logger.warning('Skipped duplicate product "%s" (%s, %s)', mapping['description'], mapping['unique_item_number'], mapping['barbuddy_code'])
+                    db.session.commit()
         flash(f'Imported {created} products successfully. Skipped {skipped} rows.')
     except Exception as exc:
         db.session.rollback()
-        current_app.logger.error(f'Failed to save imported products: {str(exc)}', exc_info=True)
-        flash(f'Failed to save imported products: {exc}')
+        current_app.logger.error('Failed to save imported products: %s', exc, exc_info=True)
+        flash(f'Failed to save imported products after importing {created}: {exc}')
+    finally:
+        frames.close()
+        if created:
+            invalidate_user_categories(current_user.id)
+            invalidate_ingredient_options(current_user.id)
 
     return redirect(url_for('products.ingredients_master'))
 
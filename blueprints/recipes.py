@@ -2,31 +2,133 @@
 Recipes Blueprint
 Handles all recipe routes
 """
-from flask import Blueprint, render_template, redirect, url_for, request, flash, current_app
+from flask import Blueprint, render_template, stream_template, redirect, url_for, request, flash, current_app, get_flashed_messages
 from flask_login import login_required, current_user
 from extensions import db
 from models import Product, HomemadeIngredient, Recipe, RecipeIngredient
-from utils.db_helpers import ensure_schema_updates
+from sqlalchemy import and_, or_, func, cast, Integer
+from sqlalchemy.orm import selectinload, load_only, raiseload
+from utils.db_helpers import ensure_schema_updates, has_column, prefetch_ingredient_products
 from utils.file_upload import save_uploaded_file
-from utils.constants import resolve_recipe_category, category_context_from_type, CATEGORY_CONFIG
+from utils.ingredient_options import build_ingredient_options
+from utils.constants import (
+    resolve_recipe_category, category_context_from_type, CATEGORY_CONFIG,
+    DERIVED_CATEGORY_LABELS, TYPE_TO_DERIVED_CATEGORY, VIEW_CATEGORY_SLUGS, DEFAULT_CATEGORY_CONTEXT
+)
+from datetime import datetime
+import logging
+import traceback
 
 recipes_bp = Blueprint('recipes', __name__)
 
+# Columns recipes/list.html and the cost helpers read - method, garnish, image_path etc. stay unloaded
+RECIPE_LIST_OPTIONS = (
+    load_only(
+        Recipe.id, Recipe.user_id, Recipe.recipe_code, Recipe.title, Recipe.recipe_type, Recipe.type,
+        Recipe.food_category, Recipe.selling_price, Recipe.vat_percentage,
+        Recipe.service_charge_percentage, Recipe.government_fees_percentage
+    ),
+    selectinload(Recipe.ingredients).load_only(
+        RecipeIngredient.recipe_id, RecipeIngredient.ingredient_type, RecipeIngredient.ingredient_id,
+        RecipeIngredient.product_type, RecipeIngredient.product_id, RecipeIngredient.quantity,
+        RecipeIngredient.quantity_ml, RecipeIngredient.unit
+    ),
+)
+
+
+def _owned_ingredient_lookup(ingredient_ids, ingredient_types, known_types):
+    """
+    Bulk-load what the ingredient loop needs about the current user's items:
+    {product id: ml_in_bottle} for product and untyped rows, and the homemade ids
+    among untyped rows. One query per table instead of SELECTs per ingredient row.
+    """
+    product_candidates = set()
+    untyped = set()
+    for idx, ing_id in enumerate(ingredient_ids):
+        ing_type = (ingredient_types[idx] if idx < len(ingredient_types) else '') or ''
+        if ing_type in known_types and ing_type != 'Product':
+            continue
+        try:
+            ing_id_int = int(ing_id)
+        except (ValueError, TypeError):
+            continue
+        product_candidates.add(ing_id_int)
+        if ing_type not in known_types:
+            untyped.add(ing_id_int)
+    product_ml = {}
+    if product_candidates:
+        product_ml = dict(db.session.query(Product.id, Product.ml_in_bottle).filter(
+            Product.id.in_(product_candidates), Product.user_id == current_user.id
+        ).all())
+    homemade_ids = set()
+    if untyped:
+        homemade_ids = {row.id for row in db.session.query(HomemadeIngredient.id).filter(
+            HomemadeIngredient.id.in_(untyped), HomemadeIngredient.user_id == current_user.id
+        )}
+    return product_ml, homemade_ids
+
+
+def _distinct_recipe_categories(user_id, recipe_type_filter=''):
+    """
+    Sorted category names for a user's recipes (food_category, else derived from the type -
+    same logic as the template), from the DISTINCT category/type combinations only.
+    """
+    query = db.session.query(Recipe.food_category, Recipe.type, Recipe.recipe_type).filter(Recipe.user_id == user_id)
+    if recipe_type_filter:
+        query = query.filter(Recipe.recipe_type == recipe_type_filter)
+    categories = set()
+    for food_category, recipe_type_label, recipe_type in query.distinct():
+        if food_category:
+            categories.add(food_category)
+        else:
+            derived_cat = TYPE_TO_DERIVED_CATEGORY.get((recipe_type_label or recipe_type or '').lower())
+            if derived_cat:
+                categories.add(derived_cat)
+    return sorted(categories)
+
+
+def _stream_recipe_list(**context):
+    """
+    Stream recipes/list.html so rows go out as they are rendered.
+    Flashed messages are popped first: the session cookie is written before the
+    body streams, so popping them mid-stream would leave them in the session.
+    """
+    get_flashed_messages()
+    return stream_template('recipes/list.html', **context)
+
 
 @recipes_bp.route('/recipes', methods=['GET'])
 @login_required
 def recipes_list():
     ensure_schema_updates()
     try:
-        from sqlalchemy.orm import joinedload
+        recipe_type_filter = request.args.get('type', '')
+        category_filter = request.args.get('category', '') or ''
+        
         # Eagerly load ingredients to avoid N+1 queries and ensure cost calculation works
-        from sqlalchemy import and_
-        from utils.db_helpers import has_column
         try:
             if has_column('recipe', 'user_id'):
-                recipes = Recipe.query.filter(Recipe.user_id == current_user.id).options(
-                    joinedload(Recipe.ingredients)
-                ).all()
+                query = Recipe.query.filter(Recipe.user_id == current_user.id).options(*RECIPE_LIST_OPTIONS)
+                if recipe_type_filter:
+                    query = query.filter(Recipe.recipe_type == recipe_type_filter)
+                if category_filter:
+                    # Filter by actual category value (food_category or derived category) in SQL
+                    filter_cat = category_filter.replace('-', ' ').strip().lower()
+                    has_food_category = and_(Recipe.food_category.isnot(None), Recipe.food_category != '')
+                    category_clause = and_(has_food_category, func.lower(func.trim(Recipe.food_category)) == filter_cat)
+                    # Recipes without food_category get the same derived category as the template
+                    derived_labels = DERIVED_CATEGORY_LABELS.get(filter_cat)
+                    if derived_labels:
+                        has_type = and_(Recipe.type.isnot(None), Recipe.type != '')
+                        category_clause = or_(category_clause, and_(
+                            ~has_food_category,
+                            or_(
+                                and_(has_type, func.lower(Recipe.type).in_(derived_labels)),
+                                and_(~has_type, func.lower(Recipe.recipe_type).in_(derived_labels))
+                            )
+                        ))
+                    query = query.filter(category_clause)
+                recipes = query.all()
             else:
                 current_app.logger.info('user_id column does not exist yet in recipe table')
                 recipes = []
@@ -34,74 +136,20 @@ def recipes_list():
             current_app.logger.error(f'Error loading recipes: {str(e)}', exc_info=True)
             recipes = []
         
-        recipe_type_filter = request.args.get('type', '')
-        category_filter = request.args.get('category', '') or ''
-        
-        if recipe_type_filter:
-            recipes = [r for r in recipes if r.recipe_type == recipe_type_filter]
-        if category_filter:
-            # Filter by actual category value (food_category or derived category)
-            def matches_category(recipe):
-                # First check food_category (most specific)
-                if recipe.food_category:
-                    # Normalize for comparison (handle spaces, case)
-                    recipe_cat = recipe.food_category.strip()
-                    filter_cat = category_filter.replace('-', ' ').strip()
-                    if recipe_cat.lower() == filter_cat.lower():
-                        return True
-                else:
-                    # Use the same logic as template to derive category
-                    cat_key = (recipe.type or recipe.recipe_type or '').lower()
-                    derived_cat = None
-                    if cat_key in ['cocktails','classic']:
-                        derived_cat = 'Cocktail'
-                    elif cat_key in ['mocktails','signature']:
-                        derived_cat = 'Mocktail'
-                    elif cat_key in ['beverages','beverage']:
-                        derived_cat = 'Beverage'
-                    elif cat_key in ['food']:
-                        derived_cat = 'Food'
-                    
-                    if derived_cat:
-                        filter_cat = category_filter.replace('-', ' ').strip()
-                        if derived_cat.lower() == filter_cat.lower():
-                            return True
-                return False
-            recipes = [r for r in recipes if matches_category(r)]
-        
-        # Ensure ingredients are loaded for cost calculation
-        for recipe in recipes:
-            try:
-                _ = recipe.ingredients
-                for ingredient in recipe.ingredients:
-                    try:
-                        _ = ingredient.get_product()
-                    except Exception as ing_e:
-                        current_app.logger.warning(f"Error loading product for ingredient {ingredient.id}: {str(ing_e)}")
-            except Exception as recipe_e:
-                current_app.logger.warning(f"Error loading ingredients for recipe {recipe.id}: {str(recipe_e)}")
-        
-        # Collect unique category values from recipes (same logic as in template)
-        unique_categories = set()
-        for recipe in recipes:
-            if recipe.food_category:
-                unique_categories.add(recipe.food_category)
-            else:
-                # Use the same logic as the template to derive category
-                cat_key = (recipe.type or recipe.recipe_type or '').lower()
-                if cat_key in ['cocktails','classic']:
-                    unique_categories.add('Cocktail')
-                elif cat_key in ['mocktails','signature']:
-                    unique_categories.add('Mocktail')
-                elif cat_key in ['beverages','beverage']:
-                    unique_categories.add('Beverage')
-                elif cat_key in ['food']:
-                    unique_categories.add('Food')
+        # Load every ingredient's product for cost calculation in a few batched queries
+        try:
+            prefetch_ingredient_products(recipes)
+        except Exception as e:
+            current_app.logger.warning(f"Error prefetching ingredient products: {str(e)}")
         
-        # Sort categories for consistent display
-        unique_categories = sorted(unique_categories)
+        # Category choices cover every recipe of the selected type, not just the filtered ones
+        try:
+            unique_categories = _distinct_recipe_categories(current_user.id, recipe_type_filter)
+        except Exception as e:
+            current_app.logger.warning(f"Error loading recipe categories: {str(e)}")
+            unique_categories = []
         
-        return render_template('recipes/list.html', recipes=recipes, selected_type=recipe_type_filter, selected_category=category_filter, unique_categories=unique_categories)
+        return _stream_recipe_list(recipes=recipes, selected_type=recipe_type_filter, selected_category=category_filter, unique_categories=unique_categories)
     except Exception as e:
         current_app.logger.error(f"Error in recipes_list: {str(e)}", exc_info=True)
         flash('An error occurred while loading recipes.', 'error')
@@ -112,25 +160,16 @@ def recipes_list():
 @login_required
 def recipe_list(category):
     try:
-        # Check if this is actually a recipe code (starts with 'REC-')
-        # If so, redirect to the recipe code handler
-        if category.startswith('REC-'):
-            return view_recipe_by_code(category)
-        
+        # Recipe codes (REC-...) are routed to view_recipe_by_code by the reccode converter
         canonical, config = resolve_recipe_category(category)
         if not canonical:
             # If category is invalid, redirect to recipes list instead of showing error
             flash(f"Category '{category}' not found. Showing all recipes.")
             return redirect(url_for('recipes.recipes_list'))
 
-        from sqlalchemy.orm import joinedload
-        from sqlalchemy import or_, and_
         # Prioritize type field over recipe_type since recipe_type is generic ('Beverage')
         # and type field has specific values ('Beverages', 'Mocktails', 'Cocktails')
-        from sqlalchemy import and_, or_
-        recipes = Recipe.query.filter(Recipe.user_id == current_user.id).options(
-            joinedload(Recipe.ingredients)
-        ).filter(
+        recipes = Recipe.query.filter(Recipe.user_id == current_user.id).options(*RECIPE_LIST_OPTIONS).filter(
             or_(
                 Recipe.type.in_(config['db_labels']),
                 and_(
@@ -140,20 +179,13 @@ def recipe_list(category):
             )
         ).all()
         
-        # Ensure ingredients are loaded for cost calculation
-        for recipe in recipes:
-            try:
-                _ = recipe.ingredients
-                for ingredient in recipe.ingredients:
-                    try:
-                        _ = ingredient.get_product()
-                    except Exception as ing_e:
-                        current_app.logger.warning(f"Error loading product for ingredient {ingredient.id}: {str(ing_e)}")
-            except Exception as recipe_e:
-                current_app.logger.warning(f"Error loading ingredients for recipe {recipe.id}: {str(recipe_e)}")
+        # Load every ingredient's product for cost calculation in a few batched queries
+        try:
+            prefetch_ingredient_products(recipes)
+        except Exception as e:
+            current_app.logger.warning(f"Error prefetching ingredient products: {str(e)}")
         
-        return render_template(
-            'recipes/list.html',
+        return _stream_recipe_list(
             recipes=recipes,
             selected_type='',
             selected_category=canonical
@@ -164,70 +196,37 @@ def recipe_list(category):
         return redirect(url_for('recipes.recipes_list'))
 
 
-@recipes_bp.route('/recipes/<code>')
+@recipes_bp.route('/recipes/<reccode:code>')
 @login_required
 def view_recipe_by_code(code):
     try:
-        # First check if it looks like a recipe code (starts with REC-)
-        # This should take priority over category matching
-        if code.startswith('REC-'):
-            from sqlalchemy.orm import joinedload
-            # First check if this is a valid recipe code
-            recipe = Recipe.query.filter(Recipe.user_id == current_user.id, Recipe.recipe_code == code).first()
-            if recipe:
-                # Reload with eager loading
-                recipe = Recipe.query.filter(Recipe.user_id == current_user.id).options(
-                    joinedload(Recipe.ingredients)
-                ).filter(Recipe.recipe_code == code).first()
-                
-                if not recipe:
-                    # Recipe code exists but query failed
-                    flash("Recipe not found")
-                    return redirect(url_for('recipes.recipes_list'))
-                
-                # Ensure ingredients are loaded
-                _ = recipe.ingredients
-                for ingredient in recipe.ingredients:
-                    try:
-                        _ = ingredient.get_product()
-                    except Exception as e:
-                        current_app.logger.warning(f"Error loading product for ingredient {ingredient.id}: {str(e)}")
-                        continue
-                
-                try:
-                    batch = recipe.batch_summary()
-                except Exception as e:
-                    current_app.logger.warning(f"Error in batch_summary for recipe {recipe.id}: {str(e)}")
-                    batch = {}
-                
-                category_slug, category_display = category_context_from_type(recipe.type or recipe.recipe_type or '')
-                # Ensure category_slug is always valid
-                if not category_slug or category_slug not in ['cocktails', 'mocktails', 'beverages']:
-                    category_slug = 'cocktails'
-                    category_display = 'Cocktails'
-                # Double-check that category_slug is valid before rendering
-                canonical_check, _ = resolve_recipe_category(category_slug)
-                if not canonical_check:
-                    category_slug = 'cocktails'
-                    category_display = 'Cocktails'
-                return render_template('recipes/view.html', recipe=recipe, batch=batch, category_slug=category_slug, category_display=category_display)
-            else:
-                # Recipe code not found
-                flash("Recipe not found")
-                return redirect(url_for('recipes.recipes_list'))
+        # Look the code up with its ingredients eager-loaded in the same query
+        recipe = Recipe.query.filter(Recipe.user_id == current_user.id, Recipe.recipe_code == code).options(
+            selectinload(Recipe.ingredients)
+        ).first()
+        if not recipe:
+            flash("Recipe not found")
+            return redirect(url_for('recipes.recipes_list'))
         
-        # If not a recipe code, check if it's a category name
-        canonical, config = resolve_recipe_category(code)
-        if canonical:
-            # This is a category, not a recipe code - call the category handler directly
-            return recipe_list(canonical)
+        # Load the ingredients' products in a few batched queries
+        try:
+            prefetch_ingredient_products([recipe])
+        except Exception as e:
+            current_app.logger.warning(f"Error prefetching ingredient products for recipe {recipe.id}: {str(e)}")
         
-        # Not a recipe code and not a category
-        flash("Recipe or category not found")
-        return redirect(url_for('recipes.recipes_list'))
+        try:
+            batch = recipe.batch_summary()
+        except Exception as e:
+            current_app.logger.warning(f"Error in batch_summary for recipe {recipe.id}: {str(e)}")
+            batch = {}
+        
+        category_slug, category_display = category_context_from_type(recipe.type or recipe.recipe_type or '')
+        # Ensure category_slug is always valid
+        if category_slug not in VIEW_CATEGORY_SLUGS:
+            category_slug, category_display = DEFAULT_CATEGORY_CONTEXT
+        return render_template('recipes/view.html', recipe=recipe, batch=batch, category_slug=category_slug, category_display=category_display)
     except Exception as e:
         current_app.logger.error(f"Error in view_recipe_by_code: {str(e)}", exc_info=True)
-        import traceback
         current_app.logger.error(traceback.format_exc())
         flash(f'An error occurred while loading the recipe: {str(e)}', 'error')
         return redirect(url_for('recipes.recipes_list'))
@@ -242,106 +241,6 @@ def add_recipe(category):
             flash("Invalid recipe category")
             return redirect(url_for('main.index'))
 
-        # Filter products and secondary ingredients by current user
-        from utils.db_helpers import has_column
-        try:
-            if has_column('product', 'user_id'):
-                products = Product.query.filter(Product.user_id == current_user.id).order_by(Product.description).all()
-            else:
-                products = Product.query.order_by(Product.description).all()
-        except Exception:
-            products = Product.query.order_by(Product.description).all()
-        
-        try:
-            if has_column('homemade_ingredient', 'user_id'):
-                secondary_ingredients = HomemadeIngredient.query.filter(HomemadeIngredient.user_id == current_user.id).order_by(HomemadeIngredient.name).all()
-            else:
-                secondary_ingredients = HomemadeIngredient.query.order_by(HomemadeIngredient.name).all()
-        except Exception:
-            secondary_ingredients = HomemadeIngredient.query.order_by(HomemadeIngredient.name).all()
-        
-        # Build ingredient options list, ensuring no duplicates
-        ingredient_options = []
-        seen_products = set()  # Track products by (description, code) to avoid duplicates
-        
-        for p in products:
-            description = p.description or ''
-            code = p.barbuddy_code or ''
-            # Use a unique key to detect duplicates
-            product_key = (description.lower().strip(), code.lower().strip())
-            
-            # Skip if we've already added this product
-            if product_key in seen_products:
-                current_app.logger.warning(f'Skipping duplicate product: {description} ({code})')
-                continue
-            
-            seen_products.add(product_key)
-            label = f"{description} ({code})" if code else description
-            ingredient_options.append({
-                'label': label,
-                'description': description,
-                'code': code,
-                'id': p.id,
-                'type': 'Product',
-                'unit': p.selling_unit or 'ml',
-                'cost_per_unit': p.cost_per_unit or 0.0,
-                'container_volume': p.ml_in_bottle or (1 if (p.selling_unit or '').lower() == 'ml' else 0)
-            })
-        
-        # Add secondary ingredients, also checking for duplicates
-        seen_secondary = set()
-        for sec in secondary_ingredients:
-            if not sec.unique_code:
-                continue
-            
-            # Use a unique key to detect duplicates
-            secondary_key = (sec.name.lower().strip() if sec.name else '', sec.unique_code.lower().strip())
-            
-            # Skip if we've already added this secondary ingredient
-            if secondary_key in seen_secondary:
-                current_app.logger.warning(f'Skipping duplicate secondary ingredient: {sec.name} ({sec.unique_code})')
-                continue
-            
-            seen_secondary.add(secondary_key)
-            try:
-                # Ensure ingredients are loaded for cost calculation
-                _ = sec.ingredients
-                for item in sec.ingredients:
-                    try:
-                        _ = item.product
-                    except Exception:
-                        pass
-                
-                total_cost = sec.calculate_cost()
-                cost_per_unit = sec.calculate_cost_per_unit()
-                
-                if cost_per_unit is None or cost_per_unit <= 0:
-                    current_app.logger.warning(
-                        f'Secondary ingredient {sec.id} ({sec.unique_code}) has zero or invalid cost_per_unit: {cost_per_unit}. '
-                        f'Total cost: {total_cost}, Total volume: {sec.total_volume_ml}, '
-                        f'Has ingredients: {len(sec.ingredients) if sec.ingredients else 0}'
-                    )
-                    cost_per_unit = 0.0
-                else:
-                    current_app.logger.debug(
-                        f'Secondary ingredient {sec.id} ({sec.unique_code}): cost_per_unit={cost_per_unit}, '
-                        f'total_cost={total_cost}, total_volume_ml={sec.total_volume_ml}'
-                    )
-            except Exception as e:
-                current_app.logger.error(f'Error calculating cost_per_unit for secondary ingredient {sec.id} ({sec.unique_code}): {str(e)}', exc_info=True)
-                cost_per_unit = 0.0
-            
-            ingredient_options.append({
-                'label': f"{sec.name} ({sec.unique_code})",
-                'description': sec.name,
-                'code': sec.unique_code or '',
-                'id': sec.id,
-                'type': 'Secondary',
-                'unit': sec.unit or 'ml',
-                'cost_per_unit': cost_per_unit,
-                'container_volume': sec.total_volume_ml or 1
-            })
-
         if request.method == 'POST':
             try:
                 title = request.form.get('title', '').strip()
@@ -361,17 +260,32 @@ def add_recipe(category):
                 # Generate unique recipe code (per user)
                 max_attempts = 100
                 recipe_code = None
-                user_recipe_count = Recipe.query.filter(Recipe.user_id == current_user.id).count()
-                for attempt in range(max_attempts):
-                    candidate_code = f"REC-{user_recipe_count + attempt + 1:04d}"
-                    existing = Recipe.query.filter(Recipe.user_id == current_user.id, Recipe.recipe_code == candidate_code).first()
-                    if not existing:
+                # Continue from the highest sequential code - a MAX over the user's codes instead of
+                # counting every recipe. Only REC-0001 style codes count: the 14-digit timestamp
+                # fallback (REC-20240101120000) would jump the sequence and overflow the Integer cast
+                try:
+                    last_number = db.session.query(
+                        func.max(cast(func.substr(Recipe.recipe_code, 5), Integer))
+                    ).filter(
+                        Recipe.user_id == current_user.id,
+                        Recipe.recipe_code.regexp_match('^REC-[0-9]{1,9}$')
+                    ).scalar() or 0
+                except Exception as e:
+                    db.session.rollback()
+                    current_app.logger.warning(f"Could not read highest recipe code, counting recipes instead: {str(e)}")
+                    last_number = Recipe.query.filter(Recipe.user_id == current_user.id).count()
+                candidates = [f"REC-{last_number + attempt + 1:04d}" for attempt in range(max_attempts)]
+                # Check every candidate in one query instead of one SELECT per attempt
+                existing_codes = {code for (code,) in db.session.query(Recipe.recipe_code).filter(
+                    Recipe.user_id == current_user.id, Recipe.recipe_code.in_(candidates)
+                )}
+                for candidate_code in candidates:
+                    if candidate_code not in existing_codes:
                         recipe_code = candidate_code
                         break
                 
                 if not recipe_code:
                     # Fallback to timestamp-based code
-                    from datetime import datetime
                     recipe_code = f"REC-{datetime.now().strftime('%Y%m%d%H%M%S')}"
 
                 image_path = None
@@ -430,15 +344,24 @@ def add_recipe(category):
                 ingredient_qtys = request.form.getlist('ingredient_qty')
                 ingredient_units = request.form.getlist('ingredient_unit')
                 
-                current_app.logger.debug(f"Received {len(ingredient_ids)} ingredient IDs")
-                current_app.logger.debug(f"Ingredient IDs: {ingredient_ids}")
-                current_app.logger.debug(f"Ingredient types: {ingredient_types}")
-                current_app.logger.debug(f"Ingredient qtys: {ingredient_qtys}")
+                # Checked once so the per-ingredient debug lines cost nothing when DEBUG is off
+                log_debug = current_app.logger.isEnabledFor(logging.DEBUG)
+                if log_debug:
+                    current_app.logger.debug("Received %d ingredient IDs", len(ingredient_ids))
+                    current_app.logger.debug("Ingredient IDs: %s", ingredient_ids)
+                    current_app.logger.debug("Ingredient types: %s", ingredient_types)
+                    current_app.logger.debug("Ingredient qtys: %s", ingredient_qtys)
                 
-                items_added = 0
+                # Product sizes and types of untyped rows in two bulk lookups
+                owned_product_ml, owned_homemade_ids = _owned_ingredient_lookup(
+                    ingredient_ids, ingredient_types, ('Product', 'Secondary')
+                )
+                
+                pending_items = []
                 for idx, ing_id in enumerate(ingredient_ids):
                     if not ing_id or not str(ing_id).strip():
-                        current_app.logger.debug(f"Skipping empty ingredient ID at index {idx}")
+                        if log_debug:
+                            current_app.logger.debug("Skipping empty ingredient ID at index %d", idx)
                         continue
                     
                     try:
@@ -447,7 +370,8 @@ def add_recipe(category):
                         unit = ingredient_units[idx] if idx < len(ingredient_units) else 'ml'
                         
                         if not qty_str or not str(qty_str).strip():
-                            current_app.logger.debug(f"Skipping ingredient {idx} - no quantity")
+                            if log_debug:
+                                current_app.logger.debug("Skipping ingredient %d - no quantity", idx)
                             continue
                         
                         try:
@@ -457,7 +381,8 @@ def add_recipe(category):
                             continue
                         
                         if qty <= 0:
-                            current_app.logger.debug(f"Skipping ingredient {idx} - quantity {qty} <= 0")
+                            if log_debug:
+                                current_app.logger.debug("Skipping ingredient %d - quantity %s <= 0", idx, qty)
                             continue
                         
                         try:
@@ -480,11 +405,11 @@ def add_recipe(category):
                             db_product_id = ing_id_int
                         else:
                             # Try to determine from ID
-                            if Product.query.filter(Product.id == ing_id_int, Product.user_id == current_user.id).first():
+                            if ing_id_int in owned_product_ml:
                                 db_ingredient_type = 'Product'
                                 db_product_type = 'Product'
                                 db_product_id = ing_id_int
-                            elif HomemadeIngredient.query.filter(HomemadeIngredient.id == ing_id_int, HomemadeIngredient.user_id == current_user.id).first():
+                            elif ing_id_int in owned_homemade_ids:
                                 db_ingredient_type = 'Homemade'
                                 db_product_type = 'Homemade'
                                 db_product_id = ing_id_int
@@ -501,10 +426,10 @@ def add_recipe(category):
                         if unit and unit != 'ml':
                             # Try to convert if we have the product info
                             if db_ingredient_type == 'Product':
-                                product = Product.query.filter(Product.id == ing_id_int, Product.user_id == current_user.id).first()
-                                if product and product.ml_in_bottle and product.ml_in_bottle > 0:
+                                ml_in_bottle = owned_product_ml.get(ing_id_int)
+                                if ml_in_bottle and ml_in_bottle > 0:
                                     # Assume unit is in bottles/containers
-                                    quantity_ml = qty * product.ml_in_bottle
+                                    quantity_ml = qty * ml_in_bottle
                             elif db_ingredient_type == 'Homemade':
                                 # For secondary ingredients, assume ml
                                 quantity_ml = qty
@@ -523,9 +448,10 @@ def add_recipe(category):
                             product_type=db_product_type or db_ingredient_type,
                             product_id=db_product_id or ing_id_int
                         )
-                        db.session.add(item)
-                        items_added += 1
-                        current_app.logger.debug(f"Added ingredient {idx}: type={db_ingredient_type}, id={ing_id_int}, qty={qty}, unit={unit}")
+                        pending_items.append(item)
+                        if log_debug:
+                            current_app.logger.debug("Added ingredient %d: type=%s, id=%s, qty=%s, unit=%s",
+                                                     idx, db_ingredient_type, ing_id_int, qty, unit)
                     except (ValueError, TypeError) as e:
                         current_app.logger.warning(f"Error processing ingredient {idx}: {str(e)}", exc_info=True)
                         continue
@@ -533,6 +459,9 @@ def add_recipe(category):
                         current_app.logger.error(f"Unexpected error processing ingredient {idx}: {str(e)}", exc_info=True)
                         continue
 
+                # Add the rows in one call once the form has been parsed
+                db.session.add_all(pending_items)
+                items_added = len(pending_items)
                 if items_added == 0:
                     flash('Please add at least one ingredient with a quantity greater than zero.')
                     db.session.rollback()
@@ -558,14 +487,14 @@ def add_recipe(category):
                 
                 return redirect(url_for('recipes.add_recipe', category=canonical))
 
+        ingredient_options, ingredient_options_json = build_ingredient_options(current_user.id)
         return render_template(
             'recipes/add_recipe.html',
-            products=products,
-            secondary_ingredients=secondary_ingredients,
             category=config['display'],
             add_label=config['add_label'],
             category_slug=canonical,
             ingredient_options=ingredient_options,
+            ingredient_options_json=ingredient_options_json,
             edit_mode=False,
             recipe=None,
             preset_rows=[]
@@ -580,19 +509,15 @@ def add_recipe(category):
 @login_required
 def view_recipe(id):
     try:
-        from sqlalchemy.orm import joinedload
         recipe = Recipe.query.filter(Recipe.id == id, Recipe.user_id == current_user.id).options(
-            joinedload(Recipe.ingredients)
+            selectinload(Recipe.ingredients)
         ).first_or_404()
         
-        # Ensure ingredients are loaded
-        _ = recipe.ingredients
-        for ingredient in recipe.ingredients:
-            try:
-                _ = ingredient.get_product()
-            except Exception as e:
-                current_app.logger.warning(f"Error loading product for ingredient {ingredient.id}: {str(e)}")
-                continue
+        # Load the ingredients' products in a few batched queries
+        try:
+            prefetch_ingredient_products([recipe])
+        except Exception as e:
+            current_app.logger.warning(f"Error prefetching ingredient products for recipe {recipe.id}: {str(e)}")
         
         try:
             batch = recipe.batch_summary()
@@ -602,18 +527,11 @@ def view_recipe(id):
         
         category_slug, category_display = category_context_from_type(recipe.type or recipe.recipe_type or '')
         # Ensure category_slug is always valid
-        if not category_slug or category_slug not in ['cocktails', 'mocktails', 'beverages']:
-            category_slug = 'cocktails'
-            category_display = 'Cocktails'
-        # Double-check that category_slug is valid before rendering
-        canonical_check, _ = resolve_recipe_category(category_slug)
-        if not canonical_check:
-            category_slug = 'cocktails'
-            category_display = 'Cocktails'
+        if category_slug not in VIEW_CATEGORY_SLUGS:
+            category_slug, category_display = DEFAULT_CATEGORY_CONTEXT
         return render_template('recipes/view.html', recipe=recipe, batch=batch, category_slug=category_slug, category_display=category_display)
     except Exception as e:
         current_app.logger.error(f"Error in view_recipe: {str(e)}", exc_info=True)
-        import traceback
         current_app.logger.error(traceback.format_exc())
         flash(f'An error occurred while loading the recipe: {str(e)}', 'error')
         return redirect(url_for('recipes.recipes_list'))
@@ -626,103 +544,17 @@ def view_recipe(id):
 def edit_recipe(id):
     ensure_schema_updates()
     try:
-        from sqlalchemy.orm import joinedload
+        # Anything else the page touches on the recipe must be loaded explicitly - lazy SQL raises instead of
+        # quietly adding queries (sql_only still allows lookups the identity map can answer)
         recipe = Recipe.query.filter(Recipe.id == id, Recipe.user_id == current_user.id).options(
-            joinedload(Recipe.ingredients)
+            selectinload(Recipe.ingredients),
+            raiseload('*', sql_only=True)
         ).first_or_404()
         
-        # Ensure ingredients are loaded
-        _ = recipe.ingredients
-        for ingredient in recipe.ingredients:
-            _ = ingredient.get_product()
-        
         category_slug, category_display = category_context_from_type(recipe.type or recipe.recipe_type or '')
-        if not category_slug:
-            category_slug = 'cocktails'
-            category_display = 'Cocktails'
-        config = CATEGORY_CONFIG.get(category_slug, CATEGORY_CONFIG['cocktails'])
-        
-        # Filter products and secondary ingredients by current user
-        from utils.db_helpers import has_column
-        try:
-            if has_column('product', 'user_id'):
-                products = Product.query.filter(Product.user_id == current_user.id).order_by(Product.description).all()
-            else:
-                products = Product.query.order_by(Product.description).all()
-        except Exception:
-            products = Product.query.order_by(Product.description).all()
+        # category_context_from_type always returns a configured slug (cocktails by default)
+        config = CATEGORY_CONFIG[category_slug]
         
-        try:
-            if has_column('homemade_ingredient', 'user_id'):
-                secondary_ingredients = HomemadeIngredient.query.filter(HomemadeIngredient.user_id == current_user.id).order_by(HomemadeIngredient.name).all()
-            else:
-                secondary_ingredients = HomemadeIngredient.query.order_by(HomemadeIngredient.name).all()
-        except Exception:
-            secondary_ingredients = HomemadeIngredient.query.order_by(HomemadeIngredient.name).all()
-        
-        # Build ingredient options list, ensuring no duplicates
-        ingredient_options = []
-        seen_products = set()  # Track products by (description, code) to avoid duplicates
-        
-        for p in products:
-            description = p.description or ''
-            code = p.barbuddy_code or ''
-            # Use a unique key to detect duplicates
-            product_key = (description.lower().strip(), code.lower().strip())
-            
-            # Skip if we've already added this product
-            if product_key in seen_products:
-                current_app.logger.warning(f'Skipping duplicate product: {description} ({code})')
-                continue
-            
-            seen_products.add(product_key)
-            label = f"{description} ({code})" if code else description
-            ingredient_options.append({
-                'label': label,
-                'description': description,
-                'code': code,
-                'id': int(p.id),
-                'type': 'Product',
-                'unit': p.selling_unit or 'ml',
-                'cost_per_unit': float(p.cost_per_unit or 0.0),
-                'container_volume': float(p.ml_in_bottle or (1 if (p.selling_unit or '').lower() == 'ml' else 0))
-            })
-        
-        # Add secondary ingredients, also checking for duplicates
-        seen_secondary = set()
-        for sec in secondary_ingredients:
-            if not sec.unique_code:
-                continue
-            
-            # Use a unique key to detect duplicates
-            secondary_key = (sec.name.lower().strip() if sec.name else '', sec.unique_code.lower().strip())
-            
-            # Skip if we've already added this secondary ingredient
-            if secondary_key in seen_secondary:
-                current_app.logger.warning(f'Skipping duplicate secondary ingredient: {sec.name} ({sec.unique_code})')
-                continue
-            
-            seen_secondary.add(secondary_key)
-            try:
-                cost_per_unit = sec.calculate_cost_per_unit()
-                if cost_per_unit is None or cost_per_unit <= 0:
-                    current_app.logger.warning(f'Secondary ingredient {sec.id} ({sec.unique_code}) has zero or invalid cost_per_unit: {cost_per_unit}. Total cost: {sec.calculate_cost()}, Total volume: {sec.total_volume_ml}')
-                    cost_per_unit = 0.0
-            except Exception as e:
-                current_app.logger.error(f'Error calculating cost_per_unit for secondary ingredient {sec.id} ({sec.unique_code}): {str(e)}', exc_info=True)
-                cost_per_unit = 0.0
-            
-            ingredient_options.append({
-                'label': f"{sec.name} ({sec.unique_code})",
-                'description': sec.name,
-                'code': sec.unique_code or '',
-                'id': int(sec.id),
-                'type': 'Secondary',
-                'unit': sec.unit or 'ml',
-                'cost_per_unit': float(cost_per_unit),
-                'container_volume': float(sec.total_volume_ml or 1.0)
-            })
-
         if request.method == 'POST':
             try:
                 recipe.title = request.form['title']
@@ -740,13 +572,20 @@ def edit_recipe(id):
                     if file.filename:
                         recipe.image_path = save_uploaded_file(file, 'recipes')
 
-                RecipeIngredient.query.filter_by(recipe_id=recipe.id).delete()
+                # Replace the rows wholesale: one DELETE here, one multi-row INSERT below
+                RecipeIngredient.query.filter_by(recipe_id=recipe.id).delete(synchronize_session=False)
 
                 ingredient_ids = request.form.getlist('ingredient_id')
                 ingredient_types = request.form.getlist('ingredient_type')
                 ingredient_quantities = request.form.getlist('ingredient_qty')
                 ingredient_units = request.form.getlist('ingredient_unit')
 
+                # Product sizes and types of untyped rows in two bulk lookups
+                owned_product_ml, owned_homemade_ids = _owned_ingredient_lookup(
+                    ingredient_ids, ingredient_types, ('Secondary', 'Product', 'Homemade', 'Recipe')
+                )
+
+                pending_rows = []
                 for idx, ing_id in enumerate(ingredient_ids):
                     if not ing_id or idx >= len(ingredient_types) or idx >= len(ingredient_quantities):
                         continue
@@ -774,9 +613,9 @@ def edit_recipe(id):
                         db_ingredient_type = ing_type
                     else:
                         # Best-effort detection
-                        if Product.query.filter(Product.id == ing_id_int, Product.user_id == current_user.id).first():
+                        if ing_id_int in owned_product_ml:
                             db_ingredient_type = 'Product'
-                        elif HomemadeIngredient.query.filter(HomemadeIngredient.id == ing_id_int, HomemadeIngredient.user_id == current_user.id).first():
+                        elif ing_id_int in owned_homemade_ids:
                             db_ingredient_type = 'Homemade'
                         else:
                             db_ingredient_type = 'Recipe'
@@ -788,15 +627,15 @@ def edit_recipe(id):
                     quantity_ml = qty
                     if unit and unit != 'ml':
                         if db_ingredient_type == 'Product':
-                            prod = Product.query.filter(Product.id == ing_id_int, Product.user_id == current_user.id).first()
-                            if prod and prod.ml_in_bottle and prod.ml_in_bottle > 0:
-                                quantity_ml = qty * prod.ml_in_bottle
+                            ml_in_bottle = owned_product_ml.get(ing_id_int)
+                            if ml_in_bottle and ml_in_bottle > 0:
+                                quantity_ml = qty * ml_in_bottle
                         # For Homemade/Recipe, treat qty as ml/serving
                     
                     if quantity_ml is None or quantity_ml <= 0:
                         quantity_ml = qty
                     
-                    item = RecipeIngredient(
+                    pending_rows.append(dict(
                         recipe_id=recipe.id,
                         ingredient_type=db_ingredient_type,
                         ingredient_id=ing_id_int,
@@ -805,9 +644,10 @@ def edit_recipe(id):
                         quantity_ml=float(quantity_ml),
                         product_type=db_product_type,
                         product_id=db_product_id
-                    )
-                    db.session.add(item)
+                    ))
 
+                if pending_rows:
+                    db.session.bulk_insert_mappings(RecipeIngredient, pending_rows)
                 db.session.commit()
                 flash('Recipe updated successfully!')
                 return redirect(url_for('recipes.recipes_list'))
@@ -817,8 +657,11 @@ def edit_recipe(id):
                 flash(f'An error occurred while updating the recipe: {str(e)}', 'error')
                 return redirect(url_for('recipes.edit_recipe', id=id))
 
+        # The ingredient rows are already loaded - fetch what they point at in a few batched queries
+        prefetch_ingredient_products([recipe])
+        
         preset_rows = []
-        recipe_ingredients = RecipeIngredient.query.filter_by(recipe_id=recipe.id).all()
+        recipe_ingredients = recipe.ingredients
         current_app.logger.info(f"Edit recipe {recipe.id}: Found {len(recipe_ingredients)} ingredients")
         for ingredient in recipe_ingredients:
             ing_type = ingredient.ingredient_type
@@ -828,23 +671,21 @@ def edit_recipe(id):
             label = ''
             description = ''
             code = ''
-            if ing_type == 'Product':
-                product = Product.query.filter(Product.id == ingredient.ingredient_id, Product.user_id == current_user.id).first()
-                if product:
-                    description = product.description or ''
-                    code = product.barbuddy_code or ''
-                    label = f"{description} ({code})" if code else description
-            elif ing_type == 'Secondary':
-                sec = HomemadeIngredient.query.filter(HomemadeIngredient.id == ingredient.ingredient_id, HomemadeIngredient.user_id == current_user.id).first()
-                if sec and sec.unique_code:
-                    description = sec.name or ''
-                    code = sec.unique_code or ''
+            # get_product() returns the prefetched item, scoped to the recipe's (= current) user
+            item = ingredient.get_product() if ing_type in ('Product', 'Secondary', 'Recipe') else None
+            if ing_type == 'Product' and isinstance(item, Product):
+                description = item.description or ''
+                code = item.barbuddy_code or ''
+                label = f"{description} ({code})" if code else description
+            elif ing_type == 'Secondary' and isinstance(item, HomemadeIngredient):
+                if item.unique_code:
+                    description = item.name or ''
+                    code = item.unique_code or ''
                     label = f"{description} ({code})" if code else description
-            elif ing_type == 'Recipe':
-                rec = Recipe.query.filter(Recipe.id == ingredient.ingredient_id, Recipe.user_id == current_user.id).first()
-                if rec and rec.recipe_code:
-                    description = rec.title or ''
-                    code = rec.recipe_code or ''
+            elif ing_type == 'Recipe' and isinstance(item, Recipe):
+                if item.recipe_code:
+                    description = item.title or ''
+                    code = item.recipe_code or ''
                     label = f"{description} ({code})" if code else description
             
             if label:
@@ -858,13 +699,13 @@ def edit_recipe(id):
                     'unit': ingredient.unit or 'ml'
                 })
 
+        ingredient_options, ingredient_options_json = build_ingredient_options(current_user.id)
         return render_template('recipes/edit.html',
-                               products=products,
-                               secondary_ingredients=secondary_ingredients,
                                category=category_display,
                                add_label=config['add_label'],
                                category_slug=category_slug,
                                ingredient_options=ingredient_options,
+                               ingredient_options_json=ingredient_options_json,
                                recipe=recipe,
                                preset_rows=preset_rows)
     except Exception as e:
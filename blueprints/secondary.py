@@ -6,8 +6,11 @@ from flask import Blueprint, render_template, redirect, url_for, request, flash,
 from flask_login import login_required, current_user
 from extensions import db
 from models import Product, HomemadeIngredient, HomemadeIngredientItem
-from utils.db_helpers import ensure_schema_updates
+from sqlalchemy.orm import joinedload
+from utils.db_helpers import ensure_schema_updates, has_column
+from utils.ingredient_options import invalidate_ingredient_options
 import time
+import traceback
 
 secondary_bp = Blueprint('secondary', __name__)
 
@@ -18,8 +21,6 @@ def secondary_ingredients():
     ensure_schema_updates()
     try:
         # Eagerly load ingredients and their products to ensure cost calculation works
-        from sqlalchemy.orm import joinedload
-        from utils.db_helpers import has_column
         try:
             if has_column('homemade_ingredient', 'user_id'):
                 secondary_items = HomemadeIngredient.query.filter(HomemadeIngredient.user_id == current_user.id).options(
@@ -62,7 +63,7 @@ def secondary_ingredients():
                 # Calculate cost per unit
                 try:
                     if item.total_volume_ml and item.total_volume_ml > 0:
-                        unit_cost = item.calculate_cost_per_unit()
+                        unit_cost = item.calculate_cost_per_unit(total_cost)
                     else:
                         unit_cost = 0.0
                 except Exception as e:
@@ -103,7 +104,6 @@ def secondary_ingredients():
 def view_secondary_ingredient(id):
     ensure_schema_updates()
     try:
-        from sqlalchemy.orm import joinedload
         secondary = HomemadeIngredient.query.filter_by(user_id=current_user.id).options(
             joinedload(HomemadeIngredient.ingredients).joinedload(HomemadeIngredientItem.product)
         ).first_or_404()
@@ -120,7 +120,6 @@ def view_secondary_ingredient(id):
         return render_template('secondary_ingredients/view.html', secondary=secondary)
     except Exception as e:
         current_app.logger.error(f"Error in view_secondary_ingredient: {str(e)}", exc_info=True)
-        import traceback
         current_app.logger.error(traceback.format_exc())
         flash(f'An error occurred while loading the secondary ingredient: {str(e)}', 'error')
         return redirect(url_for('secondary.secondary_ingredients'))
@@ -296,6 +295,7 @@ def add_secondary_ingredient():
                     continue
 
             db.session.commit()
+            invalidate_ingredient_options(current_user.id)
             flash('Secondary ingredient created successfully!')
             return redirect(url_for('secondary.secondary_ingredients'))
         except Exception as e:
@@ -318,7 +318,6 @@ def add_secondary_ingredient():
 def edit_secondary_ingredient(id):
     ensure_schema_updates()
     try:
-        from sqlalchemy.orm import joinedload
         secondary = HomemadeIngredient.query.filter_by(user_id=current_user.id).options(
             joinedload(HomemadeIngredient.ingredients).joinedload(HomemadeIngredientItem.product)
         ).first_or_404()
@@ -497,6 +496,7 @@ def edit_secondary_ingredient(id):
                     return redirect(url_for('secondary.edit_secondary_ingredient', id=id))
 
                 db.session.commit()
+                invalidate_ingredient_options(current_user.id)
                 # Expire and reload the secondary ingredient to ensure ingredients are loaded
                 db.session.expire(secondary)
                 db.session.refresh(secondary)
@@ -536,7 +536,6 @@ def edit_secondary_ingredient(id):
         return render_template('secondary_ingredients/edit.html', ingredient_options=ingredient_options, secondary=secondary, preset_rows=preset_rows)
     except Exception as e:
         current_app.logger.error(f"Error in edit_secondary_ingredient: {str(e)}", exc_info=True)
-        import traceback
         current_app.logger.error(traceback.format_exc())
         flash(f'An error occurred while loading the secondary ingredient: {str(e)}', 'error')
         return redirect(url_for('secondary.secondary_ingredients'))
@@ -548,6 +547,7 @@ def delete_secondary_ingredient(id):
     secondary = HomemadeIngredient.query.filter_by(id=id, user_id=current_user.id).first_or_404()
     db.session.delete(secondary)
     db.session.commit()
+    invalidate_ingredient_options(current_user.id)
     flash('Secondary ingredient deleted successfully!')
     return redirect(url_for('secondary.secondary_ingredients'))
 
@@ -596,6 +596,7 @@ def link_ingredient_to_secondary(id):
                 flash(f'Successfully linked: {product.description} ({quantity} {unit})')
             
             db.session.commit()
+            invalidate_ingredient_options(current_user.id)
             return redirect(url_for('secondary.view_secondary_ingredient', id=id))
         except Exception as e:
             db.session.rollback()
@@ -621,6 +622,7 @@ def delete_ingredient_item(id):
     secondary_id = item.homemade_id
     db.session.delete(item)
     db.session.commit()
+    invalidate_ingredient_options(current_user.id)
     flash('Ingredient removed successfully!')
     return redirect(url_for('secondary.link_ingredient_to_secondary', id=secondary_id))
 
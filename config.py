@@ -1,29 +1,62 @@
 import os
+import tempfile
+from functools import lru_cache
 
-class Config:
-    # Use environment variable for SECRET_KEY in production, fallback to default for development
-    SECRET_KEY = os.environ.get('SECRET_KEY') or 'supersecretkey'
-    
-    # Support both SQLite (development) and PostgreSQL (production) via DATABASE_URL
-    database_url = os.environ.get('DATABASE_URL', '').strip()
-    
+_UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads')
+
+
+@lru_cache(maxsize=4)
+def _normalize_db_url(raw):
+    """Map DATABASE_URL to a SQLAlchemy URL - SQLite when unset, psycopg3 driver for PostgreSQL"""
     # If DATABASE_URL is not set or empty, use SQLite for development
-    if not database_url:
-        database_url = 'sqlite:///bar_bartender.db'
+    if not raw:
+        return 'sqlite:///bar_bartender.db'
     # Handle PostgreSQL URL format for Render and other platforms
     # Convert to use psycopg3 (Python 3.13 compatible)
-    elif database_url.startswith('postgres://'):
+    if raw.startswith('postgres://'):
         # Convert postgres:// to postgresql+psycopg://
-        database_url = database_url.replace('postgres://', 'postgresql+psycopg://', 1)
-    elif database_url.startswith('postgresql://'):
+        return raw.replace('postgres://', 'postgresql+psycopg://', 1)
+    if raw.startswith('postgresql://') and '+psycopg' not in raw:
         # If already postgresql:// but not using psycopg, add it
-        if '+psycopg' not in database_url:
-            database_url = database_url.replace('postgresql://', 'postgresql+psycopg://', 1)
+        return raw.replace('postgresql://', 'postgresql+psycopg://', 1)
+    return raw
+
+
+class Config:
+    # Use environment variable for SECRET_KEY in production, fallback to default for development
+    SECRET_KEY = os.environ.get('SECRET_KEY') or 'supersecretkey'
+    
+    # Support both SQLite (development) and PostgreSQL (production) via DATABASE_URL
+    database_url = _normalize_db_url(os.environ.get('DATABASE_URL', '').strip())
     
     SQLALCHEMY_DATABASE_URI = database_url
     
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads')
+    # Session cookie is sent on top-level redirects (flash messages survive Post/Redirect/Get)
+    SESSION_COOKIE_SAMESITE = 'Lax'
+    
+    # Connection pooling (PostgreSQL) - size to gunicorn workers x threads via DB_POOL_SIZE / DB_MAX_OVERFLOW
+    # pool_pre_ping drops connections the server closed; pool_recycle stays below the server idle timeout
+    # Behind PgBouncer set DB_USE_NULLPOOL=true and let PgBouncer do the pooling
+    if database_url.startswith('sqlite'):
+        SQLALCHEMY_ENGINE_OPTIONS = {}
+    elif os.environ.get('DB_USE_NULLPOOL', 'false').lower() in ['true', 'on', '1']:
+        from sqlalchemy.pool import NullPool
+        SQLALCHEMY_ENGINE_OPTIONS = {'poolclass': NullPool}
+    else:
+        SQLALCHEMY_ENGINE_OPTIONS = {
+            'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+            'pool_pre_ping': True,
+            'pool_recycle': 280,
+            'pool_timeout': 5,
+        }
+    # Schema migrations run automatically on startup (cheap once the database is marked current)
+    # Set AUTO_SCHEMA_UPDATES=false and run `flask schema-upgrade` once per deploy instead
+    AUTO_SCHEMA_UPDATES = os.environ.get('AUTO_SCHEMA_UPDATES', 'true').lower() in ['true', 'on', '1']
+    # Compiled Jinja templates are cached on disk and shared by all workers
+    JINJA_CACHE_DIR = os.environ.get('JINJA_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'bar_bartender_jinja_cache')
+    UPLOAD_FOLDER = _UPLOAD_FOLDER
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
     
@@ -51,6 +84,33 @@ class Config:
         logging.info(f'MAIL config - USERNAME={bool(MAIL_USERNAME)}, PASSWORD={bool(MAIL_PASSWORD)}, PASSWORD_LEN={pwd_len}')
     MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER', MAIL_USERNAME)
     
+    # Rate limiting (Flask-Limiter) - Redis keeps counters shared across gunicorn workers
+    RATELIMIT_STORAGE_URI = os.environ.get('RATELIMIT_STORAGE_URI') or os.environ.get('REDIS_URL') or 'memory://'
+    RATELIMIT_HEADERS_ENABLED = True
+    # Number of reverse proxies in front of the app (Render/Railway = 1), so limits key on the real client IP
+    PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR', 0))
+    
+    # Flask-Caching - Redis shares cached values (and invalidations) across gunicorn workers
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL') or os.environ.get('REDIS_URL')
+    CACHE_TYPE = 'RedisCache' if CACHE_REDIS_URL else 'SimpleCache'
+    CACHE_DEFAULT_TIMEOUT = 300
+    CACHE_KEY_PREFIX = 'bar_bartender_'
+    
+    # Celery (background email sending) - use Redis/RabbitMQ in production
+    # If no broker is configured, tasks run inline so development still works without a worker
+    CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL') or os.environ.get('REDIS_URL')
+    CELERY = {
+        'broker_url': CELERY_BROKER_URL,
+        'task_ignore_result': True,
+        'task_always_eager': not CELERY_BROKER_URL,
+        'beat_schedule': {
+            'purge-expired-verification-codes': {
+                'task': 'tasks.purge_expired_verification_codes',
+                'schedule': 3600.0,
+            },
+        },
+    }
+    
     # Email verification is MANDATORY for all new registrations
     # This setting is kept for backward compatibility but is no longer used
     # Email verification cannot be skipped
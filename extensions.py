@@ -5,14 +5,36 @@ Initialize all Flask extensions here
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_mail import Mail
+from celery import Celery, Task
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from flask_caching import Cache
 
 # Initialize extensions
 db = SQLAlchemy()
 login_manager = LoginManager()
 mail = Mail()
+# Rate limiter - storage comes from RATELIMIT_STORAGE_URI (Redis in production)
+limiter = Limiter(key_func=get_remote_address)
+# Response/query cache - backend comes from CACHE_TYPE (Redis in production)
+cache = Cache()
 
 # Configure login manager (will be set in app factory)
 login_manager.login_view = 'auth.login'
 login_manager.login_message = 'Please log in to access this page.'
 login_manager.login_message_category = 'info'
 
+
+
+def celery_init_app(app):
+    """Create the Celery app bound to the Flask app (tasks run inside an app context)"""
+    class FlaskTask(Task):
+        def __call__(self, *args, **kwargs):
+            with app.app_context():
+                return self.run(*args, **kwargs)
+    
+    celery_app = Celery(app.name, task_cls=FlaskTask)
+    celery_app.config_from_object(app.config['CELERY'])
+    celery_app.set_default()
+    app.extensions['celery'] = celery_app
+    return celery_app
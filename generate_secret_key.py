@@ -6,7 +6,7 @@ Run this script to generate a random secret key for production use
 import secrets
 
 if __name__ == '__main__':
-    secret_key = secrets.token_hex(32)
+    secret_key = secrets.token_urlsafe(32)
     print("\n" + "="*60)
     print("Generated SECRET_KEY for your Flask application:")
     print("="*60)
@@ -1,3 +1,4 @@
+from flask import g, has_request_context
 from flask_login import UserMixin
 from datetime import datetime
 
@@ -19,8 +20,13 @@ class User(db.Model, UserMixin):
 # VERIFICATION CODE MODEL
 # -------------------------
 class VerificationCode(db.Model):
+    # One pending code per email - new codes replace the old row via UPSERT
+    __table_args__ = (
+        db.Index('uq_verification_code_email', 'email', unique=True),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(120), nullable=False, index=True)
+    email = db.Column(db.String(120), nullable=False)
     code = db.Column(db.String(6), nullable=False)
     username = db.Column(db.String(80), nullable=False)
     password_hash = db.Column(db.String(200), nullable=False)
@@ -55,9 +61,23 @@ class Product(db.Model):
     case_cost = db.Column(db.Float, default=0.0)
     image_path = db.Column(db.String(255))
     
-    # Unique constraint will be handled at application level
-    # SQL unique constraints with nullable columns can cause issues
-    # We'll enforce uniqueness in the application code instead
+    # Master list filters by sub-category / item level within a user's products
+    # Codes are unique per user - partial indexes so legacy rows without user_id/code don't conflict
+    # (same definitions ensure_schema_updates() adds to existing databases)
+    __table_args__ = (
+        db.Index('ix_product_user_subcat', 'user_id', 'sub_category'),
+        db.Index('ix_product_user_level', 'user_id', 'item_level'),
+        db.Index(
+            'product_user_unique_item_number_key', 'user_id', 'unique_item_number', unique=True,
+            postgresql_where=db.text('user_id IS NOT NULL AND unique_item_number IS NOT NULL'),
+            sqlite_where=db.text('user_id IS NOT NULL AND unique_item_number IS NOT NULL')
+        ),
+        db.Index(
+            'product_user_barbuddy_code_key', 'user_id', 'barbuddy_code', unique=True,
+            postgresql_where=db.text('user_id IS NOT NULL AND barbuddy_code IS NOT NULL'),
+            sqlite_where=db.text('user_id IS NOT NULL AND barbuddy_code IS NOT NULL')
+        ),
+    )
 
     def calculate_case_cost(self):
         if self.purchase_type == "case":
@@ -104,15 +124,25 @@ class HomemadeIngredient(db.Model):
             logging.error(f"Error calculating total cost for HomemadeIngredient {self.id}: {str(e)}")
             return 0.0
     
-    def calculate_cost_per_unit(self):
-        """Calculate cost per unit (ml, gram, etc.)"""
+    def request_cost_per_unit(self):
+        """calculate_cost_per_unit(), memoized on flask.g so a secondary shared by many recipe rows is costed once per request"""
+        if not has_request_context() or self.id is None:
+            return self.calculate_cost_per_unit()
+        cache = g.setdefault('_homemade_cost_per_unit', {})
+        if self.id not in cache:
+            cache[self.id] = self.calculate_cost_per_unit()
+        return cache[self.id]
+    
+    def calculate_cost_per_unit(self, total_cost=None):
+        """Calculate cost per unit (ml, gram, etc.); pass total_cost if calculate_cost() already ran"""
         try:
             if not self.total_volume_ml or self.total_volume_ml <= 0:
                 import logging
                 logging.warning(f"HomemadeIngredient {self.id} ({self.unique_code}) has invalid total_volume_ml: {self.total_volume_ml}")
                 return 0.0
             
-            total_cost = self.calculate_cost()
+            if total_cost is None:
+                total_cost = self.calculate_cost()
             if total_cost is None or total_cost <= 0:
                 import logging
                 logging.warning(f"HomemadeIngredient {self.id} ({self.unique_code}) has zero or invalid total_cost: {total_cost}")
@@ -305,8 +335,24 @@ class RecipeIngredient(db.Model):
     product_type = db.Column(db.String(20))
     product_id = db.Column(db.Integer)
 
+    def ingredient_ref(self):
+        """(model name, id) this row points at - 'Product', 'Homemade' or 'Recipe' - or (None, None)"""
+        if self.ingredient_type:
+            return self.ingredient_type, self.ingredient_id
+        if self.product_type:
+            return ('Product' if self.product_type == "Product" else 'Homemade'), self.product_id
+        return None, None
+
+    def set_product(self, product):
+        """Attach a prefetched ingredient (see prefetch_ingredient_products) so get_product() doesn't query"""
+        self._prefetched_product = product
+
     def get_product(self):
         """Get the ingredient (Product, HomemadeIngredient, or Recipe) - filtered by recipe's user"""
+        # Use the batch-prefetched ingredient when there is one (None is a valid "not found" result)
+        if '_prefetched_product' in self.__dict__:
+            return self._prefetched_product
+        
         # Get user_id from the recipe this ingredient belongs to
         user_id = self.recipe.user_id if self.recipe else None
         
@@ -370,7 +416,7 @@ class RecipeIngredient(db.Model):
             
             elif isinstance(ingredient, HomemadeIngredient):
                 try:
-                    cost_per_unit = ingredient.calculate_cost_per_unit()
+                    cost_per_unit = ingredient.request_cost_per_unit()
                     if cost_per_unit is None or cost_per_unit <= 0:
                         import logging
                         logging.warning(f"RecipeIngredient {self.id}: HomemadeIngredient {ingredient.id} ({ingredient.unique_code}) has zero or invalid cost_per_unit: {cost_per_unit}. Total cost: {ingredient.calculate_cost()}, Total volume: {ingredient.total_volume_ml}")
@@ -0,0 +1,57 @@
+"""
+Background tasks (run by the Celery worker)
+Keep tasks thin - they wrap the existing helpers so the logic stays in one place
+"""
+from concurrent.futures import ThreadPoolExecutor
+from celery import shared_task
+from celery.signals import worker_process_shutdown
+from flask import current_app
+from datetime import datetime, timedelta
+from extensions import db
+from models import VerificationCode
+from utils.email_helpers import send_verification_email, close_smtp_connection
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=30)
+def send_verification_email_task(self, email, code):
+    """Send a verification code email outside the request cycle, retrying on transient SMTP failures"""
+    try:
+        # Permanent failures (mail not configured, bad address, 5xx replies) return False - no retry
+        return send_verification_email(email, code, raise_transient=True)
+    except Exception as e:
+        # Without a broker the task runs inline (eager) - don't retry inside the request
+        if self.request.is_eager:
+            return False
+        # Back off 30s, 60s, 120s so a struggling SMTP server isn't hammered
+        raise self.retry(exc=e, countdown=self.default_retry_delay * 2 ** self.request.retries)
+
+
+# Without a broker tasks run eagerly - a small pool keeps the SMTP round trip off the request thread
+_eager_email_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='verification-email')
+
+
+def queue_verification_email(email, code):
+    """Send a verification email in the background - via Celery when a broker is configured"""
+    if send_verification_email_task.app.conf.task_always_eager:
+        # apply() runs the task (and its app context) on the pool thread
+        _eager_email_executor.submit(send_verification_email_task.apply, args=(email, code))
+    else:
+        send_verification_email_task.delay(email, code)
+
+
+@worker_process_shutdown.connect
+def _close_smtp_on_shutdown(**kwargs):
+    """Close the worker process's SMTP connection when it shuts down"""
+    close_smtp_connection()
+
+
+@shared_task
+def purge_expired_verification_codes():
+    """Delete verification codes that expired more than a day ago (scheduled hourly via beat)"""
+    cutoff = datetime.utcnow() - timedelta(days=1)
+    deleted = VerificationCode.query.filter(
+        VerificationCode.expires_at < cutoff
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    current_app.logger.info(f'Purged {deleted} expired verification code(s)')
+    return deleted
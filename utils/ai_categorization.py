@@ -3,9 +3,12 @@ AI-powered product categorization utility
 Uses AI to automatically identify category and sub-category from product descriptions
 """
 import os
+import re
 import json
 import time
+import hashlib
 from flask import current_app
+from extensions import cache
 
 # Try to import requests, but don't fail if it's not installed
 try:
@@ -19,6 +22,10 @@ _last_api_call_time = 0
 _min_time_between_calls = 0.5  # Minimum 0.5 seconds between API calls (2 per second max)
 _quota_exceeded = False  # Track if we've hit quota limit
 
+# Batched categorization: products per API request, and how long results are cached
+AI_BATCH_SIZE = 50
+AI_CACHE_TIMEOUT = 30 * 24 * 3600
+
 
 # List of valid categories
 VALID_CATEGORIES = ['Beverage', 'Food']
@@ -37,11 +44,48 @@ VALID_SUB_CATEGORIES = [
     'Frozen Puree', 'Juice', 'Packet Juice', 'Other'
 ]
 
+# Outermost JSON object / array in a model reply
+_JSON_OBJECT_RE = re.compile(r'\{.*\}', re.DOTALL)
+_JSON_ARRAY_RE = re.compile(r'\[.*\]', re.DOTALL)
+
+# Set forms for validating AI answers (the lists above keep prompt order)
+_VALID_CATEGORY_SET = frozenset(VALID_CATEGORIES)
+_VALID_SUB_CATEGORY_SET = frozenset(VALID_SUB_CATEGORIES)
+# Joined once for the prompt templates
+_VALID_CATEGORIES_STR = ', '.join(VALID_CATEGORIES)
+_VALID_SUB_CATEGORIES_STR = ', '.join(VALID_SUB_CATEGORIES)
+
+
+def _extract_json(content, pattern):
+    """
+    Parse the JSON in a model reply - pattern picks the outermost object or array,
+    which also skips markdown code fences or any preamble around it
+    """
+    match = pattern.search(content)
+    return json.loads(match.group(0) if match else content)
+
+
+# One HTTP session per process - keeps the connection to the API alive between requests
+_http_session = None
+
+
+def _get_http_session():
+    """Shared requests.Session, created on first use"""
+    global _http_session
+    if _http_session is None:
+        _http_session = requests.Session()
+        # Small pool - categorization requests go to a single host
+        _http_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    return _http_session
+
 
 def categorize_product_ai(description, supplier=None):
     """
     Use AI to categorize a product based on its description.
     
+    Successful results are cached by description + supplier (case-insensitive), so a
+    product seen before skips the API call.
+    
     Args:
         description: Product description/name
         supplier: Optional supplier name for context
@@ -49,6 +93,26 @@ def categorize_product_ai(description, supplier=None):
     Returns:
         tuple: (category, sub_category) or (None, None) if categorization fails
     """
+    key = _categorization_cache_key(description, supplier)
+    try:
+        cached = cache.get(key)
+    except Exception as e:
+        current_app.logger.warning(f'AI categorization cache unavailable: {str(e)}')
+        cached = None
+    if cached:
+        return tuple(cached)
+    
+    result = _request_categorization(description, supplier)
+    if result[0]:
+        try:
+            cache.set(key, result, timeout=AI_CACHE_TIMEOUT)
+        except Exception as e:
+            current_app.logger.warning(f'Could not cache AI categorization: {str(e)}')
+    return result
+
+
+def _request_categorization(description, supplier):
+    """Categorize a single product with one API request - (None, None) on failure"""
     global _last_api_call_time, _quota_exceeded
     
     # If we've already hit quota limit, skip immediately
@@ -86,11 +150,11 @@ def categorize_product_ai(description, supplier=None):
 Product Description: {description}
 {f'Supplier: {supplier}' if supplier and supplier != 'N/A' else ''}
 
-Categories available: {', '.join(VALID_CATEGORIES)}
-Sub-categories available: {', '.join(VALID_SUB_CATEGORIES)}
+Categories available: {_VALID_CATEGORIES_STR}
+Sub-categories available: {_VALID_SUB_CATEGORIES_STR}
 
 Based on the product description, identify:
-1. The most appropriate category (must be one of: {', '.join(VALID_CATEGORIES)})
+1. The most appropriate category (must be one of: {_VALID_CATEGORIES_STR})
 2. The most specific sub-category from the list above
 
 Respond ONLY with a JSON object in this exact format:
@@ -115,7 +179,7 @@ Do not include any explanation, only the JSON object."""
             'max_tokens': 150
         }
         
-        response = requests.post(
+        response = _get_http_session().post(
             'https://api.openai.com/v1/chat/completions',
             headers=headers,
             json=payload,
@@ -128,37 +192,18 @@ Do not include any explanation, only the JSON object."""
             result = response.json()
             content = result['choices'][0]['message']['content'].strip()
             
-            # Parse JSON response
-            # Sometimes the response might have markdown code blocks
-            if content.startswith('```'):
-                # Extract JSON from code block
-                lines = content.split('\n')
-                json_start = False
-                json_lines = []
-                for line in lines:
-                    if line.strip().startswith('{'):
-                        json_start = True
-                    if json_start:
-                        json_lines.append(line)
-                    if json_start and line.strip().endswith('}'):
-                        break
-                content = '\n'.join(json_lines)
-            
-            # Remove markdown code block markers if present
-            content = content.replace('```json', '').replace('```', '').strip()
-            
-            categorization = json.loads(content)
+            categorization = _extract_json(content, _JSON_OBJECT_RE)
             
             category = categorization.get('category', '').strip()
             sub_category = categorization.get('sub_category', '').strip()
             
             # Validate category
-            if category not in VALID_CATEGORIES:
+            if category not in _VALID_CATEGORY_SET:
                 current_app.logger.warning(f'AI returned invalid category: {category}, defaulting to Beverage')
                 category = 'Beverage'
             
             # Validate sub_category
-            if sub_category not in VALID_SUB_CATEGORIES:
+            if sub_category not in _VALID_SUB_CATEGORY_SET:
                 current_app.logger.warning(f'AI returned invalid sub_category: {sub_category}, defaulting to Other')
                 sub_category = 'Other'
             
@@ -203,10 +248,153 @@ def should_use_ai_categorization(category, sub_category):
     Returns:
         bool: True if AI should be used (category is missing/Other or sub_category is missing/Other)
     """
-    # Use AI if category is missing, empty, or "Other"
-    category_needs_ai = not category or category.strip() == '' or category.strip() == 'Other'
+    # Use AI if either value is missing, empty, or "Other" (each stripped once)
+    category = (category or '').strip()
+    sub_category = (sub_category or '').strip()
+    return category in ('', 'Other') or sub_category in ('', 'Other')
+
+
+def _categorization_cache_key(description, supplier):
+    """Cache key for a (description, supplier) pair - case-insensitive"""
+    raw = f'{(description or "").strip().lower()}|{(supplier or "").strip().lower()}'
+    return 'ai_cat:' + hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def _request_batch_categorization(items, api_key):
+    """
+    Categorize up to AI_BATCH_SIZE (description, supplier) pairs in one API request.
     
-    # Use AI if sub_category is missing, empty, or "Other"
-    sub_category_needs_ai = not sub_category or sub_category.strip() == '' or sub_category.strip() == 'Other'
+    Returns:
+        list: (category, sub_category) per item, or None if the batch request failed
+    """
+    global _last_api_call_time, _quota_exceeded
+    
+    # Rate limiting: ensure minimum time between API calls
+    time_since_last_call = time.time() - _last_api_call_time
+    if time_since_last_call < _min_time_between_calls:
+        time.sleep(_min_time_between_calls - time_since_last_call)
+    _last_api_call_time = time.time()
+    
+    products = [
+        {'id': i, 'description': description, 'supplier': supplier if supplier and supplier != 'N/A' else ''}
+        for i, (description, supplier) in enumerate(items)
+    ]
+    prompt = f"""Analyze these products and determine the category and sub-category of each for a bar/restaurant inventory system.
+
+Products (JSON): {json.dumps(products)}
+
+Categories available: {_VALID_CATEGORIES_STR}
+Sub-categories available: {_VALID_SUB_CATEGORIES_STR}
+
+For every product, identify:
+1. The most appropriate category (must be one of: {_VALID_CATEGORIES_STR})
+2. The most specific sub-category from the list above
+
+Respond ONLY with a JSON array containing one object per product, in this exact format:
+[{{"id": 0, "category": "Beverage or Food", "sub_category": "exact match from the list"}}]
+
+If you cannot determine with confidence, use "Other" for sub-category.
+Do not include any explanation, only the JSON array."""
+
+    try:
+        response = _get_http_session().post(
+            'https://api.openai.com/v1/chat/completions',
+            headers={
+                'Authorization': f'Bearer {api_key}',
+                'Content-Type': 'application/json'
+            },
+            json={
+                'model': 'gpt-3.5-turbo',
+                'messages': [
+                    {'role': 'system', 'content': 'You are a helpful assistant that categorizes products for bar and restaurant inventory management. Always respond with valid JSON only.'},
+                    {'role': 'user', 'content': prompt}
+                ],
+                'temperature': 0.3,
+                'max_tokens': 40 * len(items) + 50
+            },
+            timeout=30
+        )
+        
+        if response.status_code == 429:
+            # Quota exceeded - set flag and stop trying
+            _quota_exceeded = True
+            current_app.logger.warning('OpenAI API quota exceeded. AI categorization disabled for this session.')
+            return None
+        if response.status_code != 200:
+            current_app.logger.warning(f'OpenAI API error (batch): {response.status_code} - {response.text[:200]}')
+            return None
+        
+        content = response.json()['choices'][0]['message']['content'].strip()
+        answers = {int(entry['id']): entry for entry in _extract_json(content, _JSON_ARRAY_RE)
+                   if isinstance(entry, dict) and 'id' in entry}
+    except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+        current_app.logger.warning(f'AI batch categorization failed: {str(e)}')
+        return None
+    
+    results = []
+    for i in range(len(items)):
+        entry = answers.get(i)
+        if entry is None:
+            results.append((None, None))
+            continue
+        category = str(entry.get('category', '')).strip()
+        sub_category = str(entry.get('sub_category', '')).strip()
+        # Same validation as the single-product path
+        if category not in _VALID_CATEGORY_SET:
+            category = 'Beverage'
+        if sub_category not in _VALID_SUB_CATEGORY_SET:
+            sub_category = 'Other'
+        results.append((category, sub_category))
+    return results
+
+
+def categorize_products_ai(items):
+    """
+    Categorize many products with as few API requests as possible.
+    
+    Results are cached (Redis when configured) by description + supplier, duplicates are
+    sent once, and the rest go out AI_BATCH_SIZE per request. If a batch request fails,
+    its products fall back to categorize_product_ai() one at a time.
+    
+    Args:
+        items: list of (description, supplier) tuples
+    
+    Returns:
+        list: (category, sub_category) per item, (None, None) where categorization failed
+    """
+    if not items:
+        return []
+    if not REQUESTS_AVAILABLE or not os.environ.get('OPENAI_API_KEY'):
+        # Same checks (and logging) as the single-product path
+        return [categorize_product_ai(description, supplier) for description, supplier in items]
+    
+    keys = [_categorization_cache_key(description, supplier) for description, supplier in items]
+    unique_keys = list(dict.fromkeys(keys))
+    try:
+        cached = dict(zip(unique_keys, cache.get_many(*unique_keys)))
+    except Exception as e:
+        current_app.logger.warning(f'AI categorization cache unavailable: {str(e)}')
+        cached = {}
+    found = {key: tuple(value) for key, value in cached.items() if value}
+    
+    # One entry per distinct product that isn't cached yet
+    first_item = dict(zip(keys, items))
+    missing = [key for key in unique_keys if key not in found]
+    api_key = os.environ.get('OPENAI_API_KEY')
+    for start in range(0, len(missing), AI_BATCH_SIZE):
+        if _quota_exceeded:
+            break
+        chunk = missing[start:start + AI_BATCH_SIZE]
+        results = _request_batch_categorization([first_item[key] for key in chunk], api_key)
+        if results is None:
+            # Batch request failed - fall back to one request per product (cached below)
+            results = [_request_categorization(*first_item[key]) for key in chunk]
+        fresh = {key: result for key, result in zip(chunk, results) if result[0]}
+        found.update(fresh)
+        if fresh:
+            try:
+                cache.set_many(fresh, timeout=AI_CACHE_TIMEOUT)
+            except Exception as e:
+                current_app.logger.warning(f'Could not cache AI categorizations: {str(e)}')
     
-    return category_needs_ai or sub_category_needs_ai
+    return [found.get(key, (None, None)) for key in keys]
@@ -1,6 +1,8 @@
 """
 Application constants
 """
+from functools import lru_cache
+
 CATEGORY_CONFIG = {
     'cocktails': {
         'display': 'Cocktails',
@@ -28,6 +30,10 @@ CATEGORY_CONFIG = {
     }
 }
 
+# Categories the recipe view page links back to - anything else falls back to the default
+VIEW_CATEGORY_SLUGS = frozenset(('cocktails', 'mocktails', 'beverages'))
+DEFAULT_CATEGORY_CONTEXT = ('cocktails', 'Cocktails')
+
 CATEGORY_ALIASES = {
     'cocktails': 'cocktails',
     'classic': 'cocktails',
@@ -49,9 +55,31 @@ TYPE_TO_CATEGORY = {
     '': 'cocktails'  # Default empty type to Cocktails
 }
 
+# Category shown for recipes without a food_category, from their lower-cased type/recipe_type
+# (same fallback as templates/recipes/list.html)
+DERIVED_RECIPE_CATEGORIES = {
+    'Cocktail': ('cocktails', 'classic'),
+    'Mocktail': ('mocktails', 'signature'),
+    'Beverage': ('beverages', 'beverage'),
+    'Food': ('food',)
+}
+
+TYPE_TO_DERIVED_CATEGORY = {
+    label: category for category, labels in DERIVED_RECIPE_CATEGORIES.items() for label in labels
+}
+
+# Lower-cased category filter value -> type labels that derive it
+DERIVED_CATEGORY_LABELS = {
+    category.lower(): labels for category, labels in DERIVED_RECIPE_CATEGORIES.items()
+}
+
 
 def resolve_recipe_category(category: str):
-    key = (category or '').lower()
+    return _resolve_recipe_category((category or '').lower())
+
+
+@lru_cache(maxsize=128)
+def _resolve_recipe_category(key: str):
     canonical = CATEGORY_ALIASES.get(key)
     if not canonical:
         return None, None
@@ -59,7 +87,11 @@ def resolve_recipe_category(category: str):
 
 
 def category_context_from_type(recipe_type: str):
-    key = (recipe_type or '').lower().strip()
+    return _category_context_from_type((recipe_type or '').lower().strip())
+
+
+@lru_cache(maxsize=128)
+def _category_context_from_type(key: str):
     canonical = TYPE_TO_CATEGORY.get(key)
     if not canonical:
         # Default to cocktails if type doesn't match
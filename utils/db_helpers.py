@@ -1,31 +1,81 @@
 """
 Database helper utilities
 """
+import threading
+import time
+from sqlalchemy import inspect
 from extensions import db
 from flask import current_app
 
 
 def get_table_columns(conn, table_name):
     """
-    Get list of column names for a table, works with both SQLite and PostgreSQL.
+    Get the set of column names for a table, works with both SQLite and PostgreSQL.
+    Uses SQLAlchemy's Inspector (pg_catalog on PostgreSQL, PRAGMA on SQLite).
     """
     try:
-        db_url = str(db.engine.url)
-        
-        if 'postgresql' in db_url or 'postgres' in db_url:
-            # PostgreSQL
-            result = conn.execute(db.text(
-                "SELECT column_name FROM information_schema.columns "
-                "WHERE table_name = :table_name"
-            ), {'table_name': table_name})
-            return [row[0] for row in result]
-        else:
-            # SQLite
-            result = conn.execute(db.text(f'PRAGMA table_info({table_name})'))
-            return [col[1] for col in result]
+        return frozenset(column['name'] for column in inspect(conn).get_columns(table_name))
+    except Exception:
+        # If table doesn't exist or error, return an empty set
+        return frozenset()
+
+
+def get_all_table_columns(conn, table_names):
+    """
+    Column names for several tables in one query: {table_name: set of columns}.
+    PostgreSQL reads information_schema; SQLite joins sqlite_master with pragma_table_info.
+    Missing tables map to an empty set.
+    """
+    columns = {table_name: set() for table_name in table_names}
+    if conn.dialect.name == 'postgresql':
+        sql = (
+            "SELECT table_name, column_name FROM information_schema.columns "
+            "WHERE table_name IN :table_names"
+        )
+    else:
+        sql = (
+            "SELECT m.name, p.name FROM sqlite_master AS m JOIN pragma_table_info(m.name) AS p "
+            "WHERE m.type = 'table' AND m.name IN :table_names"
+        )
+    try:
+        result = conn.execute(
+            db.text(sql).bindparams(db.bindparam('table_names', expanding=True)),
+            {'table_names': list(table_names)}
+        )
+        for table_name, column_name in result:
+            columns[table_name].add(column_name)
     except Exception:
-        # If table doesn't exist or error, return empty list
-        return []
+        pass  # Treat as missing tables, same as get_table_columns
+    return columns
+
+
+# Column names per table, kept for the life of the process (cleared after migrations)
+_table_columns = {}
+
+
+def _cached_table_columns(table_name):
+    """Column names for a table - one query the first time, then served from _table_columns"""
+    columns = _table_columns.get(table_name)
+    if columns is None:
+        with db.engine.connect() as conn:
+            columns = get_table_columns(conn, table_name)
+        if not columns:
+            # Missing table or lookup error - raise so the empty result isn't cached
+            raise LookupError(f'No columns found for table {table_name}')
+        _table_columns[table_name] = columns
+    return columns
+
+
+def warm_column_cache():
+    """Load the columns of every model table with one catalog query (call at startup)"""
+    try:
+        with db.engine.connect() as conn:
+            found = get_all_table_columns(conn, list(db.metadata.tables))
+    except Exception as e:
+        current_app.logger.warning(f'Could not preload table columns: {str(e)}')
+        return
+    # Missing tables stay uncached, same as a lazy lookup
+    _table_columns.update((table_name, frozenset(columns)) for table_name, columns in found.items() if columns)
 
 
 def has_column(table_name, column_name):
@@ -34,326 +84,425 @@ def has_column(table_name, column_name):
     Returns True if column exists, False otherwise.
     """
     try:
-        with current_app.app_context():
-            with db.engine.begin() as conn:
-                columns = get_table_columns(conn, table_name)
-                return column_name in columns
+        return column_name in _cached_table_columns(table_name)
     except Exception:
         return False
 
 
+# Index names per table, kept like _table_columns (cleared after migrations)
+_table_indexes = {}
+_PRODUCT_CODE_INDEXES = frozenset({'product_user_unique_item_number_key', 'product_user_barbuddy_code_key'})
+
+
+def has_index(table_name, index_name):
+    """
+    Check if a table has an index (memoized per table).
+    Indexes added by migrations may be missing on a database that wasn't migrated yet.
+    """
+    names = _table_indexes.get(table_name)
+    if names is None:
+        try:
+            with db.engine.connect() as conn:
+                names = frozenset(index['name'] for index in inspect(conn).get_indexes(table_name))
+        except Exception:
+            return False  # Missing table or lookup error - not cached
+        _table_indexes[table_name] = names
+    return index_name in names
+
+
+def product_code_indexes_ready():
+    """
+    True once the per-user unique indexes on product codes exist.
+    Until then - e.g. an older database that still holds duplicate codes - callers
+    must check for duplicates themselves before inserting.
+    """
+    return all(has_index('product', name) for name in _PRODUCT_CODE_INDEXES)
+
+
+def clear_column_cache():
+    """Forget cached columns and indexes (after migrations)"""
+    _table_columns.clear()
+    _table_indexes.clear()
+
+
+# Schema updates only need to run once per process
+_schema_ready = False
+_schema_lock = threading.Lock()
+# After a failed run, skip further attempts until this time.monotonic() value
+_schema_retry_after = 0.0
+SCHEMA_RETRY_SECONDS = 300
+# Set when a migration step fails, so the version marker isn't written and the step is retried
+_schema_incomplete = False
+
+# Bump when _run_schema_updates gains a new step - databases marked with an older
+# version run the migrations again on the next start
+SCHEMA_VERSION = '1'
+
+
+def _schema_warning(message):
+    """Log a failed migration step and keep the database from being marked up to date"""
+    global _schema_incomplete
+    _schema_incomplete = True
+    current_app.logger.warning(message)
+
+
+def _schema_version_current():
+    """True if a previous run completed every migration for SCHEMA_VERSION"""
+    try:
+        with db.engine.connect() as conn:
+            value = conn.execute(db.text(
+                "SELECT value FROM schema_meta WHERE key = 'app_schema_version'"
+            )).scalar()
+        return value == SCHEMA_VERSION
+    except Exception:
+        return False  # No schema_meta table yet
+
+
+def _record_schema_version():
+    """Mark the database as migrated to SCHEMA_VERSION"""
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(db.text(
+                "CREATE TABLE IF NOT EXISTS schema_meta (key VARCHAR(64) PRIMARY KEY, value VARCHAR(64))"
+            ))
+            conn.execute(db.text("DELETE FROM schema_meta WHERE key = 'app_schema_version'"))
+            conn.execute(db.text(
+                "INSERT INTO schema_meta (key, value) VALUES ('app_schema_version', :version)"
+            ), {'version': SCHEMA_VERSION})
+    except Exception as e:
+        current_app.logger.warning(f'Could not record schema version: {str(e)}')
+
+
 def ensure_schema_updates():
     """
     Ensure database schema is up to date with migrations.
-    Works with both SQLite and PostgreSQL.
+    Runs once per process - later calls return immediately. A database already marked
+    with SCHEMA_VERSION costs a single query. A failed run is retried at most every
+    SCHEMA_RETRY_SECONDS.
     """
-    try:
-        with current_app.app_context():
-            with db.engine.begin() as conn:
-                # Recipe table updates
-                recipe_columns = get_table_columns(conn, 'recipe')
-                if 'item_level' not in recipe_columns:
-                    try:
-                        conn.execute(db.text("ALTER TABLE recipe ADD COLUMN item_level VARCHAR(20) DEFAULT 'Primary'"))
-                    except Exception:
-                        pass  # Column might already exist
-                if 'selling_price' not in recipe_columns:
-                    try:
-                        conn.execute(db.text("ALTER TABLE recipe ADD COLUMN selling_price FLOAT DEFAULT 0"))
-                    except Exception:
-                        pass
-                if 'vat_percentage' not in recipe_columns:
-                    try:
-                        conn.execute(db.text("ALTER TABLE recipe ADD COLUMN vat_percentage FLOAT DEFAULT 0"))
-                    except Exception:
-                        pass
-                if 'service_charge_percentage' not in recipe_columns:
-                    try:
-                        conn.execute(db.text("ALTER TABLE recipe ADD COLUMN service_charge_percentage FLOAT DEFAULT 0"))
-                    except Exception:
-                        pass
-                if 'government_fees_percentage' not in recipe_columns:
-                    try:
-                        conn.execute(db.text("ALTER TABLE recipe ADD COLUMN government_fees_percentage FLOAT DEFAULT 0"))
-                    except Exception:
-                        pass
-                if 'garnish' not in recipe_columns:
-                    try:
-                        conn.execute(db.text("ALTER TABLE recipe ADD COLUMN garnish TEXT"))
-                    except Exception:
-                        pass
-                if 'food_category' not in recipe_columns:
-                    try:
-                        conn.execute(db.text("ALTER TABLE recipe ADD COLUMN food_category VARCHAR(50)"))
-                    except Exception:
-                        pass
+    global _schema_ready, _schema_retry_after
+    if _schema_ready or time.monotonic() < _schema_retry_after:
+        return
+    with _schema_lock:
+        if _schema_ready or time.monotonic() < _schema_retry_after:
+            return
+        if not current_app.config.get('AUTO_SCHEMA_UPDATES', True):
+            # Migrations are run at deploy time with `flask schema-upgrade`
+            _schema_ready = True
+            return
+        if _schema_version_current():
+            _schema_ready = True
+            return
+        if _run_schema_updates():
+            _schema_ready = True
+        else:
+            # Handlers call this on every request - don't rerun a failing migration for each one
+            _schema_retry_after = time.monotonic() + SCHEMA_RETRY_SECONDS
+            current_app.logger.error(f'Schema updates failed - retrying in {SCHEMA_RETRY_SECONDS}s')
+        # Migrations may have added columns - drop anything looked up before they ran
+        clear_column_cache()
 
-                # Product table updates
-                product_columns = get_table_columns(conn, 'product')
-                if 'item_level' not in product_columns:
-                    try:
-                        conn.execute(db.text("ALTER TABLE product ADD COLUMN item_level VARCHAR(20) DEFAULT 'Primary'"))
-                    except Exception:
-                        pass
 
-                # Recipe ingredient table updates
-                recipe_ingredient_columns = get_table_columns(conn, 'recipe_ingredient')
-                if 'ingredient_type' not in recipe_ingredient_columns:
-                    try:
-                        conn.execute(db.text("ALTER TABLE recipe_ingredient ADD COLUMN ingredient_type VARCHAR(20)"))
-                    except Exception:
-                        pass
-                if 'ingredient_id' not in recipe_ingredient_columns:
-                    try:
-                        conn.execute(db.text("ALTER TABLE recipe_ingredient ADD COLUMN ingredient_id INTEGER"))
-                    except Exception:
-                        pass
-                if 'quantity' not in recipe_ingredient_columns:
-                    try:
-                        conn.execute(db.text("ALTER TABLE recipe_ingredient ADD COLUMN quantity FLOAT"))
-                    except Exception:
-                        pass
-                if 'unit' not in recipe_ingredient_columns:
-                    try:
-                        conn.execute(db.text("ALTER TABLE recipe_ingredient ADD COLUMN unit VARCHAR(20) DEFAULT 'ml'"))
-                    except Exception:
-                        pass
+def upgrade_schema():
+    """
+    Run every migration now, whatever version the database is marked with
+    (the `flask schema-upgrade` command). Returns True if every step succeeded.
+    """
+    global _schema_ready
+    with _schema_lock:
+        _schema_ready = _run_schema_updates()
+        clear_column_cache()
+        return _schema_ready and not _schema_incomplete
+
+
+def clear_schema_cache():
+    """Forget cached schema state (call after running migrations in-process)"""
+    global _schema_ready, _schema_retry_after
+    _schema_ready = False
+    _schema_retry_after = 0.0
+    clear_column_cache()
+
+
+# Columns added to existing tables, per table: (column, type and default)
+# Note: user_id is added without a foreign key constraint - the model defines it and
+# adding constraints manually can fail due to PostgreSQL reserved words
+_SCHEMA_COLUMNS = {
+    'recipe': [
+        ('item_level', "VARCHAR(20) DEFAULT 'Primary'"),
+        ('selling_price', 'FLOAT DEFAULT 0'),
+        ('vat_percentage', 'FLOAT DEFAULT 0'),
+        ('service_charge_percentage', 'FLOAT DEFAULT 0'),
+        ('government_fees_percentage', 'FLOAT DEFAULT 0'),
+        ('garnish', 'TEXT'),
+        ('food_category', 'VARCHAR(50)'),
+    ],
+    'product': [
+        ('item_level', "VARCHAR(20) DEFAULT 'Primary'"),
+        ('user_id', 'INTEGER'),
+    ],
+    'recipe_ingredient': [
+        ('ingredient_type', 'VARCHAR(20)'),
+        ('ingredient_id', 'INTEGER'),
+        ('quantity', 'FLOAT'),
+        ('unit', "VARCHAR(20) DEFAULT 'ml'"),
+    ],
+    'homemade_ingredient_item': [
+        ('quantity', 'FLOAT DEFAULT 0'),
+        ('unit', "VARCHAR(20) DEFAULT 'ml'"),
+    ],
+    'homemade_ingredient': [
+        ('user_id', 'INTEGER'),
+    ],
+}
+
+
+# Fill the columns above from legacy data - each statement only rewrites rows still missing a value
+_BACKFILL_STATEMENTS = [
+    "UPDATE recipe_ingredient SET "
+    "ingredient_id = COALESCE(ingredient_id, product_id), "
+    "ingredient_type = COALESCE(ingredient_type, product_type), "
+    "quantity = COALESCE(quantity, quantity_ml), "
+    "unit = COALESCE(unit, 'ml') "
+    "WHERE ingredient_id IS NULL OR ingredient_type IS NULL OR quantity IS NULL OR unit IS NULL",
+    "UPDATE homemade_ingredient_item SET quantity_ml = COALESCE(quantity, 0) WHERE quantity_ml IS NULL",
+]
+
+# Global unique constraints from before codes were scoped per user: (table, constraint)
+_LEGACY_UNIQUE_CONSTRAINTS = [
+    ('product', 'product_unique_item_number_key'),
+    ('product', 'product_barbuddy_code_key'),
+    ('homemade_ingredient', 'homemade_ingredient_unique_code_key'),
+    ('recipe', 'recipe_recipe_code_key'),
+]
+
+# Their per-user replacements on (user_id, column): (table, index, column)
+_USER_SCOPED_UNIQUE_INDEXES = [
+    ('product', 'product_user_unique_item_number_key', 'unique_item_number'),
+    ('product', 'product_user_barbuddy_code_key', 'barbuddy_code'),
+    ('homemade_ingredient', 'homemade_ingredient_user_unique_code_key', 'unique_code'),
+    ('recipe', 'recipe_user_recipe_code_key', 'recipe_code'),
+]
+
+
+def _duplicate_codes(conn, table_name, column, limit=5):
+    """
+    (user_id, code) pairs that occur more than once in a table - a unique index on
+    (user_id, column) can't be created while any exist. Returns up to limit examples.
+    """
+    return conn.execute(db.text(
+        f"SELECT user_id, {column} FROM {table_name} "
+        f"WHERE user_id IS NOT NULL AND {column} IS NOT NULL "
+        f"GROUP BY user_id, {column} HAVING COUNT(*) > 1 LIMIT {int(limit)}"
+    )).fetchall()
+
+
+def _report_duplicate_codes(logger, table_name, index_name, duplicates):
+    """
+    Log why a per-user unique index was skipped. Not a failed migration step: the schema
+    version is still recorded, the add forms keep their own duplicate check, and
+    `flask schema-upgrade` creates the index once the rows are cleaned up.
+    """
+    logger.warning(
+        'Not creating unique index %s: %s has duplicate codes per user, e.g. %r. '
+        'Fix these rows, then run flask schema-upgrade',
+        index_name, table_name, [tuple(row) for row in duplicates]
+    )
+
+
+def _add_missing_columns(conn, table_name, existing_columns, dialect):
+    """
+    Add the _SCHEMA_COLUMNS a table is missing. PostgreSQL gets a single multi-clause
+    ALTER TABLE (one round trip, one lock); SQLite only supports one ADD COLUMN per statement.
+    Columns that were added are recorded in existing_columns.
+    """
+    missing = [(name, ddl) for name, ddl in _SCHEMA_COLUMNS[table_name] if name not in existing_columns]
+    if not missing:
+        return
+    if dialect == 'postgresql':
+        # IF NOT EXISTS covers a concurrent worker adding the column first. A real failure
+        # aborts the transaction anyway, so it propagates and the whole run is retried
+        conn.execute(db.text(
+            f"ALTER TABLE {table_name} " + ", ".join(f"ADD COLUMN IF NOT EXISTS {name} {ddl}" for name, ddl in missing)
+        ))
+        existing_columns.update(name for name, _ in missing)
+        return
+    # SQLite has no ADD COLUMN IF NOT EXISTS - guard each statement against a concurrent add
+    for name, ddl in missing:
+        try:
+            conn.execute(db.text(f"ALTER TABLE {table_name} ADD COLUMN {name} {ddl}"))
+            existing_columns.add(name)
+        except Exception as e:
+            _schema_warning(f'Could not add {name} to {table_name}: {str(e)}')
+
+
+def _run_schema_updates():
+    """
+    Apply schema migrations. Works with both SQLite and PostgreSQL.
+    Returns False if the update could not run (ensure_schema_updates retries it later).
+    The schema version is recorded only when every step succeeded.
+    """
+    global _schema_incomplete
+    _schema_incomplete = False
+    # Resolve the proxies once - the block below logs and opens connections repeatedly
+    engine = db.engine
+    logger = current_app.logger
+    try:
+        with current_app.app_context():
+            with engine.begin() as conn:
+                dialect = conn.dialect.name
+                # Add missing columns - one ALTER per table (see _SCHEMA_COLUMNS)
+                # One metadata lookup for every table; the sets are kept current as columns are added
+                table_columns = get_all_table_columns(conn, _SCHEMA_COLUMNS)
+                for table_name, columns in table_columns.items():
+                    _add_missing_columns(conn, table_name, columns, dialect)
 
                 # Backfill new columns from legacy data where possible
-                try:
-                    conn.execute(db.text("UPDATE recipe_ingredient SET ingredient_id = product_id WHERE ingredient_id IS NULL AND product_id IS NOT NULL"))
-                    conn.execute(db.text("UPDATE recipe_ingredient SET ingredient_type = COALESCE(ingredient_type, product_type) WHERE ingredient_type IS NULL"))
-                    conn.execute(db.text("UPDATE recipe_ingredient SET quantity = COALESCE(quantity, quantity_ml) WHERE quantity IS NULL"))
-                    conn.execute(db.text("UPDATE recipe_ingredient SET unit = COALESCE(unit, 'ml') WHERE unit IS NULL"))
-                except Exception:
-                    pass  # Some columns might not exist
-
-                # Homemade ingredient item table updates
-                homemade_item_columns = get_table_columns(conn, 'homemade_ingredient_item')
-                if 'quantity' not in homemade_item_columns:
-                    try:
-                        conn.execute(db.text("ALTER TABLE homemade_ingredient_item ADD COLUMN quantity FLOAT DEFAULT 0"))
-                    except Exception:
-                        pass
-                if 'unit' not in homemade_item_columns:
-                    try:
-                        conn.execute(db.text("ALTER TABLE homemade_ingredient_item ADD COLUMN unit VARCHAR(20) DEFAULT 'ml'"))
-                    except Exception:
-                        pass
-                
-                # Backfill quantity_ml if it's NULL (for existing records)
-                try:
-                    conn.execute(db.text("UPDATE homemade_ingredient_item SET quantity_ml = COALESCE(quantity_ml, COALESCE(quantity, 0)) WHERE quantity_ml IS NULL"))
-                except Exception:
-                    pass  # Column might not exist or already updated
-                
-                # Add user_id columns if they don't exist
-                # Note: We only add the column, not the foreign key constraint
-                # The foreign key is already defined in the model, SQLAlchemy will handle it
-                # Adding constraints manually can fail due to PostgreSQL reserved words
-                if 'user_id' not in product_columns:
-                    try:
-                        conn.execute(db.text("ALTER TABLE product ADD COLUMN user_id INTEGER"))
-                    except Exception as e:
-                        current_app.logger.warning(f'Could not add user_id to product: {str(e)}')
-                        pass  # Column might already exist
-                
-                homemade_columns = get_table_columns(conn, 'homemade_ingredient')
-                if 'user_id' not in homemade_columns:
-                    try:
-                        conn.execute(db.text("ALTER TABLE homemade_ingredient ADD COLUMN user_id INTEGER"))
-                    except Exception as e:
-                        current_app.logger.warning(f'Could not add user_id to homemade_ingredient: {str(e)}')
-                        pass  # Column might already exist
-                
-                # Store homemade_columns for later use in constraint updates
-                homemade_columns_for_constraints = get_table_columns(conn, 'homemade_ingredient')
+                if dialect == 'postgresql':
+                    # One round trip - a failure aborts the transaction, so it fails the run
+                    conn.exec_driver_sql(";\n".join(_BACKFILL_STATEMENTS))
+                else:
+                    for statement in _BACKFILL_STATEMENTS:
+                        try:
+                            conn.execute(db.text(statement))
+                        except Exception:
+                            pass  # Legacy columns might not exist
                 
                 # Drop old global unique constraints and replace with user-scoped constraints
-                db_url = str(db.engine.url)
-                if 'postgresql' in db_url or 'postgres' in db_url:
+                if dialect == 'postgresql':
                     try:
-                        # Drop old global unique constraint on unique_item_number if it exists
-                        # Check both table_constraints and pg_constraint for comprehensive detection
-                        constraint_check = conn.execute(db.text(
-                            "SELECT 1 FROM information_schema.table_constraints "
-                            "WHERE table_name = 'product' AND constraint_name = 'product_unique_item_number_key' "
-                            "UNION ALL "
-                            "SELECT 1 FROM pg_constraint WHERE conname = 'product_unique_item_number_key'"
-                        ))
-                        if constraint_check.fetchone():
-                            try:
-                                conn.execute(db.text("ALTER TABLE product DROP CONSTRAINT IF EXISTS product_unique_item_number_key"))
-                                current_app.logger.info('Dropped old global unique constraint on unique_item_number')
-                            except Exception as drop_e:
-                                current_app.logger.warning(f'Could not drop unique_item_number constraint: {str(drop_e)}')
-                        
-                        # Drop old global unique constraint on barbuddy_code if it exists
-                        # Check both table_constraints and pg_constraint for comprehensive detection
-                        barbuddy_constraint_check = conn.execute(db.text(
-                            "SELECT 1 FROM information_schema.table_constraints "
-                            "WHERE table_name = 'product' AND constraint_name = 'product_barbuddy_code_key' "
-                            "UNION ALL "
-                            "SELECT 1 FROM pg_constraint WHERE conname = 'product_barbuddy_code_key'"
-                        ))
-                        if barbuddy_constraint_check.fetchone():
-                            try:
-                                conn.execute(db.text("ALTER TABLE product DROP CONSTRAINT IF EXISTS product_barbuddy_code_key"))
-                                current_app.logger.info('Dropped old global unique constraint on barbuddy_code')
-                            except Exception as drop_e:
-                                current_app.logger.warning(f'Could not drop barbuddy_code constraint: {str(drop_e)}')
+                        # Every old constraint/index and new index that exists, in one catalog query
+                        legacy_names = [name for _, name in _LEGACY_UNIQUE_CONSTRAINTS]
+                        present = {row[0] for row in conn.execute(db.text(
+                            "SELECT conname FROM pg_constraint WHERE conname IN :legacy_names "
+                            "UNION SELECT indexname FROM pg_indexes WHERE indexname IN :index_names"
+                        ).bindparams(
+                            db.bindparam('legacy_names', expanding=True),
+                            db.bindparam('index_names', expanding=True)
+                        ), {
+                            'legacy_names': legacy_names,
+                            'index_names': legacy_names + [name for _, name, _ in _USER_SCOPED_UNIQUE_INDEXES]
+                        })}
                         
-                        # Also check for and drop any unique indexes that might be enforcing uniqueness
-                        # Sometimes PostgreSQL creates unique indexes instead of constraints
-                        unique_index_check = conn.execute(db.text(
-                            "SELECT indexname FROM pg_indexes "
-                            "WHERE tablename = 'product' AND indexname IN ('product_unique_item_number_key', 'product_barbuddy_code_key')"
-                        ))
-                        for row in unique_index_check:
-                            index_name = row[0]
-                            try:
-                                conn.execute(db.text(f"DROP INDEX IF EXISTS {index_name}"))
-                                current_app.logger.info(f'Dropped old unique index: {index_name}')
-                            except Exception as drop_e:
-                                current_app.logger.warning(f'Could not drop index {index_name}: {str(drop_e)}')
+                        # Old global constraints - sometimes PostgreSQL has a unique index instead
+                        ddl = []
+                        for table_name, name in _LEGACY_UNIQUE_CONSTRAINTS:
+                            if name in present:
+                                ddl.append(f"ALTER TABLE {table_name} DROP CONSTRAINT IF EXISTS {name}")
+                                ddl.append(f"DROP INDEX IF EXISTS {name}")
                         
-                        # Drop old global unique constraint on homemade_ingredient.unique_code if it exists
-                        homemade_constraint_check = conn.execute(db.text(
-                            "SELECT 1 FROM information_schema.table_constraints "
-                            "WHERE table_name = 'homemade_ingredient' AND constraint_name = 'homemade_ingredient_unique_code_key' "
-                            "UNION ALL "
-                            "SELECT 1 FROM pg_constraint WHERE conname = 'homemade_ingredient_unique_code_key'"
-                        ))
-                        if homemade_constraint_check.fetchone():
-                            try:
-                                conn.execute(db.text("ALTER TABLE homemade_ingredient DROP CONSTRAINT IF EXISTS homemade_ingredient_unique_code_key"))
-                                current_app.logger.info('Dropped old global unique constraint on homemade_ingredient.unique_code')
-                            except Exception as drop_e:
-                                current_app.logger.warning(f'Could not drop homemade_ingredient unique_code constraint: {str(drop_e)}')
+                        # New user-scoped unique indexes (only once the table has user_id)
+                        for table_name, name, column in _USER_SCOPED_UNIQUE_INDEXES:
+                            if name not in present and 'user_id' in table_columns[table_name]:
+                                duplicates = _duplicate_codes(conn, table_name, column)
+                                if duplicates:
+                                    _report_duplicate_codes(logger, table_name, name, duplicates)
+                                    continue
+                                ddl.append(
+                                    f"CREATE UNIQUE INDEX IF NOT EXISTS {name} "
+                                    f"ON {table_name} (user_id, {column}) "
+                                    f"WHERE user_id IS NOT NULL AND {column} IS NOT NULL"
+                                )
                         
-                        # Also check for unique indexes on homemade_ingredient.unique_code
-                        homemade_index_check = conn.execute(db.text(
-                            "SELECT indexname FROM pg_indexes "
-                            "WHERE tablename = 'homemade_ingredient' AND indexname = 'homemade_ingredient_unique_code_key'"
-                        ))
-                        for row in homemade_index_check:
-                            index_name = row[0]
-                            try:
-                                conn.execute(db.text(f"DROP INDEX IF EXISTS {index_name}"))
-                                current_app.logger.info(f'Dropped old unique index: {index_name}')
-                            except Exception as drop_e:
-                                current_app.logger.warning(f'Could not drop index {index_name}: {str(drop_e)}')
-                        
-                        # Add new user-scoped unique constraints (only if user_id column exists)
-                        if 'user_id' in product_columns:
-                            try:
-                                # Check if new constraint for unique_item_number already exists
-                                new_constraint_check = conn.execute(db.text(
-                                    "SELECT indexname FROM pg_indexes "
-                                    "WHERE tablename = 'product' AND indexname = 'product_user_unique_item_number_key'"
-                                ))
-                                if not new_constraint_check.fetchone():
-                                    # Create unique constraint on (user_id, unique_item_number)
-                                    conn.execute(db.text(
-                                        "CREATE UNIQUE INDEX IF NOT EXISTS product_user_unique_item_number_key "
-                                        "ON product (user_id, unique_item_number) "
-                                        "WHERE user_id IS NOT NULL AND unique_item_number IS NOT NULL"
-                                    ))
-                                    current_app.logger.info('Created user-scoped unique constraint on (user_id, unique_item_number)')
-                                
-                                # Check if new constraint for barbuddy_code already exists
-                                barbuddy_index_check = conn.execute(db.text(
-                                    "SELECT indexname FROM pg_indexes "
-                                    "WHERE tablename = 'product' AND indexname = 'product_user_barbuddy_code_key'"
-                                ))
-                                if not barbuddy_index_check.fetchone():
-                                    # Create unique constraint on (user_id, barbuddy_code)
-                                    conn.execute(db.text(
-                                        "CREATE UNIQUE INDEX IF NOT EXISTS product_user_barbuddy_code_key "
-                                        "ON product (user_id, barbuddy_code) "
-                                        "WHERE user_id IS NOT NULL AND barbuddy_code IS NOT NULL"
-                                    ))
-                                    current_app.logger.info('Created user-scoped unique constraint on (user_id, barbuddy_code)')
-                            except Exception as e:
-                                current_app.logger.warning(f'Could not create user-scoped constraints: {str(e)}')
-                        
-                        # Add new user-scoped unique constraint for homemade_ingredient.unique_code
-                        if 'user_id' in homemade_columns_for_constraints:
-                            try:
-                                # Check if new constraint for unique_code already exists
-                                homemade_unique_check = conn.execute(db.text(
-                                    "SELECT indexname FROM pg_indexes "
-                                    "WHERE tablename = 'homemade_ingredient' AND indexname = 'homemade_ingredient_user_unique_code_key'"
-                                ))
-                                if not homemade_unique_check.fetchone():
-                                    # Create unique constraint on (user_id, unique_code)
-                                    conn.execute(db.text(
-                                        "CREATE UNIQUE INDEX IF NOT EXISTS homemade_ingredient_user_unique_code_key "
-                                        "ON homemade_ingredient (user_id, unique_code) "
-                                        "WHERE user_id IS NOT NULL AND unique_code IS NOT NULL"
-                                    ))
-                                    current_app.logger.info('Created user-scoped unique constraint on (user_id, unique_code) for homemade_ingredient')
-                            except Exception as e:
-                                current_app.logger.warning(f'Could not create user-scoped constraint for homemade_ingredient: {str(e)}')
-                        
-                        # Drop old global unique constraint on recipe.recipe_code if it exists
-                        recipe_constraint_check = conn.execute(db.text(
-                            "SELECT 1 FROM information_schema.table_constraints "
-                            "WHERE table_name = 'recipe' AND constraint_name = 'recipe_recipe_code_key' "
-                            "UNION ALL "
-                            "SELECT 1 FROM pg_constraint WHERE conname = 'recipe_recipe_code_key'"
-                        ))
-                        if recipe_constraint_check.fetchone():
-                            try:
-                                conn.execute(db.text("ALTER TABLE recipe DROP CONSTRAINT IF EXISTS recipe_recipe_code_key"))
-                                current_app.logger.info('Dropped old global unique constraint on recipe.recipe_code')
-                            except Exception as drop_e:
-                                current_app.logger.warning(f'Could not drop recipe recipe_code constraint: {str(drop_e)}')
-                        
-                        # Also check for unique indexes on recipe.recipe_code
-                        recipe_index_check = conn.execute(db.text(
-                            "SELECT indexname FROM pg_indexes "
-                            "WHERE tablename = 'recipe' AND indexname = 'recipe_recipe_code_key'"
-                        ))
-                        for row in recipe_index_check:
-                            index_name = row[0]
-                            try:
-                                conn.execute(db.text(f"DROP INDEX IF EXISTS {index_name}"))
-                                current_app.logger.info(f'Dropped old unique index: {index_name}')
-                            except Exception as drop_e:
-                                current_app.logger.warning(f'Could not drop index {index_name}: {str(drop_e)}')
-                        
-                        # Add new user-scoped unique constraint for recipe.recipe_code
-                        recipe_columns = get_table_columns(conn, 'recipe')
-                        if 'user_id' in recipe_columns:
-                            try:
-                                # Check if new constraint for recipe_code already exists
-                                recipe_unique_check = conn.execute(db.text(
-                                    "SELECT indexname FROM pg_indexes "
-                                    "WHERE tablename = 'recipe' AND indexname = 'recipe_user_recipe_code_key'"
-                                ))
-                                if not recipe_unique_check.fetchone():
-                                    # Create unique constraint on (user_id, recipe_code)
-                                    conn.execute(db.text(
-                                        "CREATE UNIQUE INDEX IF NOT EXISTS recipe_user_recipe_code_key "
-                                        "ON recipe (user_id, recipe_code) "
-                                        "WHERE user_id IS NOT NULL AND recipe_code IS NOT NULL"
-                                    ))
-                                    current_app.logger.info('Created user-scoped unique constraint on (user_id, recipe_code) for recipe')
-                            except Exception as e:
-                                current_app.logger.warning(f'Could not create user-scoped constraint for recipe: {str(e)}')
+                        # All idempotent - send them as one multi-statement batch (one round trip)
+                        if ddl:
+                            conn.exec_driver_sql(";\n".join(ddl))
+                            logger.info(f'Applied {len(ddl)} unique constraint/index change(s) for per-user codes')
                     except Exception as e:
-                        current_app.logger.warning(f'Could not update unique constraints: {str(e)}')
+                        _schema_warning(f'Could not update unique constraints: {str(e)}')
                         # Try to drop constraints directly as fallback
                         try:
-                            conn.execute(db.text("ALTER TABLE product DROP CONSTRAINT IF EXISTS product_unique_item_number_key"))
-                            conn.execute(db.text("ALTER TABLE product DROP CONSTRAINT IF EXISTS product_barbuddy_code_key"))
-                            conn.execute(db.text("ALTER TABLE homemade_ingredient DROP CONSTRAINT IF EXISTS homemade_ingredient_unique_code_key"))
-                            conn.execute(db.text("ALTER TABLE recipe DROP CONSTRAINT IF EXISTS recipe_recipe_code_key"))
-                            current_app.logger.info('Attempted to drop old constraints as fallback')
+                            for table_name, name in _LEGACY_UNIQUE_CONSTRAINTS:
+                                conn.execute(db.text(f"ALTER TABLE {table_name} DROP CONSTRAINT IF EXISTS {name}"))
+                            logger.info('Attempted to drop old constraints as fallback')
                         except Exception:
                             pass
     except Exception as e:
         # Log error but don't crash - schema updates are best effort
-        current_app.logger.warning(f'Schema update warning: {str(e)}')
+        _schema_warning(f'Schema update warning: {str(e)}')
+        return False
+    
+    # One pending verification code per email (registration uses an UPSERT on email)
+    try:
+        with engine.begin() as conn:
+            # Keep only the newest row per email before adding the unique index
+            conn.execute(db.text(
+                "DELETE FROM verification_code WHERE id NOT IN "
+                "(SELECT MAX(id) FROM verification_code GROUP BY email)"
+            ))
+            conn.execute(db.text("DROP INDEX IF EXISTS ix_verification_code_email"))
+            conn.execute(db.text(
+                "CREATE UNIQUE INDEX IF NOT EXISTS uq_verification_code_email ON verification_code (email)"
+            ))
+    except Exception as e:
+        _schema_warning(f'Could not add unique index on verification_code.email: {str(e)}')
+    
+    # Composite indexes for the master list's sub-category / item level filters
+    try:
+        with engine.begin() as conn:
+            conn.execute(db.text(
+                "CREATE INDEX IF NOT EXISTS ix_product_user_subcat ON product (user_id, sub_category)"
+            ))
+            conn.execute(db.text(
+                "CREATE INDEX IF NOT EXISTS ix_product_user_level ON product (user_id, item_level)"
+            ))
+    except Exception as e:
+        _schema_warning(f'Could not add product filter indexes: {str(e)}')
+    
+    # Per-user unique product codes on databases other than PostgreSQL (handled above for PostgreSQL)
+    # An index is skipped, with the conflicting rows logged, while duplicates still exist
+    if engine.dialect.name != 'postgresql':
+        try:
+            with engine.begin() as conn:
+                for table_name, name, column in _USER_SCOPED_UNIQUE_INDEXES:
+                    if name not in _PRODUCT_CODE_INDEXES:
+                        continue
+                    duplicates = _duplicate_codes(conn, table_name, column)
+                    if duplicates:
+                        _report_duplicate_codes(logger, table_name, name, duplicates)
+                        continue
+                    conn.execute(db.text(
+                        f"CREATE UNIQUE INDEX IF NOT EXISTS {name} ON {table_name} (user_id, {column}) "
+                        f"WHERE user_id IS NOT NULL AND {column} IS NOT NULL"
+                    ))
+        except Exception as e:
+            _schema_warning(f'Could not add unique product code indexes: {str(e)}')
+    
+    if not _schema_incomplete:
+        _record_schema_version()
+    return True
 
+
+def prefetch_ingredient_products(recipes):
+    """
+    Load the ingredients referenced by every RecipeIngredient of these recipes with one IN query
+    per ingredient model (instead of one query per get_product() call) and attach them to the rows.
+    """
+    from sqlalchemy.orm import selectinload
+    from models import Product, HomemadeIngredient, HomemadeIngredientItem, Recipe
+    
+    models = {'Product': Product, 'Homemade': HomemadeIngredient, 'Recipe': Recipe}
+    # (model name, user_id) -> ids; get_product() scopes lookups to the recipe's user
+    wanted = {}
+    rows = []
+    for recipe in recipes:
+        for ingredient in recipe.ingredients:
+            kind, ingredient_id = ingredient.ingredient_ref()
+            if kind not in models or ingredient_id is None:
+                continue
+            wanted.setdefault((kind, recipe.user_id), set()).add(ingredient_id)
+            rows.append((ingredient, kind, recipe.user_id, ingredient_id))
+    
+    found = {}
+    for (kind, user_id), ids in wanted.items():
+        model = models[kind]
+        query = model.query.filter(model.id.in_(ids))
+        if user_id:
+            query = query.filter(model.user_id == user_id)
+        if model is HomemadeIngredient:
+            # Homemade costs are computed from their own items
+            query = query.options(selectinload(HomemadeIngredient.ingredients).selectinload(HomemadeIngredientItem.product))
+        for item in query.all():
+            found[(kind, user_id, item.id)] = item
+    
+    for ingredient, kind, user_id, ingredient_id in rows:
+        ingredient.set_product(found.get((kind, user_id, ingredient_id)))
@@ -4,76 +4,24 @@ Email helper utilities for sending verification codes
 from flask import current_app
 from flask_mail import Message
 from extensions import mail
+import re
 import secrets
+import smtplib
+import string
+import threading
+import time
 from datetime import datetime, timedelta
 
+# Basic shape check - no alternation, so matching is linear in the input length
+_EMAIL_RE = re.compile(r'^[^@\s]{1,64}@[^@\s]+\.[^@\s]+\Z')
 
-def generate_verification_code():
-    """Generate a random 6-digit verification code"""
-    return ''.join([str(secrets.randbelow(10)) for _ in range(6)])
-
-
-def send_verification_email(email, code):
-    """
-    Send verification code email to user
-    Returns True if successful, False otherwise
-    """
-    try:
-        # Check if mail extension is initialized
-        if not mail or not hasattr(mail, 'send'):
-            current_app.logger.warning('Mail extension not initialized')
-            return False
-        
-        # Check if email is configured
-        mail_username = current_app.config.get('MAIL_USERNAME')
-        mail_password = current_app.config.get('MAIL_PASSWORD')
-        mail_server = current_app.config.get('MAIL_SERVER', 'Not set')
-        mail_port = current_app.config.get('MAIL_PORT', 'Not set')
-        
-        # Also check environment variables directly as fallback
-        import os
-        env_mail_password = os.environ.get('MAIL_PASSWORD')
-        env_mail_password_len = len(env_mail_password) if env_mail_password else 0
-        
-        # Debug: List all MAIL_* environment variables (for troubleshooting)
-        mail_env_vars = {k: 'SET' if v else 'NOT SET' for k, v in os.environ.items() if k.startswith('MAIL_')}
-        current_app.logger.info(f'All MAIL_* environment variables: {mail_env_vars}')
-        
-        # Log email configuration status (without exposing password)
-        current_app.logger.info(f'Email config check - MAIL_SERVER={mail_server}, MAIL_PORT={mail_port}, MAIL_USERNAME={bool(mail_username)}, MAIL_PASSWORD={bool(mail_password)}, ENV_MAIL_PASSWORD={bool(env_mail_password)} (length: {env_mail_password_len})')
-        
-        # If password not in config but exists in environment, use it
-        if not mail_password and env_mail_password:
-            mail_password = str(env_mail_password).strip()
-            if mail_password:
-                current_app.logger.info(f'Using MAIL_PASSWORD from environment variable directly (length: {len(mail_password)})')
-                # Update config so Flask-Mail can use it
-                current_app.config['MAIL_PASSWORD'] = mail_password
-            else:
-                current_app.logger.warning('MAIL_PASSWORD from environment is empty after stripping')
-        
-        # Final check - if still no password, log detailed error
-        if not mail_password:
-            current_app.logger.error(f'MAIL_PASSWORD is still None/empty. Config value: {current_app.config.get("MAIL_PASSWORD")}, Env value exists: {bool(env_mail_password)}, Env value length: {env_mail_password_len}')
-        
-        if not mail_username or not mail_password:
-            current_app.logger.error(f'Email not configured - MAIL_USERNAME={bool(mail_username)} (value: {mail_username if mail_username else "None"}), MAIL_PASSWORD={bool(mail_password)}, ENV_MAIL_PASSWORD={bool(env_mail_password)}')
-            return False
-        
-        # Validate email format
-        if '@' not in email or '.' not in email.split('@')[1]:
-            current_app.logger.warning(f'Invalid email format: {email}')
-            return False
-        
-        # Create email message
-        msg = Message(
-            subject='Chefs & Bartenders - Email Verification Code',
-            recipients=[email],
-            body=f'''Hello!
+# Verification email - only the code changes between sends
+_VERIFICATION_SUBJECT = 'Chefs & Bartenders - Email Verification Code'
+_VERIFICATION_TEXT = string.Template('''Hello!
 
 Thank you for registering with Chefs & Bartenders!
 
-Your verification code is: {code}
+Your verification code is: $code
 
 This code will expire in 10 minutes.
 
@@ -81,8 +29,8 @@ If you did not request this code, please ignore this email.
 
 Best regards,
 Chefs & Bartenders Team
-''',
-            html=f'''<html>
+''')
+_VERIFICATION_HTML = string.Template('''<html>
 <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
     <div style="max-width: 600px; margin: 0 auto; padding: 20px;">
         <h2 style="color: #2c3e50;">Chefs & Bartenders - Email Verification</h2>
@@ -90,7 +38,7 @@ Chefs & Bartenders Team
         <p>Thank you for registering with Chefs & Bartenders!</p>
         <div style="background-color: #f4f4f4; padding: 20px; text-align: center; margin: 20px 0; border-radius: 5px;">
             <p style="margin: 0; font-size: 14px; color: #666;">Your verification code is:</p>
-            <h1 style="margin: 10px 0; font-size: 32px; color: #2c3e50; letter-spacing: 5px;">{code}</h1>
+            <h1 style="margin: 10px 0; font-size: 32px; color: #2c3e50; letter-spacing: 5px;">$code</h1>
         </div>
         <p style="font-size: 12px; color: #999;">This code will expire in 10 minutes.</p>
         <p>If you did not request this code, please ignore this email.</p>
@@ -98,27 +46,142 @@ Chefs & Bartenders Team
         <p style="font-size: 12px; color: #999;">Best regards,<br>Chefs & Bartenders Team</p>
     </div>
 </body>
-</html>'''
+</html>''')
+
+# One open SMTP connection per thread (Celery worker / gunicorn thread), reused across sends
+_smtp_local = threading.local()
+# A connection idle longer than this gets a NOOP before it is reused
+_SMTP_IDLE_CHECK_SECONDS = 60
+
+
+def is_valid_email(email):
+    """Basic shape check: local@domain.tld with no whitespace or extra '@', within RFC length limits"""
+    if len(email) > 254:
+        return False
+    # Cheap guard first - most malformed input has no '@' or no dot in the domain
+    _, at, domain = email.rpartition('@')
+    if not at or '.' not in domain:
+        return False
+    return _EMAIL_RE.match(email) is not None
+
+
+def generate_verification_code():
+    """Generate a random 6-digit verification code"""
+    return f'{secrets.randbelow(1_000_000):06d}'
+
+
+def _get_smtp_connection():
+    """Return this thread's open Flask-Mail connection, connecting (TLS + login) only the first time"""
+    conn = getattr(_smtp_local, 'conn', None)
+    if conn is not None and time.monotonic() - getattr(_smtp_local, 'last_used', 0) > _SMTP_IDLE_CHECK_SECONDS:
+        # Idle for a while - servers drop quiet sessions, so check before reusing it
+        try:
+            alive = conn.host.noop()[0] == 250
+        except Exception:
+            alive = False
+        if not alive:
+            close_smtp_connection()
+            conn = None
+    if conn is None:
+        conn = mail.connect()
+        conn.__enter__()  # Opens the socket, STARTTLS and AUTH - kept open for later sends
+        _smtp_local.conn = conn
+    return conn
+
+
+def close_smtp_connection():
+    """Drop this thread's SMTP connection (it will be reopened on the next send)"""
+    conn = getattr(_smtp_local, 'conn', None)
+    _smtp_local.conn = None
+    if conn is not None and conn.host is not None:
+        try:
+            conn.host.close()
+        except Exception:
+            pass
+
+
+def send_with_shared_connection(msg):
+    """Send a message over the reused SMTP connection, reconnecting once if the server dropped it"""
+    try:
+        _get_smtp_connection().send(msg)
+    except (smtplib.SMTPServerDisconnected, ConnectionError):
+        close_smtp_connection()
+        _get_smtp_connection().send(msg)
+    except Exception:
+        # Unknown state - don't reuse this connection
+        close_smtp_connection()
+        raise
+    _smtp_local.last_used = time.monotonic()
+
+
+def is_mail_configured():
+    """Return True if SMTP credentials are available (resolved once when the app is created)"""
+    configured = current_app.extensions.get('mail_configured')
+    if configured is None:
+        # App built without the factory's mail setup - check the config directly
+        configured = bool(current_app.config.get('MAIL_USERNAME') and current_app.config.get('MAIL_PASSWORD'))
+    return configured
+
+
+def _is_transient_mail_error(error):
+    """True for send failures worth retrying: SMTP 4xx replies and dropped or refused connections"""
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    # Socket errors (refused, reset, timeout) - other SMTPExceptions subclass OSError but are permanent
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+def send_verification_email(email, code, raise_transient=False):
+    """
+    Send verification code email to user
+    Returns True if successful, False otherwise.
+    With raise_transient, SMTP/socket errors that may succeed later are re-raised
+    instead (for callers that retry); permanent failures still return False.
+    """
+    try:
+        # One flag read - set at startup only once the mail extension initialized with credentials
+        if not is_mail_configured():
+            current_app.logger.error('Email not configured - MAIL_USERNAME=%s, MAIL_PASSWORD=%s',
+                                     bool(current_app.config.get('MAIL_USERNAME')), bool(current_app.config.get('MAIL_PASSWORD')))
+            return False
+        
+        # Validate email format
+        if not is_valid_email(email):
+            current_app.logger.warning('Invalid email format: %s', email)
+            return False
+        
+        # Create email message
+        msg = Message(
+            subject=_VERIFICATION_SUBJECT,
+            recipients=[email],
+            body=_VERIFICATION_TEXT.substitute(code=code),
+            html=_VERIFICATION_HTML.substitute(code=code)
         )
         
-        current_app.logger.info(f'Attempting to send email via {mail_server} to {email}')
+        current_app.logger.info('Attempting to send email via %s to %s', current_app.config.get('MAIL_SERVER'), email)
         try:
-            mail.send(msg)
-            current_app.logger.info(f'Verification email sent successfully to {email}')
+            send_with_shared_connection(msg)
+            current_app.logger.info('Verification email sent successfully to %s', email)
             return True
         except Exception as send_error:
-            current_app.logger.error(f'Error during mail.send(): {str(send_error)}', exc_info=True)
+            current_app.logger.error('Error during mail.send(): %s', send_error, exc_info=True)
             raise  # Re-raise to be caught by outer exception handler
     except Exception as e:
         error_msg = str(e)
-        current_app.logger.error(f'Failed to send verification email to {email}: {error_msg}', exc_info=True)
+        current_app.logger.error('Failed to send verification email to %s: %s', email, error_msg, exc_info=True)
         # Log more details about the error for debugging
         if 'authentication' in error_msg.lower() or 'login' in error_msg.lower():
             current_app.logger.error('Email authentication failed - check MAIL_USERNAME and MAIL_PASSWORD. For Gmail, use App Password, not regular password.')
         elif 'connection' in error_msg.lower() or 'timeout' in error_msg.lower():
-            current_app.logger.error(f'Email connection failed - check MAIL_SERVER ({current_app.config.get("MAIL_SERVER")}) and network connectivity')
+            current_app.logger.error('Email connection failed - check MAIL_SERVER (%s) and network connectivity', current_app.config.get('MAIL_SERVER'))
         elif 'ssl' in error_msg.lower() or 'tls' in error_msg.lower():
             current_app.logger.error('Email SSL/TLS error - check MAIL_USE_TLS setting')
         else:
-            current_app.logger.error(f'Unknown email error: {error_msg}')
+            current_app.logger.error('Unknown email error: %s', error_msg)
+        if raise_transient and _is_transient_mail_error(e):
+            raise
         return False
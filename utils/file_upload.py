@@ -2,11 +2,19 @@
 File upload utilities
 """
 import os
+import shutil
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from werkzeug.utils import secure_filename
 from flask import current_app
 
+# Copy uploads in 1 MiB chunks - Werkzeug's FileStorage.save() default of 16 KiB means many more read/write calls
+UPLOAD_COPY_BUFFER = 1 << 20
+
+# Small shared pool for removing replaced images, so the response doesn't wait on the unlink
+_upload_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='upload-cleanup')
+
 
 def allowed_file(filename):
     """Check if file extension is allowed"""
@@ -27,9 +35,22 @@ def save_uploaded_file(file, folder):
         filename = timestamp + filename
         
         filepath = os.path.join(upload_dir, filename)
-        file.save(filepath)
+        with open(filepath, 'wb', buffering=UPLOAD_COPY_BUFFER) as out:
+            shutil.copyfileobj(file.stream, out, length=UPLOAD_COPY_BUFFER)
         
         # Return relative path from static folder
         return os.path.join('uploads', folder, filename)
     return None
 
+
+def _remove_file(filepath):
+    """Unlink a file, ignoring one that is already gone"""
+    try:
+        os.unlink(filepath)
+    except FileNotFoundError:
+        pass
+
+
+def delete_file_async(filepath):
+    """Remove a replaced upload on the upload thread pool - the response doesn't wait for it"""
+    return _upload_executor.submit(_remove_file, filepath)
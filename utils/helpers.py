@@ -3,6 +3,7 @@ Helper utility functions
 """
 from datetime import datetime
 from flask import current_app
+from werkzeug.routing import BaseConverter
 
 
 def inject_now():
@@ -10,6 +11,13 @@ def inject_now():
     return {'current_year': datetime.now().year}
 
 
+class RecipeCodeConverter(BaseConverter):
+    """URL converter for recipe codes (REC-...), so /recipes/<code> never matches category names"""
+    regex = r'REC-[^/]+'
+    # Lower than the default string converter so it is tried before /recipes/<category>
+    weight = 50
+
+
 def ensure_schema_updates():
     """
     Ensure database schema is up to date.
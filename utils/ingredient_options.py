@@ -0,0 +1,122 @@
+"""
+Ingredient picker options for the recipe add/edit forms
+"""
+from flask import current_app
+from jinja2.utils import htmlsafe_json_dumps
+from sqlalchemy.orm import selectinload
+from extensions import cache
+from models import Product, HomemadeIngredient, HomemadeIngredientItem
+from utils.db_helpers import has_column
+
+
+def _unique_ingredient_choices(products, secondary_ingredients):
+    """
+    Drop duplicate choices for the ingredient picker in one pass each, keeping the first
+    product per (description, code) and the first coded secondary per (name, code).
+    Skips are logged as one summary line per kind with a few example names.
+    """
+    unique_products = {}
+    skipped_products = []
+    for p in products:
+        key = ((p.description or '').lower().strip(), (p.barbuddy_code or '').lower().strip())
+        if unique_products.setdefault(key, p) is not p:
+            skipped_products.append(p.description)
+    unique_secondary = {}
+    skipped_secondary = []
+    for sec in secondary_ingredients:
+        if sec.unique_code:
+            key = ((sec.name or '').lower().strip(), sec.unique_code.lower().strip())
+            if unique_secondary.setdefault(key, sec) is not sec:
+                skipped_secondary.append(sec.name)
+    if skipped_products:
+        current_app.logger.warning('Skipped %d duplicate product(s), examples: %r',
+                                   len(skipped_products), skipped_products[:10])
+    if skipped_secondary:
+        current_app.logger.warning('Skipped %d duplicate secondary ingredient(s), examples: %r',
+                                   len(skipped_secondary), skipped_secondary[:10])
+    return list(unique_products.values()), list(unique_secondary.values())
+
+
+@cache.memoize(timeout=60)
+def build_ingredient_options(user_id):
+    """
+    Products and secondary ingredients (with cost per unit) a user can pick in a recipe.
+    Returns (options, options_json) - the JSON embed is rendered once here, matching |tojson,
+    instead of on every page view. Cached per user until one of their products or secondary
+    ingredients changes.
+    """
+    # Filter products and secondary ingredients by user (schema checks are memoized)
+    product_query = Product.query
+    if has_column('product', 'user_id'):
+        product_query = product_query.filter(Product.user_id == user_id)
+    products = product_query.order_by(Product.description).all()
+
+    # Items and their products are needed for the cost columns - load them up front
+    secondary_query = HomemadeIngredient.query.options(
+        selectinload(HomemadeIngredient.ingredients).selectinload(HomemadeIngredientItem.product)
+    )
+    if has_column('homemade_ingredient', 'user_id'):
+        secondary_query = secondary_query.filter(HomemadeIngredient.user_id == user_id)
+    secondary_ingredients = secondary_query.order_by(HomemadeIngredient.name).all()
+
+    # Build ingredient options list, ensuring no duplicates
+    ingredient_options = []
+    unique_products, unique_secondary = _unique_ingredient_choices(products, secondary_ingredients)
+
+    for p in unique_products:
+        description = p.description or ''
+        code = p.barbuddy_code or ''
+        label = f"{description} ({code})" if code else description
+        ingredient_options.append({
+            'label': label,
+            'description': description,
+            'code': code,
+            'id': int(p.id),
+            'type': 'Product',
+            'unit': p.selling_unit or 'ml',
+            'cost_per_unit': float(p.cost_per_unit or 0.0),
+            'container_volume': float(p.ml_in_bottle or (1 if (p.selling_unit or '').lower() == 'ml' else 0))
+        })
+
+    # Add secondary ingredients - only ones with a usable volume are costed, problems are logged once
+    zero_cost_ids = []
+    failed_ids = []
+    for sec in unique_secondary:
+        cost_per_unit = 0.0
+        if sec.total_volume_ml and sec.total_volume_ml > 0:
+            try:
+                cost_per_unit = sec.calculate_cost_per_unit(sec.calculate_cost()) or 0.0
+            except Exception:
+                failed_ids.append(sec.id)
+                cost_per_unit = None
+        if cost_per_unit is not None and cost_per_unit <= 0:
+            zero_cost_ids.append(sec.id)
+        cost_per_unit = max(cost_per_unit or 0.0, 0.0)
+
+        ingredient_options.append({
+            'label': f"{sec.name} ({sec.unique_code})",
+            'description': sec.name,
+            'code': sec.unique_code or '',
+            'id': int(sec.id),
+            'type': 'Secondary',
+            'unit': sec.unit or 'ml',
+            'cost_per_unit': float(cost_per_unit),
+            'container_volume': float(sec.total_volume_ml or 1.0)
+        })
+
+    if zero_cost_ids:
+        current_app.logger.warning('%d secondary ingredient(s) with zero or invalid cost_per_unit for user %s, examples: %r',
+                                   len(zero_cost_ids), user_id, zero_cost_ids[:10])
+    if failed_ids:
+        current_app.logger.error('Error calculating cost_per_unit for %d secondary ingredient(s) of user %s, examples: %r',
+                                 len(failed_ids), user_id, failed_ids[:10])
+
+    return ingredient_options, htmlsafe_json_dumps(ingredient_options, dumps=current_app.json.dumps)
+
+
+def invalidate_ingredient_options(user_id):
+    """Drop the cached picker options after a user's products or secondary ingredients change"""
+    try:
+        cache.delete_memoized(build_ingredient_options, user_id)
+    except Exception as e:
+        current_app.logger.warning(f'Could not invalidate ingredient options cache for user {user_id}: {str(e)}')
@@ -0,0 +1,37 @@
+"""
+Password hashing helpers
+New passwords are hashed with argon2; older werkzeug (pbkdf2/scrypt) hashes
+still verify and are upgraded to argon2 on the next successful login
+"""
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+from werkzeug.security import check_password_hash
+
+ARGON2_PREFIX = '$argon2'
+
+# time_cost=2, 64 MiB, 2 lanes - roughly the same defender latency as werkzeug's pbkdf2 default
+password_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=2)
+
+
+def hash_password(password):
+    """Hash a password for storage"""
+    return password_hasher.hash(password)
+
+
+def verify_password(stored_hash, password):
+    """Check a password against a stored argon2 or legacy werkzeug hash"""
+    if not stored_hash:
+        return False
+    if stored_hash.startswith(ARGON2_PREFIX):
+        try:
+            return password_hasher.verify(stored_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    return check_password_hash(stored_hash, password)
+
+
+def password_needs_rehash(stored_hash):
+    """True for legacy hashes or argon2 hashes made with outdated parameters"""
+    if not stored_hash or not stored_hash.startswith(ARGON2_PREFIX):
+        return True
+    return password_hasher.check_needs_rehash(stored_hash)
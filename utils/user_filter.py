@@ -3,19 +3,16 @@ Helper functions for user-based filtering
 Handles cases where user_id column might not exist yet
 """
 from flask import current_app
-from extensions import db
-from sqlalchemy import inspect
+from sqlalchemy import false
+from utils.db_helpers import has_column
 
 
 def has_user_id_column(model_class):
-    """Check if the model has a user_id column in the database"""
-    try:
-        inspector = inspect(db.engine)
-        table_name = model_class.__tablename__
-        columns = [col['name'] for col in inspector.get_columns(table_name)]
-        return 'user_id' in columns
-    except Exception:
+    """Check if the model has a user_id column in the database (memoized per table)"""
+    # Models without the column never need the database check
+    if 'user_id' not in model_class.__table__.c:
         return False
+    return has_column(model_class.__tablename__, 'user_id')
 
 
 def filter_by_user(query, model_class, user_id):
@@ -27,8 +24,8 @@ def filter_by_user(query, model_class, user_id):
             return query.filter(model_class.user_id == user_id)
         else:
             # Column doesn't exist yet - return empty result
-            current_app.logger.warning(f'user_id column does not exist in {model_class.__name__} table yet')
-            return query.filter(False)  # Return empty result
+            current_app.logger.warning('user_id column does not exist in %s table yet', model_class.__name__)
+            return query.filter(false())  # Return empty result
     except Exception as e:
-        current_app.logger.error(f'Error filtering by user: {str(e)}')
-        return query.filter(False)  # Return empty result on error
+        current_app.logger.error('Error filtering by user: %s', e)
+        return query.filter(false())  # Return empty result on error